@@ -14,7 +14,7 @@ from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
 from twisted.internet.defer import (
     Deferred, inlineCallbacks, maybeDeferred, returnValue, DeferredList,
-    succeed)
+    succeed, fail)
 from twisted.internet.error import ProcessDone
 from twisted.python.failure import Failure
 
@@ -172,7 +172,9 @@ class SandboxProtocol(ProcessProtocol):
         self._done = MultiDeferred()
         self._pending_requests = []
         self.exit_reason = None
-        self.timeout_task = reactor.callLater(timeout, self.kill)
+        self.timeout = timeout
+        self.timeout_task = None
+        self.start_timeout()
         self.recv_limit = recv_limit
         self.recv_bytes = 0
         self.chunk = ''
@@ -187,6 +189,15 @@ class SandboxProtocol(ProcessProtocol):
         SandboxRlimiter.spawn(
             self, self.executable, self.rlimits, **self.spawn_kwargs)
 
+    def start_timeout(self):
+        """Kill the process if it is still running after `timeout`
+        seconds."""
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+
+    def cancel_timeout(self):
+        if self.timeout_task is not None and self.timeout_task.active():
+            self.timeout_task.cancel()
+
     def done(self):
         """Returns a deferred that will be called when the process ends."""
         return self._done.get()
@@ -229,18 +240,20 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def dispatch_command(self, command):
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
         lines = self._process_data(self.chunk, data)
         for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
+            self.dispatch_command(self._parse_command(lines[i]))
         self.chunk = lines[-1]
 
     def outConnectionLost(self):
         if self.chunk:
             line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+            self.dispatch_command(self._parse_command(line))
 
     def errReceived(self, data):
         lines = self._process_data(self.error_chunk, data)
@@ -259,8 +272,7 @@ class SandboxProtocol(ProcessProtocol):
                 log.error(result)
 
     def processEnded(self, reason):
-        if self.timeout_task.active():
-            self.timeout_task.cancel()
+        self.cancel_timeout()
         if isinstance(reason.value, ProcessDone):
             result = reason.value.status
         else:
@@ -273,6 +285,263 @@ class SandboxProtocol(ProcessProtocol):
         requests_done.addCallback(lambda _r: self._done.callback(result))
 
 
+class PooledSandboxProtocol(SandboxProtocol):
+    """A :class:`SandboxProtocol` for a sandboxed process that handles
+    many messages.
+
+    The process is spawned with the `VUMI_SANDBOX_POOLED` environment
+    variable set. Instead of exiting once it has finished with a message,
+    it should send a `done` command and wait for the next one.
+
+    The `timeout` and `recv_limit` apply to starting the process and then
+    separately to each message. There is no timeout while the process is
+    idle in a pool.
+    """
+
+    DONE_COMMAND = "done"
+    POOLED_ENV_VAR = "VUMI_SANDBOX_POOLED"
+    # Provider of `callLater` and `seconds` for timeouts and ages.
+    clock = reactor
+
+    def __init__(self, *args, **kw):
+        super(PooledSandboxProtocol, self).__init__(*args, **kw)
+        self.created_at = self.clock.seconds()
+        self.requests_handled = 0
+        self.timed_out = False
+        self.retiring = False
+        self._current = None
+
+    def age(self):
+        """Seconds since this protocol was created."""
+        return self.clock.seconds() - self.created_at
+
+    def spawn(self):
+        env = dict(self.spawn_kwargs.get('env') or {})
+        env[self.POOLED_ENV_VAR] = '1'
+        self.spawn_kwargs = dict(self.spawn_kwargs, env=env)
+        super(PooledSandboxProtocol, self).spawn()
+
+    def start_timeout(self):
+        self.timeout_task = self.clock.callLater(
+            self.timeout, self._timeout_expired)
+
+    def _timeout_expired(self):
+        self.timed_out = True
+        self.kill()
+
+    def process(self, api_callback):
+        """Hand a message to the sandboxed process.
+
+        :param api_callback:
+            Called with this protocol's :class:`SandboxApi` to send the
+            message to the process.
+
+        Returns a deferred that fires with `0` once the process has sent a
+        `done` command and all of its requests have been handled, or with
+        the process' exit status (or a failure) if it ends first.
+        """
+        self.requests_handled += 1
+        self.recv_bytes = 0
+        self.api.clear_inbound_messages()
+        self._current = Deferred()
+        self.cancel_timeout()
+        self.start_timeout()
+        api_callback(self.api)
+        return self._current
+
+    def dispatch_command(self, command):
+        if command['cmd'] == self.DONE_COMMAND:
+            self._message_done()
+        else:
+            super(PooledSandboxProtocol, self).dispatch_command(command)
+
+    def _message_done(self):
+        current, self._current = self._current, None
+        if current is None:
+            log.warning("Sandbox %r sent %r while not handling a message."
+                        % (self.sandbox_id, self.DONE_COMMAND))
+            return
+        self.cancel_timeout()
+        pending, self._pending_requests = self._pending_requests, []
+        d = DeferredList(pending)
+        d.addCallback(self._process_request_results)
+        d.addCallback(lambda _r: current.callback(0))
+
+    def processEnded(self, reason):
+        super(PooledSandboxProtocol, self).processEnded(reason)
+        current, self._current = self._current, None
+        if current is not None:
+            self.done().chainDeferred(current)
+
+
+class SandboxPool(object):
+    """A pool of running sandbox processes for a single sandbox id.
+
+    Processes are spawned and initialized ahead of time and each one is
+    reused for many messages. A process is replaced once it has handled
+    `max_requests` messages or is older than `max_age` seconds. This also
+    bounds the CPU time it accumulates, since rlimits apply to a process'
+    whole lifetime. Processes that exit unexpectedly (for example, by
+    exceeding an rlimit) or time out are discarded and replaced when they
+    are next needed.
+
+    Counts of what has happened to the pool's processes are kept in
+    :attr:`stats`.
+
+    :param str sandbox_id:
+        The sandbox id the pool's processes run code for.
+    :param protocol_factory:
+        Callable that returns a new, unspawned,
+        :class:`PooledSandboxProtocol`.
+    :param int size:
+        The number of processes to keep running.
+    :param int max_requests:
+        Messages a process may handle before it is replaced. `0` means no
+        limit.
+    :param float max_age:
+        Seconds a process may run for before it is replaced. `0` means no
+        limit.
+    """
+
+    def __init__(self, sandbox_id, protocol_factory, size, max_requests=0,
+                 max_age=0):
+        self.sandbox_id = sandbox_id
+        self.protocol_factory = protocol_factory
+        self.size = size
+        self.max_requests = max_requests
+        self.max_age = max_age
+        self.stats = {
+            'spawned': 0,
+            'requests': 0,
+            'recycled': 0,
+            'died': 0,
+            'timeouts': 0,
+        }
+        self._protocols = set()
+        self._idle = []
+        self._waiting = []
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._protocols)
+
+    def idle_count(self):
+        return len(self._idle)
+
+    def fill(self):
+        """Spawn processes until the pool is full."""
+        while len(self._protocols) < self.size:
+            self._spawn()
+
+    def _spawn(self):
+        protocol = self.protocol_factory()
+        self._protocols.add(protocol)
+        self.stats['spawned'] += 1
+        protocol.spawn()
+        protocol.done().addBoth(self._process_ended, protocol)
+        d = protocol.started()
+        d.addCallbacks(self._process_started, log.error)
+
+    def _process_started(self, protocol):
+        protocol.api.sandbox_init()
+        # The process may sit idle for a while before it is given a
+        # message, so it mustn't be killed for taking too long to start.
+        protocol.cancel_timeout()
+        self._make_available(protocol)
+
+    def _make_available(self, protocol):
+        if protocol not in self._protocols:
+            return
+        if self._waiting:
+            self._waiting.pop(0).callback(protocol)
+        else:
+            self._idle.append(protocol)
+
+    def _should_recycle(self, protocol):
+        if (self.max_requests and
+                protocol.requests_handled >= self.max_requests):
+            return True
+        if self.max_age and protocol.age() >= self.max_age:
+            return True
+        return False
+
+    def _retire(self, protocol):
+        protocol.retiring = True
+        self._protocols.discard(protocol)
+        if protocol in self._idle:
+            self._idle.remove(protocol)
+        protocol.kill()
+
+    def _process_ended(self, result, protocol):
+        if protocol.retiring:
+            return
+        self._protocols.discard(protocol)
+        if protocol in self._idle:
+            self._idle.remove(protocol)
+        if self._stopping:
+            return
+        if protocol.timed_out:
+            self.stats['timeouts'] += 1
+        else:
+            self.stats['died'] += 1
+        log.warning("Sandbox process for %r ended unexpectedly after %d"
+                    " requests: %r" % (self.sandbox_id,
+                                       protocol.requests_handled, result))
+        # Replace the process only if something is waiting for one, so a
+        # sandbox that keeps failing doesn't spawn processes in a loop.
+        while self._waiting and len(self._protocols) < self.size:
+            self._spawn()
+
+    def acquire(self):
+        """Return a deferred that fires with an idle process."""
+        if self._stopping:
+            return fail(SandboxError("Sandbox pool %r has been stopped."
+                                     % (self.sandbox_id,)))
+        if self._idle:
+            return succeed(self._idle.pop())
+        if len(self._protocols) < self.size:
+            self._spawn()
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def release(self, protocol):
+        """Return a process to the pool after it has handled a message."""
+        if protocol not in self._protocols:
+            return
+        if self._should_recycle(protocol):
+            self.stats['recycled'] += 1
+            self._retire(protocol)
+            self.fill()
+        else:
+            self._make_available(protocol)
+
+    @inlineCallbacks
+    def process(self, api_callback):
+        """Hand a message to a process from the pool.
+
+        See :meth:`PooledSandboxProtocol.process`.
+        """
+        protocol = yield self.acquire()
+        self.stats['requests'] += 1
+        status = yield protocol.process(api_callback)
+        self.release(protocol)
+        returnValue(status)
+
+    def stop(self):
+        """Kill all the pool's processes."""
+        self._stopping = True
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(SandboxError("Sandbox pool %r has been stopped."
+                                   % (self.sandbox_id,)))
+        deferreds = []
+        for protocol in list(self._protocols):
+            deferreds.append(protocol.done())
+            self._retire(protocol)
+        return DeferredList(deferreds, consumeErrors=True)
+
+
 class SandboxResources(object):
     """Class for holding resources common to a set of sandboxes."""
 
@@ -563,6 +832,9 @@ class SandboxApi(object):
     def get_inbound_message(self, message_id):
         return self._inbound_messages.get(message_id)
 
+    def clear_inbound_messages(self):
+        self._inbound_messages.clear()
+
     @inlineCallbacks
     def dispatch_request(self, command):
         resource_name, sep, rest = command['cmd'].partition('.')
@@ -629,10 +901,34 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " Python `resource` module. Values should be appropriate integers.",
         default={})
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pool_size = ConfigInt(
+        "Number of sandboxed processes to keep running for each sandbox id."
+        " Each process handles many messages and must send a `done`"
+        " command after each one instead of exiting. If 0, a new process"
+        " is started for each message.", default=0)
+    pool_max_requests = ConfigInt(
+        "Number of messages a pooled process may handle before it is"
+        " replaced. 0 means no limit.", default=100)
+    pool_max_age = ConfigInt(
+        "Number of seconds a pooled process may run for before it is"
+        " replaced. 0 means no limit.", default=3600)
+    pool_sandbox_ids = ConfigList(
+        "Sandbox ids to start process pools for when the worker starts."
+        " Pools for other sandbox ids are started when their first message"
+        " arrives. Only used if `pool_size` is set.", default=[],
+        static=True)
 
 
 class Sandbox(ApplicationWorker):
-    """Sandbox application worker."""
+    """Sandbox application worker.
+
+    By default each message or event is processed by a new sandboxed
+    process. If `pool_size` is set, a :class:`SandboxPool` of processes
+    is kept for each sandbox id instead. Pooled processes are only
+    replaced after `pool_max_requests` messages or `pool_max_age` seconds,
+    so any changes to a sandbox's configuration only take effect once
+    its processes have been replaced.
+    """
 
     CONFIG_CLASS = SandboxConfig
 
@@ -655,9 +951,16 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+        return self.get_config_for_sandbox_id(sandbox_id)
+
+    def get_config_for_sandbox_id(self, sandbox_id):
+        def get_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(sandbox_id, get_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -667,11 +970,21 @@ class Sandbox(ApplicationWorker):
                 raise ConfigError("Unknown resource limit key %r" % (key,))
         return rlimits
 
+    @inlineCallbacks
     def setup_application(self):
-        return self.resources.setup_resources()
+        self.sandbox_pools = {}
+        yield self.resources.setup_resources()
+        for sandbox_id in self.get_static_config().pool_sandbox_ids:
+            config = yield self.get_config_for_sandbox_id(sandbox_id)
+            if config.pool_size:
+                self.get_sandbox_pool(config)
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        pools, self.sandbox_pools = self.sandbox_pools, {}
+        for pool in pools.itervalues():
+            yield pool.stop()
+        yield self.resources.teardown_resources()
 
     def create_sandbox_resources(self, config):
         return SandboxResources(self, config)
@@ -684,15 +997,34 @@ class Sandbox(ApplicationWorker):
         rlimits.update(self._convert_rlimits(config.rlimits))
         return rlimits
 
-    def create_sandbox_protocol(self, api):
+    def create_sandbox_protocol(self, api, protocol_class=SandboxProtocol):
         executable, args = self.get_executable_and_args(api.config)
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
             args=args, env=api.config.env, path=api.config.path)
-        return SandboxProtocol(
+        return protocol_class(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
             api.config.timeout, api.config.recv_limit)
 
+    def create_pooled_sandbox_protocol(self, config):
+        api = self.create_sandbox_api(self.resources, config)
+        return self.create_sandbox_protocol(api, PooledSandboxProtocol)
+
+    def get_sandbox_pool(self, config):
+        """Return the :class:`SandboxPool` for a sandbox id, creating (and
+        filling) it if necessary.
+        """
+        pool = self.sandbox_pools.get(config.sandbox_id)
+        if pool is None:
+            pool = SandboxPool(
+                config.sandbox_id,
+                lambda: self.create_pooled_sandbox_protocol(config),
+                config.pool_size, config.pool_max_requests,
+                config.pool_max_age)
+            self.sandbox_pools[config.sandbox_id] = pool
+            pool.fill()
+        return pool
+
     def create_sandbox_api(self, resources, config):
         return SandboxApi(resources, config)
 
@@ -726,9 +1058,18 @@ class Sandbox(ApplicationWorker):
         d.addCallbacks(on_start, log.error)
         return d
 
+    def _process_in_pool(self, config, api_callback):
+        d = self.get_sandbox_pool(config).process(api_callback)
+        d.addErrback(log.error)
+        return d
+
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        if config.pool_size:
+            status = yield self._process_in_pool(
+                config, lambda api: api.sandbox_inbound_message(msg))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
 
         def sandbox_init():
@@ -740,6 +1081,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        if config.pool_size:
+            status = yield self._process_in_pool(
+                config, lambda api: api.sandbox_inbound_event(event))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
 
@@ -62,6 +62,8 @@ var SandboxRunner = function (api) {
     self.chunk = "";
     self.pending_requests = {};
     self.loaded = false;
+    // pooled sandboxes handle many messages and report when each is done
+    self.pooled = !!process.env.VUMI_SANDBOX_POOLED;
 
     self.emitter.on('command', function (command) {
         var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
@@ -84,7 +86,12 @@ var SandboxRunner = function (api) {
     });
 
     self.emitter.on('exit', function () {
-        process.exit(0);
+        if (self.pooled) {
+            self.send_command(self.api.populate_command("done", {}));
+        }
+        else {
+            process.exit(0);
+        }
     });
 
     self.load_code = function (command) {
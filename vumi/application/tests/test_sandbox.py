@@ -8,6 +8,7 @@ from collections import defaultdict
 
 from twisted.internet.defer import inlineCallbacks, fail, succeed
 from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase, SkipTest
 
 from vumi.message import TransportUserMessage, TransportEvent
@@ -15,7 +16,7 @@ from vumi.application.tests.utils import ApplicationTestCase
 from vumi.application.sandbox import (
     Sandbox, SandboxCommand, SandboxError, RedisResource, OutboundResource,
     JsSandboxResource, LoggingResource, HttpClientResource, JsSandbox,
-    JsFileSandbox)
+    JsFileSandbox, PooledSandboxProtocol)
 from vumi.tests.utils import LogCatcher, PersistenceMixin
 
 
@@ -232,6 +233,96 @@ class SandboxTestCase(SandboxTestCaseBase):
         self.assertTrue('/pp1' not in path)
         self.assertTrue('/pp2' not in path)
 
+    POOLED_APP = (
+        "import sys, json\n"
+        "for line in iter(sys.stdin.readline, ''):\n"
+        "    cmd = json.loads(line)\n"
+        "    if cmd['cmd'].startswith('inbound-'):\n"
+        "        sys.stdout.write(json.dumps({'cmd': 'done'}) + '\\n')\n"
+        "        sys.stdout.flush()\n"
+    )
+
+    def setup_pooled_app(self, python_code=None, **pool_config):
+        config = {'pool_size': '1'}
+        config.update(pool_config)
+        return self.setup_app(python_code or self.POOLED_APP, config)
+
+    @inlineCallbacks
+    def test_pooled_process_reuse(self):
+        app = yield self.setup_pooled_app()
+        for i in range(3):
+            status = yield app.process_event_in_sandbox(self.mk_ack())
+            self.assertEqual(status, 0)
+        pool = app.sandbox_pools['sandbox1']
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.idle_count(), 1)
+        self.assertEqual(pool.stats['spawned'], 1)
+        self.assertEqual(pool.stats['requests'], 3)
+
+    @inlineCallbacks
+    def test_pooled_process_max_requests(self):
+        app = yield self.setup_pooled_app(pool_max_requests='2')
+        for i in range(3):
+            status = yield app.process_message_in_sandbox(self.mk_msg())
+            self.assertEqual(status, 0)
+        pool = app.sandbox_pools['sandbox1']
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.stats['spawned'], 2)
+        self.assertEqual(pool.stats['recycled'], 1)
+
+    @inlineCallbacks
+    def test_pooled_process_died(self):
+        app = yield self.setup_pooled_app(
+            "import sys\n"
+            "sys.stdin.readline()\n")
+        for i in range(2):
+            status = yield app.process_event_in_sandbox(self.mk_ack())
+            self.assertEqual(status, 0)
+        pool = app.sandbox_pools['sandbox1']
+        self.assertEqual(pool.stats['spawned'], 2)
+        self.assertEqual(pool.stats['died'], 2)
+
+    @inlineCallbacks
+    def test_pooled_process_timeout(self):
+        app = yield self.setup_pooled_app(
+            "import time\n"
+            "time.sleep(5)\n", timeout='1')
+        status = yield app.process_event_in_sandbox(self.mk_ack())
+        self.assertEqual(status, None)
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+        pool = app.sandbox_pools['sandbox1']
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.stats['timeouts'], 1)
+
+    @inlineCallbacks
+    def test_pooled_idle_process_not_timed_out(self):
+        clock = Clock()
+        self.patch(PooledSandboxProtocol, 'clock', clock)
+        app = yield self.setup_pooled_app(
+            timeout='1', pool_sandbox_ids=['sandbox1'])
+        pool = app.sandbox_pools['sandbox1']
+        [protocol] = list(pool._protocols)
+        yield protocol.started()
+        self.assertEqual(pool.idle_count(), 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        clock.advance(2)
+        self.assertEqual(pool.idle_count(), 1)
+        self.assertEqual(pool.stats['timeouts'], 0)
+        status = yield app.process_event_in_sandbox(self.mk_ack())
+        self.assertEqual(status, 0)
+        self.assertEqual(pool.stats['spawned'], 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_pool_sandbox_ids(self):
+        app = yield self.setup_pooled_app(
+            pool_size='2', pool_sandbox_ids=['sandbox1'])
+        pool = app.sandbox_pools['sandbox1']
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.stats['spawned'], 2)
+
     @inlineCallbacks
     def echo_check(self, handler_name, msg, expected_cmd):
         app = yield self.setup_app(
@@ -314,6 +405,33 @@ class JsSandboxTestCase(SandboxTestCaseBase):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, {'pool_size': '1'})
+
+        with LogCatcher() as lc:
+            for i in range(2):
+                status = yield app.process_message_in_sandbox(self.mk_msg())
+                self.assertEqual(status, 0)
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+        self.assertEqual(app.sandbox_pools['sandbox1'].stats['spawned'], 1)
+
     @inlineCallbacks
     def test_js_sandboxer_with_app_context(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
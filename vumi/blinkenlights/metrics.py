@@ -11,6 +11,7 @@ from twisted.python import log
 from vumi.service import Publisher, Consumer
 from vumi.blinkenlights.message20110818 import MetricMessage
 
+import math
 import time
 
 
@@ -105,15 +106,29 @@ class Aggregator(object):
     :param func:
        The aggregation function. Should return a default value
        if the list of values is empty (usually this default is 0.0).
+    :type summary_func: f(:class:`MetricSummary`) -> float, optional
+    :param summary_func:
+       Computes the same aggregate from a :class:`MetricSummary`.
+       Shorthand for passing a :class:`SummaryAggregation` as
+       `incremental`.
+    :type incremental: :class:`IncrementalAggregation`, optional
+    :param incremental:
+       Computes the same aggregate from state that values are folded
+       into as they arrive, so that the values needn't be kept. Only
+       aggregators with an incremental implementation may be used with
+       pre-aggregated metrics.
     """
 
     REGISTRY = {}
 
-    def __init__(self, name, func):
+    def __init__(self, name, func, summary_func=None, incremental=None):
         if name in self.REGISTRY:
             raise AggregatorAlreadyDefinedError(name)
+        if incremental is None and summary_func is not None:
+            incremental = SummaryAggregation(summary_func)
         self.name = name
         self.func = func
+        self.incremental = incremental
         self.REGISTRY[name] = self
 
     @classmethod
@@ -123,13 +138,287 @@ class Aggregator(object):
     def __call__(self, values):
         return self.func(values)
 
+    def supports_incremental(self):
+        return self.incremental is not None
 
-SUM = Aggregator("sum", sum)
+    @property
+    def state_key(self):
+        """The key of the state used by the incremental implementation."""
+        return self.incremental.state_key
+
+    def new_state(self):
+        return self.incremental.new_state()
+
+    def result(self, state):
+        """Apply the aggregator to incremental state."""
+        if not state.count:
+            return self.func([])
+        return self.incremental.result(state)
+
+
+class IncrementalAggregation(object):
+    """Incremental implementation of an aggregator.
+
+    Values are folded into a state object as they arrive instead of
+    being collected in a list. States must have a `count` attribute
+    and `add(value, timestamp=None)` and `merge(other, timestamp=None)`
+    methods. Aggregations with the same `state_key` share one state,
+    so, for example, several quantiles can be read from one sketch.
+    """
+
+    state_key = None
+
+    def new_state(self):
+        raise NotImplementedError()
+
+    def result(self, state):
+        raise NotImplementedError()
+
+
+class SummaryAggregation(IncrementalAggregation):
+    """Aggregation computed from a :class:`MetricSummary`."""
+
+    def __init__(self, summary_func):
+        self.summary_func = summary_func
+
+    @property
+    def state_key(self):
+        return MetricSummary.STATE_KEY
+
+    def new_state(self):
+        return MetricSummary()
+
+    def result(self, state):
+        return self.summary_func(state)
+
+
+class QuantileAggregation(IncrementalAggregation):
+    """Aggregation computed from a :class:`QuantileSketch`."""
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+
+    @property
+    def state_key(self):
+        return QuantileSketch.STATE_KEY
+
+    def new_state(self):
+        return QuantileSketch()
+
+    def result(self, state):
+        return state.quantile(self.quantile)
+
+
+def _quantile_func(q):
+    def quantile(values):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[int(q * (len(values) - 1))]
+    return quantile
+
+
+SUM = Aggregator("sum", sum, lambda summary: summary.sum)
 AVG = Aggregator("avg",
-                 lambda values: sum(values) / len(values) if values else 0.0)
-MAX = Aggregator("max", lambda values: max(values) if values else 0.0)
-MIN = Aggregator("min", lambda values: min(values) if values else 0.0)
-LAST = Aggregator("last", lambda values: values[-1] if values else 0.0)
+                 lambda values: sum(values) / len(values) if values else 0.0,
+                 lambda summary: summary.sum / summary.count)
+MAX = Aggregator("max", lambda values: max(values) if values else 0.0,
+                 lambda summary: summary.max)
+MIN = Aggregator("min", lambda values: min(values) if values else 0.0,
+                 lambda summary: summary.min)
+LAST = Aggregator("last", lambda values: values[-1] if values else 0.0,
+                  lambda summary: summary.last)
+COUNT = Aggregator("count", lambda values: float(len(values)),
+                   lambda summary: float(summary.count))
+P50 = Aggregator("p50", _quantile_func(0.5),
+                 incremental=QuantileAggregation(0.5))
+P95 = Aggregator("p95", _quantile_func(0.95),
+                 incremental=QuantileAggregation(0.95))
+P99 = Aggregator("p99", _quantile_func(0.99),
+                 incremental=QuantileAggregation(0.99))
+
+
+class MetricSummary(object):
+    """Constant size summary of a set of metric values.
+
+    Tracks the sum, count, minimum, maximum and last value of the values
+    added to it. Summaries of different sets of values can be merged.
+    Timestamps are optional and only used to decide which value is the
+    last one when values or summaries arrive out of order.
+
+    Summaries are sent as JSON objects in place of a single value in a
+    metric datapoint's list of (timestamp, value) pairs.
+    """
+
+    STATE_KEY = 'summary'
+    FIELDS = ('sum', 'count', 'min', 'max', 'last')
+
+    def __init__(self):
+        self.sum = 0.0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self._last_timestamp = None
+
+    def _update_last(self, value, timestamp):
+        if timestamp is None or self._last_timestamp is None:
+            self.last = value
+            self._last_timestamp = timestamp
+        elif timestamp >= self._last_timestamp:
+            self.last = value
+            self._last_timestamp = timestamp
+
+    def add(self, value, timestamp=None):
+        """Add a single value to the summary."""
+        self.sum += value
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._update_last(value, timestamp)
+
+    def merge(self, other, timestamp=None):
+        """Merge another summary into this one."""
+        if not other.count:
+            return
+        self.sum += other.sum
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._update_last(other.last, timestamp)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, summary_dict):
+        summary = cls()
+        for field in cls.FIELDS:
+            setattr(summary, field, summary_dict[field])
+        return summary
+
+
+class QuantileSketch(object):
+    """Mergeable sketch for estimating quantiles of a set of values.
+
+    Values are counted in logarithmically sized buckets so that every
+    quantile estimate is within `relative_accuracy` of a value in the
+    set. Adding a value is O(1) and the number of buckets grows with the
+    logarithm of the range of values, not with the number of values.
+    Sketches with the same relative accuracy can be merged by adding
+    their bucket counts.
+
+    Values closer to zero than `MIN_VALUE` are counted as zero.
+    """
+
+    STATE_KEY = 'sketch'
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=None):
+        if relative_accuracy is None:
+            relative_accuracy = self.DEFAULT_RELATIVE_ACCURACY
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive = {}  # bucket index -> count
+        self.negative = {}  # bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _bucket_value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value, timestamp=None):
+        """Add a single value to the sketch."""
+        if value > self.MIN_VALUE:
+            index = self._index(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < -self.MIN_VALUE:
+            index = self._index(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+
+    def merge(self, other, timestamp=None):
+        """Merge another sketch into this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with relative accuracy"
+                             " %r and %r." % (self.relative_accuracy,
+                                              other.relative_accuracy))
+        for buckets, other_buckets in [(self.positive, other.positive),
+                                       (self.negative, other.negative)]:
+            for index, count in other_buckets.iteritems():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate the value at quantile `q` (between 0 and 1)."""
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._bucket_value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._bucket_value(index)
+        return self._bucket_value(max(self.positive))
+
+    def to_dict(self):
+        return {
+            'type': self.STATE_KEY,
+            'relative_accuracy': self.relative_accuracy,
+            'positive': sorted(self.positive.items()),
+            'negative': sorted(self.negative.items()),
+            'zero': self.zero_count,
+            }
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        sketch = cls(sketch_dict['relative_accuracy'])
+        sketch.positive = dict(
+            (int(i), c) for i, c in sketch_dict['positive'])
+        sketch.negative = dict(
+            (int(i), c) for i, c in sketch_dict['negative'])
+        sketch.zero_count = sketch_dict['zero']
+        sketch.count = sketch.zero_count + sum(
+            sketch.positive.itervalues()) + sum(sketch.negative.itervalues())
+        return sketch
+
+
+def is_serialized_state(value):
+    """Return `True` if a datapoint value is serialized aggregation state."""
+    return isinstance(value, dict)
+
+
+def state_from_dict(state_dict):
+    """Decode aggregation state sent as a datapoint value.
+
+    Returns a `(state_key, state)` pair. Dictionaries without a `type` are
+    :class:`MetricSummary` dictionaries.
+    """
+    state_key = state_dict.get('type', MetricSummary.STATE_KEY)
+    state_class = {
+        MetricSummary.STATE_KEY: MetricSummary,
+        QuantileSketch.STATE_KEY: QuantileSketch,
+    }[state_key]
+    return state_key, state_class.from_dict(state_dict)
 
 
 class MetricRegistrationError(Exception):
@@ -190,6 +479,55 @@ class Metric(object):
         return values
 
 
+class PreAggregatedMetric(Metric):
+    """Metric that summarizes its values on the client.
+
+    Instead of recording every value set, a :class:`MetricSummary` is
+    kept for each second values were set in, so memory use and the size
+    of published metric messages don't grow with the rate at which values
+    are set. All of the metric's aggregators must support summaries.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> my_val = mm.register(PreAggregatedMetric('my.value'))
+    >>> my_val.set(1.5)
+    """
+
+    #: Classes of the state kept for each second.
+    STATE_CLASSES = (MetricSummary,)
+
+    def __init__(self, suffix, aggregators=None):
+        super(PreAggregatedMetric, self).__init__(suffix, aggregators)
+        state_keys = set(cls.STATE_KEY for cls in self.STATE_CLASSES)
+        for agg_name in self.aggs:
+            agg = Aggregator.from_name(agg_name)
+            if not (agg.supports_incremental() and
+                    agg.state_key in state_keys):
+                raise MetricRegistrationError(
+                    "Aggregator %s does not support pre-aggregated metric"
+                    " %s." % (agg_name, suffix))
+        self._current_ts = None
+        self._current = None
+
+    def set(self, value):
+        """Add a value to the state for the current second."""
+        ts = int(time.time())
+        if ts != self._current_ts:
+            self._current_ts = ts
+            self._current = [cls() for cls in self.STATE_CLASSES]
+            self._values.append((ts, self._current))
+        for state in self._current:
+            state.add(value)
+
+    def poll(self):
+        """Called periodically by the :class:`MetricManager`."""
+        values, self._values = self._values, []
+        self._current_ts, self._current = None, None
+        return [(ts, state.to_dict())
+                for ts, states in values for state in states]
+
+
 class Count(Metric):
     """A simple counter.
 
@@ -208,6 +546,13 @@ class Count(Metric):
         self.set(1.0)
 
 
+class PreAggregatedCount(PreAggregatedMetric, Count):
+    """A counter that summarizes its increments on the client.
+
+    See :class:`PreAggregatedMetric`.
+    """
+
+
 class TimerAlreadyStartedError(Exception):
     pass
 
@@ -262,6 +607,50 @@ class Timer(Metric):
         self.set(duration)
 
 
+class PreAggregatedTimer(PreAggregatedMetric, Timer):
+    """A timer that summarizes its durations on the client.
+
+    See :class:`PreAggregatedMetric`.
+    """
+
+
+class Histogram(PreAggregatedMetric):
+    """Metric that records the distribution of its values.
+
+    Along with a :class:`MetricSummary`, a :class:`QuantileSketch` is
+    kept for each second values were set in. Recording a value is O(1)
+    and sketches from different workers are merged by the
+    :class:`MetricAggregator`, so percentile aggregates such as
+    :data:`P95` are computed over all the values recorded.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> my_hist = mm.register(Histogram('my.latency'))
+    >>> my_hist.set(0.25)
+    """
+
+    #: Default aggregators are [:data:`AVG`, :data:`MAX`, :data:`P50`,
+    #: :data:`P95`, :data:`P99`]
+    DEFAULT_AGGREGATORS = [AVG, MAX, P50, P95, P99]
+
+    STATE_CLASSES = (MetricSummary, QuantileSketch)
+
+
+class HistogramTimer(Histogram, Timer):
+    """A timer that records the distribution of its durations.
+
+    See :class:`Histogram` and :class:`Timer`.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> submit_timer = mm.register(HistogramTimer('submit_sm'))
+    >>> with submit_timer:
+    >>>     submit_message()
+    """
+
+
 class MetricsConsumer(Consumer):
     """Utility for consuming metrics published by :class:`MetricManager`s.
 
@@ -13,7 +13,8 @@ from twisted.internet.protocol import DatagramProtocol
 
 from vumi.service import Consumer, Publisher, Worker
 from vumi.blinkenlights.metrics import (MetricsConsumer, MetricManager, Count,
-                                        Metric, Timer, Aggregator)
+                                        Metric, Timer, Aggregator,
+                                        is_serialized_state, state_from_dict)
 from vumi.blinkenlights.message20110818 import MetricMessage
 
 
@@ -163,6 +164,77 @@ class DiscardedMetricError(Exception):
     pass
 
 
+class MetricAggregation(object):
+    """Aggregation state for one metric in one time bucket.
+
+    Values are folded into the incremental state of the metric's
+    aggregators as they arrive, so memory use doesn't grow with the
+    number of values. Raw values are only kept if one of the aggregators
+    has no incremental implementation.
+
+    Pre-aggregated state (e.g. :class:`MetricSummary` objects sent by
+    pre-aggregated metrics) is merged into the matching state. Aggregators
+    that need a different kind of state can't be computed for such
+    metrics and are skipped.
+    """
+
+    def __init__(self, metric_name):
+        self.metric_name = metric_name
+        self.aggregators = set()
+        self.states = {}  # state_key -> incremental state
+        self.values = []  # (timestamp, value) pairs, if needed
+        self.keep_values = False
+        self.received_states = set()  # state_keys of pre-aggregated state
+
+    def __repr__(self):
+        return "<MetricAggregation %s %r>" % (
+            self.metric_name, sorted(self.aggregators))
+
+    def add_aggregators(self, agg_names):
+        for agg_name in agg_names:
+            if agg_name in self.aggregators:
+                continue
+            self.aggregators.add(agg_name)
+            agg = Aggregator.from_name(agg_name)
+            if not agg.supports_incremental():
+                self.keep_values = True
+            elif agg.state_key not in self.states:
+                self.states[agg.state_key] = agg.new_state()
+
+    def add_value(self, timestamp, value):
+        if is_serialized_state(value):
+            state_key, state = state_from_dict(value)
+            self.received_states.add(state_key)
+            if state_key in self.states:
+                self.states[state_key].merge(state, timestamp)
+            return
+        for state in self.states.itervalues():
+            state.add(value, timestamp)
+        if self.keep_values:
+            self.values.append((timestamp, value))
+
+    def aggregate(self):
+        """Return a list of (aggregate metric name, value) pairs."""
+        values = [v for t, v in sorted(self.values)]
+        aggregates = []
+        for agg_name in sorted(self.aggregators):
+            agg_metric = "%s.%s" % (self.metric_name, agg_name)
+            agg_func = Aggregator.from_name(agg_name)
+            if self.received_states and not (
+                    agg_func.supports_incremental() and
+                    agg_func.state_key in self.received_states):
+                log.err(DiscardedMetricError(
+                    "Aggregator %s cannot be applied to pre-aggregated"
+                    " metric %s" % (agg_name, self.metric_name)))
+                continue
+            if agg_func.supports_incremental():
+                agg_value = agg_func.result(self.states[agg_func.state_key])
+            else:
+                agg_value = agg_func(values)
+            aggregates.append((agg_metric, agg_value))
+        return aggregates
+
+
 class MetricAggregator(Worker):
     """Gathers a subset of metrics and aggregates them.
 
@@ -194,8 +266,7 @@ class MetricAggregator(Worker):
         log.msg("Bucket size is %d seconds" % self.bucket_size)
         self.lag = float(self.config.get("lag", 5.0))
 
-        # ts_key -> { metric_name -> (aggregate_set, values) }
-        # values is a list of (timestamp, value) pairs
+        # ts_key -> { metric_name -> MetricAggregation }
         self.buckets = {}
         # initialize last processed bucket
         self._last_ts_key = self._ts_key(self._time() - self.lag) - 2
@@ -221,14 +292,8 @@ class MetricAggregator(Worker):
             elif ts_key <= current_ts_key:
                 aggregates = []
                 ts = ts_key * self.bucket_size
-                items = self.buckets[ts_key].iteritems()
-                for metric_name, (agg_set, values) in items:
-                    values = [v for t, v in sorted(values)]
-                    for agg_name in agg_set:
-                        agg_metric = "%s.%s" % (metric_name, agg_name)
-                        agg_func = Aggregator.from_name(agg_name)
-                        agg_value = agg_func(values)
-                        aggregates.append((agg_metric, agg_value))
+                for aggregation in self.buckets[ts_key].itervalues():
+                    aggregates.extend(aggregation.aggregate())
 
                 for agg_metric, agg_value in aggregates:
                     self.publisher.publish_aggregate(agg_metric, ts,
@@ -243,12 +308,13 @@ class MetricAggregator(Worker):
         metrics = self.buckets.get(ts_key, None)
         if metrics is None:
             metrics = self.buckets[ts_key] = {}
-        metric = metrics.get(metric_name)
-        if metric is None:
-            metric = metrics[metric_name] = (set(), [])
-        existing_aggregates, existing_values = metric
-        existing_aggregates.update(aggregates)
-        existing_values.extend(values)
+        aggregation = metrics.get(metric_name)
+        if aggregation is None:
+            aggregation = metrics[metric_name] = MetricAggregation(
+                metric_name)
+        aggregation.add_aggregators(aggregates)
+        for timestamp, value in values:
+            aggregation.add_value(timestamp, value)
 
     def stopWorker(self):
         self._task.stop()
@@ -278,6 +344,57 @@ class MetricsCollectorWorker(Worker):
         raise NotImplementedError()
 
 
+class MetricLineBuffer(object):
+    """Collects lines of metric output and flushes them in batches.
+
+    Lines are flushed once adding another line would take the batch over
+    `max_size`, or `flush_interval` seconds after the first line of a
+    batch was added, whichever comes first. A single line larger than
+    `max_size` is flushed on its own.
+
+    :param flush_func:
+        Called with the list of lines in a batch.
+    :param int max_size:
+        Maximum size of a batch, as measured by `size_func`.
+    :param float flush_interval:
+        Maximum number of seconds to hold lines for.
+    :param size_func:
+        Returns the size of a line. Defaults to counting lines.
+    """
+
+    callLater = reactor.callLater
+
+    def __init__(self, flush_func, max_size, flush_interval, size_func=None):
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.size_func = size_func or (lambda line: 1)
+        self._lines = []
+        self._size = 0
+        self._flush_call = None
+
+    def add(self, line):
+        line_size = self.size_func(line)
+        if self._lines and self._size + line_size > self.max_size:
+            self.flush()
+        self._lines.append(line)
+        self._size += line_size
+        if self._size >= self.max_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self._lines:
+            return
+        lines, self._lines, self._size = self._lines, [], 0
+        self.flush_func(lines)
+
+
 class GraphitePublisher(Publisher):
     """Publisher for sending messages to Graphite."""
 
@@ -288,21 +405,66 @@ class GraphitePublisher(Publisher):
     delivery_mode = 2
     require_bind = False  # Graphite uses a topic exchange
 
+    BATCH_ROUTING_KEY = "vumi.metrics.batch"
+
     def publish_metric(self, metric, value, timestamp):
         self.publish_raw("%f %d" % (value, timestamp), routing_key=metric)
 
+    def publish_metric_values(self, metric, values):
+        """Publish many (timestamp, value) pairs for one metric in one
+        message."""
+        self.publish_raw("\n".join("%f %d" % (value, timestamp)
+                                   for timestamp, value in values),
+                         routing_key=metric)
+
+    def publish_lines(self, lines):
+        """Publish lines of the form `<metric> <value> <timestamp>` in one
+        message. Requires `AMQP_METRIC_NAME_IN_BODY = True` in Carbon's
+        configuration."""
+        self.publish_raw("\n".join(lines),
+                         routing_key=self.BATCH_ROUTING_KEY)
+
 
 class GraphiteMetricsCollector(MetricsCollectorWorker):
-    """Worker that collects Vumi metrics and publishes them to Graphite."""
+    """Worker that collects Vumi metrics and publishes them to Graphite.
+
+    Configuration Values
+    --------------------
+    metric_name_in_body : bool, optional
+        If `True`, datapoints for many metrics are sent in each message
+        with the metric name in the message body. Carbon must be
+        configured with `AMQP_METRIC_NAME_IN_BODY = True`. Otherwise the
+        datapoints for each metric are sent in one message routed by
+        metric name. Default is `False`.
+    max_batch_size : int, optional
+        Maximum number of datapoints per message when
+        `metric_name_in_body` is set. Default is 500.
+    flush_interval : float in seconds, optional
+        Maximum time datapoints are held for when `metric_name_in_body`
+        is set. Default is 1s.
+    """
 
     @inlineCallbacks
     def setup_worker(self):
+        self.metric_name_in_body = self.config.get(
+            'metric_name_in_body', False)
         self.graphite_publisher = yield self.start_publisher(GraphitePublisher)
+        self.line_buffer = MetricLineBuffer(
+            self.graphite_publisher.publish_lines,
+            int(self.config.get('max_batch_size', 500)),
+            float(self.config.get('flush_interval', 1.0)))
+
+    def teardown_worker(self):
+        self.line_buffer.flush()
 
     def consume_metrics(self, metric_name, values):
+        if not self.metric_name_in_body:
+            self.graphite_publisher.publish_metric_values(
+                metric_name, values)
+            return
         for timestamp, value in values:
-            self.graphite_publisher.publish_metric(
-                metric_name, value, timestamp)
+            self.line_buffer.add(
+                "%s %f %d" % (metric_name, value, timestamp))
 
 
 class UDPMetricsProtocol(DatagramProtocol):
@@ -319,10 +481,31 @@ class UDPMetricsProtocol(DatagramProtocol):
 
 
 class UDPMetricsCollector(MetricsCollectorWorker):
-    """Worker that collects Vumi metrics and publishes them over UDP."""
+    """Worker that collects Vumi metrics and publishes them over UDP.
+
+    Metric lines are coalesced into datagrams of up to
+    `max_datagram_size` bytes.
+
+    Configuration Values
+    --------------------
+    metrics_host : str
+        Host to send metrics to.
+    metrics_port : int
+        Port to send metrics to.
+    format_string : str, optional
+        Format of each metric line.
+    timestamp_format : str, optional
+        `strftime` format of the timestamp in each metric line.
+    max_datagram_size : int, optional
+        Maximum number of bytes of metric lines per datagram. Set this to
+        the path MTU less the IP and UDP headers. Default is 1400.
+    flush_interval : float in seconds, optional
+        Maximum time metric lines are held for. Default is 0.1s.
+    """
 
     DEFAULT_FORMAT_STRING = '%(timestamp)s %(metric_name)s %(value)s\n'
     DEFAULT_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S%z'
+    DEFAULT_MAX_DATAGRAM_SIZE = 1400
 
     @inlineCallbacks
     def setup_worker(self):
@@ -335,19 +518,38 @@ class UDPMetricsCollector(MetricsCollectorWorker):
         self.metrics_protocol = UDPMetricsProtocol(
             self.metrics_ip, self.metrics_port)
         self.listener = yield reactor.listenUDP(0, self.metrics_protocol)
+        self.line_buffer = MetricLineBuffer(
+            self.send_datagram,
+            int(self.config.get('max_datagram_size',
+                                self.DEFAULT_MAX_DATAGRAM_SIZE)),
+            float(self.config.get('flush_interval', 0.1)), size_func=len)
+        # Aggregates arrive in runs sharing a timestamp, so we only format
+        # a timestamp when it changes.
+        self._last_timestamp = None
+        self._last_timestamp_string = None
 
     def teardown_worker(self):
+        self.line_buffer.flush()
         return self.listener.stopListening()
 
+    def send_datagram(self, lines):
+        self.metrics_protocol.send_metric(''.join(lines))
+
+    def format_timestamp(self, timestamp):
+        if timestamp != self._last_timestamp:
+            self._last_timestamp = timestamp
+            self._last_timestamp_string = datetime.utcfromtimestamp(
+                timestamp).strftime(self.timestamp_format)
+        return self._last_timestamp_string
+
     def consume_metrics(self, metric_name, values):
         for timestamp, value in values:
-            timestamp = datetime.utcfromtimestamp(timestamp)
             metric_string = self.format_string % {
-                'timestamp': timestamp.strftime(self.timestamp_format),
+                'timestamp': self.format_timestamp(timestamp),
                 'metric_name': metric_name,
                 'value': value,
                 }
-            self.metrics_protocol.send_metric(metric_string)
+            self.line_buffer.add(metric_string)
 
 
 class RandomMetricsGenerator(Worker):
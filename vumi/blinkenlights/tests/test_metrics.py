@@ -177,6 +177,155 @@ class TestAggregators(TestCase):
         self.assertRaises(metrics.AggregatorAlreadyDefinedError,
                           metrics.Aggregator, "sum", sum)
 
+    def test_summary_results(self):
+        summary = metrics.MetricSummary()
+        for agg in [metrics.SUM, metrics.AVG, metrics.MIN, metrics.MAX,
+                    metrics.LAST]:
+            self.assertEqual(agg.result(summary), 0.0)
+        for value in [2.0, 1.0, 3.0]:
+            summary.add(value)
+        self.assertEqual(metrics.SUM.result(summary), 6.0)
+        self.assertEqual(metrics.AVG.result(summary), 2.0)
+        self.assertEqual(metrics.MIN.result(summary), 1.0)
+        self.assertEqual(metrics.MAX.result(summary), 3.0)
+        self.assertEqual(metrics.LAST.result(summary), 3.0)
+
+    def test_count(self):
+        self.assertEqual(metrics.COUNT([]), 0.0)
+        self.assertEqual(metrics.COUNT([1.0, 2.0]), 2.0)
+        self.assertEqual(metrics.COUNT.name, "count")
+        summary = metrics.MetricSummary()
+        summary.add(5.0)
+        self.assertEqual(metrics.COUNT.result(summary), 1.0)
+
+    def test_quantiles(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(metrics.P50([]), 0.0)
+        self.assertEqual(metrics.P50(values), 50.0)
+        self.assertEqual(metrics.P95(values), 95.0)
+        self.assertEqual(metrics.P99(values), 99.0)
+        self.assertEqual(metrics.P99.name, "p99")
+
+        sketch = metrics.P50.new_state()
+        for value in values:
+            sketch.add(value)
+        for agg in [metrics.P50, metrics.P95, metrics.P99]:
+            self.assertAlmostEqual(agg.result(sketch), agg(values),
+                                   delta=agg(values) * 0.01)
+
+    def test_incremental(self):
+        class RangeAggregation(metrics.IncrementalAggregation):
+            state_key = 'summary'
+
+            def new_state(self):
+                return metrics.MetricSummary()
+
+            def result(self, state):
+                return state.max - state.min
+
+        agg = metrics.Aggregator(
+            "test.range", lambda values: max(values) - min(values),
+            incremental=RangeAggregation())
+        try:
+            self.assertTrue(agg.supports_incremental())
+            state = agg.new_state()
+            self.assertEqual(agg.result(state), 0.0)
+            state.add(3.0)
+            state.add(1.0)
+            self.assertEqual(agg.result(state), 2.0)
+        finally:
+            del metrics.Aggregator.REGISTRY[agg.name]
+
+    def test_not_incremental(self):
+        agg = metrics.Aggregator("test.not_incremental", len)
+        try:
+            self.assertFalse(agg.supports_incremental())
+        finally:
+            del metrics.Aggregator.REGISTRY[agg.name]
+
+
+class TestQuantileSketch(TestCase):
+    def mk_sketch(self, values):
+        sketch = metrics.QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def assert_close(self, expected, actual):
+        self.assertTrue(abs(expected - actual) <= abs(expected) * 0.01,
+                        "%r is not close to %r" % (actual, expected))
+
+    def test_empty(self):
+        sketch = metrics.QuantileSketch()
+        self.assertEqual(sketch.count, 0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+
+    def test_quantiles(self):
+        sketch = self.mk_sketch([float(v) for v in range(1, 1001)])
+        self.assertEqual(sketch.count, 1000)
+        self.assert_close(1.0, sketch.quantile(0.0))
+        self.assert_close(500.0, sketch.quantile(0.5))
+        self.assert_close(990.0, sketch.quantile(0.99))
+        self.assert_close(1000.0, sketch.quantile(1.0))
+
+    def test_zero_and_negative_values(self):
+        sketch = self.mk_sketch([-10.0, -1.0, 0.0, 0.0, 1.0])
+        self.assert_close(-10.0, sketch.quantile(0.0))
+        self.assert_close(-1.0, sketch.quantile(0.25))
+        self.assertEqual(0.0, sketch.quantile(0.5))
+        self.assert_close(1.0, sketch.quantile(1.0))
+
+    def test_bounded_size(self):
+        sketch = self.mk_sketch([1.0 + (v % 100) for v in range(100000)])
+        self.assertTrue(len(sketch.positive) < 500)
+
+    def test_merge(self):
+        sketch = self.mk_sketch([float(v) for v in range(1, 501)])
+        sketch.merge(self.mk_sketch([float(v) for v in range(501, 1001)]))
+        self.assertEqual(sketch.count, 1000)
+        self.assert_close(500.0, sketch.quantile(0.5))
+
+    def test_merge_different_accuracy(self):
+        sketch = metrics.QuantileSketch()
+        self.assertRaises(ValueError, sketch.merge,
+                          metrics.QuantileSketch(0.05))
+
+    def test_dict_round_trip(self):
+        sketch = self.mk_sketch([-1.0, 0.0, 2.0, 3.0])
+        sketch_dict = sketch.to_dict()
+        self.assertTrue(metrics.is_serialized_state(sketch_dict))
+        state_key, decoded = metrics.state_from_dict(sketch_dict)
+        self.assertEqual(state_key, 'sketch')
+        self.assertEqual(decoded.to_dict(), sketch_dict)
+        self.assertEqual(decoded.count, 4)
+
+
+class TestMetricSummary(TestCase):
+    def mk_summary(self, values, timestamp=None):
+        summary = metrics.MetricSummary()
+        for value in values:
+            summary.add(value, timestamp)
+        return summary
+
+    def test_add(self):
+        summary = self.mk_summary([2.0, 1.0, 3.0])
+        self.assertEqual(summary.to_dict(), {
+            'sum': 6.0, 'count': 3, 'min': 1.0, 'max': 3.0, 'last': 3.0})
+
+    def test_merge(self):
+        summary = self.mk_summary([2.0, 1.0], 1235)
+        summary.merge(self.mk_summary([5.0, 0.5]), 1234)
+        summary.merge(metrics.MetricSummary(), 1236)
+        self.assertEqual(summary.to_dict(), {
+            'sum': 8.5, 'count': 4, 'min': 0.5, 'max': 5.0, 'last': 1.0})
+
+    def test_dict_round_trip(self):
+        summary = self.mk_summary([2.0, 1.0])
+        summary_dict = summary.to_dict()
+        self.assertEqual(
+            metrics.MetricSummary.from_dict(summary_dict).to_dict(),
+            summary_dict)
+
 
 class CheckValuesMixin(object):
 
@@ -278,6 +427,108 @@ class TestTimer(TestCase, CheckValuesMixin):
             self.check_poll(timer, [])
 
 
+class TestPreAggregatedMetric(TestCase):
+    def test_set_and_poll(self):
+        metric = metrics.PreAggregatedMetric(
+            "foo", [metrics.AVG, metrics.MAX])
+        metric.manage("prefix.")
+        self.assertEqual(metric.poll(), [])
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.2
+            metric.set(1.0)
+            metric.set(3.0)
+            mockt.return_value = 12346.1
+            metric.set(2.0)
+            self.assertEqual(metric.poll(), [
+                (12345, {'sum': 4.0, 'count': 2, 'min': 1.0, 'max': 3.0,
+                         'last': 3.0}),
+                (12346, {'sum': 2.0, 'count': 1, 'min': 2.0, 'max': 2.0,
+                         'last': 2.0}),
+            ])
+            self.assertEqual(metric.poll(), [])
+            metric.set(5.0)
+            self.assertEqual(metric.poll(), [
+                (12346, {'sum': 5.0, 'count': 1, 'min': 5.0, 'max': 5.0,
+                         'last': 5.0}),
+            ])
+
+    def test_unsupported_aggregator(self):
+        agg = metrics.Aggregator("test.preaggregated.unsupported", len)
+        try:
+            self.assertRaises(metrics.MetricRegistrationError,
+                              metrics.PreAggregatedMetric, "foo", [agg])
+        finally:
+            del metrics.Aggregator.REGISTRY[agg.name]
+
+    def test_count(self):
+        metric = metrics.PreAggregatedCount("foo")
+        metric.manage("prefix.")
+        self.assertEqual(metric.aggs, ("sum",))
+        for _ in range(1000):
+            metric.inc()
+        [(_ts, summary)] = metric.poll()
+        self.assertEqual(summary['sum'], 1000.0)
+
+    def test_timer(self):
+        timer = metrics.PreAggregatedTimer("foo")
+        timer.manage("prefix.")
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.0
+            with timer:
+                mockt.return_value += 0.1  # feign sleep
+            with timer:
+                mockt.return_value += 0.3  # feign sleep
+            [(_ts, summary)] = timer.poll()
+        self.assertEqual(summary['count'], 2)
+        self.assertTrue(0.39 < summary['sum'] < 0.41)
+        self.assertTrue(0.29 < summary['max'] < 0.31)
+
+
+class TestHistogram(TestCase):
+    def test_set_and_poll(self):
+        histogram = metrics.Histogram("foo")
+        histogram.manage("prefix.")
+        self.assertEqual(histogram.aggs,
+                         ("avg", "max", "p50", "p95", "p99"))
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.0
+            for value in range(1, 101):
+                histogram.set(float(value))
+            [(ts1, summary), (ts2, sketch)] = histogram.poll()
+        self.assertEqual((ts1, ts2), (12345, 12345))
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['max'], 100.0)
+        _, sketch = metrics.state_from_dict(sketch)
+        self.assertEqual(sketch.count, 100)
+        self.assertAlmostEqual(sketch.quantile(0.95), 95.0, delta=1.0)
+        self.assertEqual(histogram.poll(), [])
+
+    def test_bounded_state(self):
+        histogram = metrics.Histogram("foo")
+        histogram.manage("prefix.")
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.0
+            for value in range(10000):
+                histogram.set(1.0 + value % 10)
+            [_summary, (_ts, sketch)] = histogram.poll()
+        self.assertTrue(len(sketch['positive']) <= 10)
+
+    def test_timer(self):
+        timer = metrics.HistogramTimer("foo")
+        timer.manage("prefix.")
+        self.assertEqual(timer.aggs, ("avg", "max", "p50", "p95", "p99"))
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.0
+            for duration in [0.1, 0.2, 0.3]:
+                with timer:
+                    mockt.return_value += duration
+            datapoints = timer.poll()
+        [_, sketch] = [metrics.state_from_dict(value)
+                       for _, value in datapoints]
+        self.assertEqual(sketch.count, 3)
+        self.assertAlmostEqual(sketch.quantile(1.0), 0.3, delta=0.003)
+
+
 class TestMetricsConsumer(TestCase):
     def test_consume_message(self):
         expected_datapoints = [
@@ -1,11 +1,14 @@
+import time
+
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks, Deferred, DeferredQueue
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
+from twisted.internet.task import Clock
 
-from vumi.tests.utils import get_stubbed_worker, get_stubbed_channel
+from vumi.tests.utils import get_stubbed_worker, get_stubbed_channel, mocking
 from vumi.tests.fake_amqp import FakeAMQPBroker
-from vumi.blinkenlights import metrics_workers
+from vumi.blinkenlights import metrics, metrics_workers
 from vumi.blinkenlights.message20110818 import MetricMessage
 
 
@@ -159,6 +162,74 @@ class TestMetricAggregator(TestCase):
         worker.check_buckets()
         self.assertEqual(recv(), expected)
 
+    @inlineCallbacks
+    def test_aggregating_summaries(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = self.get_worker(metrics_workers.MetricAggregator,
+                                 config=config)
+        worker._time = self.fake_time
+        broker = BrokerWrapper(worker._amqp_client.broker)
+        yield worker.startWorker()
+
+        def summary(total, count, min_value, max_value, last):
+            return {'sum': total, 'count': count, 'min': min_value,
+                    'max': max_value, 'last': last}
+
+        aggs = ("avg", "last", "max", "min", "sum")
+        broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1236, summary(4.0, 2, 1.0, 3.0, 1.0)),
+                                     (1235, summary(2.0, 1, 2.0, 2.0, 2.0))]),
+            ])
+        broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1237, 0.5)]),
+            ("vumi.test.foo", aggs, [(1235, summary(5.0, 1, 5.0, 5.0, 5.0))]),
+            ])
+        yield broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        msgs = broker.recv_datapoints("vumi.metrics.aggregates",
+                                      "vumi.metrics.aggregates")
+        self.assertEqual(sorted(msgs), [
+            [["vumi.test.foo.avg", [], [[1235, 2.3]]]],
+            [["vumi.test.foo.last", [], [[1235, 0.5]]]],
+            [["vumi.test.foo.max", [], [[1235, 5.0]]]],
+            [["vumi.test.foo.min", [], [[1235, 0.5]]]],
+            [["vumi.test.foo.sum", [], [[1235, 11.5]]]],
+            ])
+
+    @inlineCallbacks
+    def test_aggregating_incremental(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = self.get_worker(metrics_workers.MetricAggregator,
+                                 config=config)
+        worker._time = self.fake_time
+        broker = BrokerWrapper(worker._amqp_client.broker)
+        yield worker.startWorker()
+
+        aggs = ("count", "max", "p50")
+        for i in range(100):
+            broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+                ("vumi.test.foo", aggs, [(1235, float(i)), (1236, 1.0)]),
+                ])
+        yield broker.kick_delivery()
+
+        [aggregation] = worker.buckets[247].values()
+        self.assertEqual([], aggregation.values)
+        self.assertEqual(['sketch', 'summary'], sorted(aggregation.states))
+
+        self.now = 1246
+        worker.check_buckets()
+        msgs = broker.recv_datapoints("vumi.metrics.aggregates",
+                                      "vumi.metrics.aggregates")
+        [count, max_value, p50] = sorted(msgs)
+        self.assertEqual(count, [["vumi.test.foo.count", [], [[1235, 200.0]]]])
+        self.assertEqual(max_value,
+                         [["vumi.test.foo.max", [], [[1235, 99.0]]]])
+        [[p50_name, _, [[p50_ts, p50_value]]]] = p50
+        self.assertEqual((p50_name, p50_ts), ("vumi.test.foo.p50", 1235))
+        self.assertAlmostEqual(p50_value, 1.0, delta=0.01)
+
     @inlineCallbacks
     def test_aggregating_lag(self):
         config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
@@ -271,6 +342,39 @@ class TestAggregationSystem(TestCase):
             ["vumi.test.foo.sum", [], [[12345, 6.0]]]
             ])
 
+    @inlineCallbacks
+    def test_aggregating_histograms(self):
+        yield self._setup_workers(1, 1, 5)
+
+        # One histogram per worker recording the same metric.
+        histograms = [metrics.Histogram("latency") for _ in range(2)]
+        with mocking(time.time) as mockt:
+            mockt.return_value = 12345.0
+            for i in range(1, 101):
+                histograms[i % 2].set(float(i))
+        for histogram in histograms:
+            histogram.manage("vumi.test.")
+            self.send([(histogram.name, histogram.aggs, histogram.poll())])
+
+        yield self.broker.kick_delivery()  # deliver to bucketters
+        yield self.broker.kick_delivery()  # deliver to aggregators
+        self.now = 12355
+        for worker in self.aggregator_workers:
+            worker.check_buckets()
+
+        aggregates = dict((name, value) for [[name, _, [[ts, value]]]]
+                          in self.recv())
+        self.assertEqual(sorted(aggregates), [
+            "vumi.test.latency.avg", "vumi.test.latency.max",
+            "vumi.test.latency.p50", "vumi.test.latency.p95",
+            "vumi.test.latency.p99",
+            ])
+        self.assertEqual(aggregates["vumi.test.latency.avg"], 50.5)
+        self.assertEqual(aggregates["vumi.test.latency.max"], 100.0)
+        for name, expected in [("p50", 50.0), ("p95", 95.0), ("p99", 99.0)]:
+            self.assertAlmostEqual(aggregates["vumi.test.latency." + name],
+                                   expected, delta=expected * 0.01)
+
 
 class TestGraphitePublisher(TestCase):
 
@@ -308,6 +412,94 @@ class TestGraphiteMetricsCollector(TestCase):
         self.assertEqual(value, 1.5)
         self.assertEqual(ts, 1234)
 
+    @inlineCallbacks
+    def test_multiple_values(self):
+        worker = get_stubbed_worker(metrics_workers.GraphiteMetricsCollector)
+        broker = BrokerWrapper(worker._amqp_client.broker)
+        yield worker.startWorker()
+
+        datapoints = [("vumi.test.foo", "", [(1234, 1.5), (1235, 2.5)])]
+        broker.send_datapoints("vumi.metrics.aggregates",
+                               "vumi.metrics.aggregates", datapoints)
+        yield broker.kick_delivery()
+
+        content, = broker.get_dispatched("graphite", "vumi.test.foo")
+        self.assertEqual(content.body, "1.500000 1234\n2.500000 1235")
+
+    @inlineCallbacks
+    def test_metric_name_in_body(self):
+        worker = get_stubbed_worker(metrics_workers.GraphiteMetricsCollector,
+                                    {'metric_name_in_body': True,
+                                     'max_batch_size': 3})
+        broker = BrokerWrapper(worker._amqp_client.broker)
+        yield worker.startWorker()
+        clock = Clock()
+        worker.line_buffer.callLater = clock.callLater
+
+        for name in ["foo", "bar"]:
+            datapoints = [("vumi.test.%s" % name, "",
+                           [(1234, 1.5), (1235, 2.5)])]
+            broker.send_datapoints("vumi.metrics.aggregates",
+                                   "vumi.metrics.aggregates", datapoints)
+        yield broker.kick_delivery()
+
+        routing_key = metrics_workers.GraphitePublisher.BATCH_ROUTING_KEY
+        [content] = broker.get_dispatched("graphite", routing_key)
+        self.assertEqual(content.body, "\n".join([
+            "vumi.test.foo 1.500000 1234",
+            "vumi.test.foo 2.500000 1235",
+            "vumi.test.bar 1.500000 1234",
+            ]))
+        clock.advance(1.0)
+        [_, content] = broker.get_dispatched("graphite", routing_key)
+        self.assertEqual(content.body, "vumi.test.bar 2.500000 1235")
+        yield worker.stopWorker()
+
+
+class TestMetricLineBuffer(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def mk_buffer(self, max_size, size_func=None):
+        line_buffer = metrics_workers.MetricLineBuffer(
+            self.batches.append, max_size, 1.0, size_func=size_func)
+        line_buffer.callLater = self.clock.callLater
+        return line_buffer
+
+    def test_flush_on_size(self):
+        line_buffer = self.mk_buffer(2)
+        line_buffer.add("a")
+        self.assertEqual(self.batches, [])
+        line_buffer.add("b")
+        line_buffer.add("c")
+        self.assertEqual(self.batches, [["a", "b"]])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_flush_on_interval(self):
+        line_buffer = self.mk_buffer(10)
+        line_buffer.add("a")
+        self.clock.advance(0.5)
+        line_buffer.add("b")
+        self.clock.advance(0.5)
+        self.assertEqual(self.batches, [["a", "b"]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush_by_bytes(self):
+        line_buffer = self.mk_buffer(10, size_func=len)
+        line_buffer.add("aaaa\n")
+        line_buffer.add("bbbb\n")
+        line_buffer.add("cc\n")
+        line_buffer.add("dddddddddddd\n")
+        line_buffer.flush()
+        self.assertEqual(self.batches, [
+            ["aaaa\n", "bbbb\n"], ["cc\n"], ["dddddddddddd\n"]])
+
+    def test_flush_empty(self):
+        line_buffer = self.mk_buffer(10)
+        line_buffer.flush()
+        self.assertEqual(self.batches, [])
+
 
 class UDPMetricsCatcher(DatagramProtocol):
     def __init__(self):
@@ -350,9 +542,18 @@ class TestUDPMetricsCollector(TestCase):
     def test_multiple_messages(self):
         yield self.send_metrics((1234, 1.5), (1235, 2.5))
         received = yield self.udp_protocol.queue.get()
-        self.assertEqual('1970-01-01 00:20:34 vumi.test.foo 1.5\n', received)
+        self.assertEqual('1970-01-01 00:20:34 vumi.test.foo 1.5\n'
+                         '1970-01-01 00:20:35 vumi.test.foo 2.5\n', received)
+
+    @inlineCallbacks
+    def test_max_datagram_size(self):
+        self.worker.line_buffer.max_size = 80
+        yield self.send_metrics(*[(1234 + i, 1.5) for i in range(3)])
+        received = yield self.udp_protocol.queue.get()
+        self.assertEqual('1970-01-01 00:20:34 vumi.test.foo 1.5\n'
+                         '1970-01-01 00:20:35 vumi.test.foo 1.5\n', received)
         received = yield self.udp_protocol.queue.get()
-        self.assertEqual('1970-01-01 00:20:35 vumi.test.foo 2.5\n', received)
+        self.assertEqual('1970-01-01 00:20:36 vumi.test.foo 1.5\n', received)
 
 
 class TestRandomMetricsGenerator(TestCase):
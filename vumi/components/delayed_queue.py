@@ -0,0 +1,240 @@
+# -*- test-case-name: vumi.components.tests.test_delayed_queue -*-
+
+"""A Redis backed queue of items to be delivered at some time in the
+future."""
+
+import json
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.message import JSONMessageEncoder, date_time_decoder
+from vumi.persist.redis_base import LuaScript
+
+
+def _claim_due_emulation(redis, keys, args):
+    due_key, items_key = keys
+    now, limit = args
+    claimed = []
+    due = redis.zrangebyscore(
+        due_key, '-inf', now, start=0, num=int(limit), withscores=True)
+    for item_id, score in due:
+        redis.zrem(due_key, item_id)
+        claimed.extend([item_id, score, redis.hget(items_key, item_id)])
+        redis.hdel(items_key, item_id)
+    return claimed
+
+
+# Items are removed from both the due set and the payload hash when they're
+# claimed, so that concurrent deliverers never see the same item twice. The
+# result is a flat list of `item_id, due, payload` triples.
+CLAIM_DUE_SCRIPT = LuaScript("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'WITHSCORES', 'LIMIT', 0, ARGV[2])
+if #due == 0 then
+    return {}
+end
+local item_ids = {}
+for i = 1, #due, 2 do
+    item_ids[#item_ids + 1] = due[i]
+end
+redis.call('ZREM', KEYS[1], unpack(item_ids))
+local payloads = redis.call('HMGET', KEYS[2], unpack(item_ids))
+redis.call('HDEL', KEYS[2], unpack(item_ids))
+local claimed = {}
+for i, item_id in ipairs(item_ids) do
+    claimed[#claimed + 1] = item_id
+    claimed[#claimed + 1] = due[2 * i]
+    claimed[#claimed + 1] = payloads[i] or false
+end
+return claimed
+""", emulation=_claim_due_emulation)
+
+
+class DelayedQueue(object):
+    """A queue of JSON-encodable payloads, each of which is delivered to
+    `callback` once it is due.
+
+    Items are kept in a single sorted set scored by the time they are due,
+    with their payloads in a hash keyed by item id. Due items are claimed
+    atomically in batches of up to `batch_size`, along with their payloads,
+    so delivering a batch costs one round trip to Redis no matter how many
+    items are in it.
+
+    If `callback` fails for an item, the error is logged and the item is put
+    back in the queue with its original due time to be retried on the next
+    delivery run.
+
+    :param redis:
+        Redis manager object.
+    :param callback:
+        Called with the payload of each item that is due. May return a
+        deferred.
+    :param int batch_size:
+        Maximum number of items to claim from Redis at once.
+    :param str due_key:
+        Key of the sorted set of item ids scored by due time.
+    :param str items_key:
+        Key of the hash of payloads by item id.
+    :param clock:
+        Provider of `seconds` and `callLater`. Defaults to the reactor.
+    """
+
+    def __init__(self, redis, callback, batch_size=100, due_key='due',
+                 items_key='items', json_encoder=None, json_decoder=None,
+                 clock=reactor):
+        self.redis = redis
+        self.callback = callback
+        self.batch_size = batch_size
+        self.due_key = due_key
+        self.items_key = items_key
+        self.json_encoder = json_encoder or JSONMessageEncoder
+        self.json_decoder = json_decoder or date_time_decoder
+        self.clock = clock
+        self.loop = LoopingCall(self.deliver_due)
+        self.loop.clock = clock
+        self._loop_done = None
+
+    @property
+    def is_running(self):
+        return self.loop.running
+
+    def start(self, interval, now=True):
+        """Check for due items every `interval` seconds."""
+        if not self.loop.running:
+            self._loop_done = self.loop.start(interval, now=now)
+
+    def stop(self):
+        """Stop checking for due items.
+
+        Returns a deferred that fires once any delivery run in progress has
+        finished.
+        """
+        if self.loop.running:
+            self.loop.stop()
+            return self._loop_done
+        return None
+
+    def schedule(self, delay, payload, item_id=None, now=None):
+        """Add an item that is due `delay` seconds from `now`.
+
+        :param float delay:
+            Seconds from `now` until the item is due.
+        :param payload:
+            A JSON-encodable payload to pass to `callback`.
+        :param str item_id:
+            Unique id for the item. If an item with this id is already
+            queued, it is replaced. A new id is generated if this is `None`.
+        :param float now:
+            Seconds since the epoch. Defaults to the current time.
+
+        Returns a deferred that fires with the item id.
+        """
+        if now is None:
+            now = self.clock.seconds()
+        return self.schedule_at(now + delay, payload, item_id=item_id)
+
+    def schedule_at(self, due, payload, item_id=None):
+        """Add an item that is due at `due` seconds since the epoch.
+
+        See :meth:`schedule`.
+        """
+        pipe = self.redis.pipeline()
+        item_id = self.schedule_in_pipeline(pipe, due, payload, item_id)
+        d = pipe.execute()
+        d.addCallback(lambda _: item_id)
+        return d
+
+    def schedule_in_pipeline(self, pipe, due, payload, item_id=None):
+        """Queue the calls to add an item on `pipe`, which must be a pipeline
+        created from this queue's redis manager, so that they can be sent
+        along with other calls.
+
+        Returns the item id.
+        """
+        # Encode first so that we blow up before touching Redis if the
+        # payload isn't JSON-encodable.
+        payload_json = json.dumps(payload, cls=self.json_encoder)
+        if item_id is None:
+            item_id = uuid4().get_hex()
+        self._add_item(pipe, item_id, due, payload_json)
+        return item_id
+
+    def _add_item(self, pipe, item_id, due, payload_json):
+        pipe.hset(self.items_key, item_id, payload_json)
+        pipe.zadd(self.due_key, **{item_id: due})
+
+    def cancel(self, item_id):
+        """Remove an item from the queue."""
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.due_key, item_id)
+        pipe.hdel(self.items_key, item_id)
+        return pipe.execute()
+
+    def count(self):
+        """Return (a deferred that fires with) the number of queued items.
+        """
+        return self.redis.zcard(self.due_key)
+
+    def get_due_time(self, item_id):
+        """Return (a deferred that fires with) the time an item is due, or
+        `None` if it isn't queued.
+        """
+        return self.redis.zscore(self.due_key, item_id)
+
+    @inlineCallbacks
+    def claim_due(self, now=None, limit=None):
+        """Claim up to `limit` items that are due at `now`.
+
+        Claimed items are removed from the queue. Returns a list of
+        `(item_id, due, payload_json)` tuples, earliest first.
+        """
+        if now is None:
+            now = self.clock.seconds()
+        if limit is None:
+            limit = self.batch_size
+        claimed = yield self.redis.run_script(
+            CLAIM_DUE_SCRIPT, keys=[self.due_key, self.items_key],
+            args=[repr(float(now)), limit])
+        returnValue([(claimed[i], float(claimed[i + 1]), claimed[i + 2])
+                     for i in range(0, len(claimed), 3)])
+
+    @inlineCallbacks
+    def deliver_due(self, now=None):
+        """Deliver all items that are due at `now`, in the order they are
+        due.
+
+        Returns (a deferred that fires with) the number of items delivered.
+        """
+        delivered = 0
+        while True:
+            batch = yield self.claim_due(now)
+            failed = []
+            for item_id, due, payload_json in batch:
+                if payload_json is None:
+                    # Cancelled while we were claiming it.
+                    continue
+                try:
+                    payload = json.loads(
+                        payload_json, object_hook=self.json_decoder)
+                    yield self.callback(payload)
+                except Exception:
+                    log.err(None, "Error delivering delayed item %r" % (
+                        item_id,))
+                    failed.append((item_id, due, payload_json))
+                else:
+                    delivered += 1
+            if failed:
+                # Put failed items back and leave them for the next run,
+                # otherwise we'd just claim them again immediately.
+                pipe = self.redis.pipeline()
+                for item_id, due, payload_json in failed:
+                    self._add_item(pipe, item_id, due, payload_json)
+                yield pipe.execute()
+                break
+            if len(batch) < self.batch_size:
+                break
+        returnValue(delivered)
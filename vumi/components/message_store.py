@@ -12,8 +12,8 @@ from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (VumiMessage, ForeignKey, ListOf, Tag, Dynamic,
                                  Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
-from vumi import log
 from vumi.components.message_store_cache import MessageStoreCache
+from vumi.components.message_store_reconciler import CacheReconciler
 
 
 class Batch(Model):
@@ -123,35 +123,32 @@ class MessageStore(object):
 
         returnValue(False)
 
-    @Manager.calls_manager
-    def reconcile_cache(self, batch_id):
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_inbound_cache(batch_id)
-        yield self.reconcile_outbound_cache(batch_id)
+    def reconciler(self, concurrency=None, progress_callback=None):
+        """
+        Return a :class:`CacheReconciler` for rebuilding this store's cache.
+        """
+        return CacheReconciler(self, concurrency=concurrency,
+                               progress_callback=progress_callback)
 
-    @Manager.calls_manager
-    def reconcile_inbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+    def reconcile_cache(self, batch_id, resume=False, progress_callback=None):
+        """
+        Rebuild the cached values for a batch from what's stored in Riak.
+
+        :param bool resume:
+            Continue an interrupted reconciliation from its last checkpoint
+            instead of clearing the cache and starting from scratch.
+        :param progress_callback:
+            Called as `progress_callback(batch_id, direction, done, total)`
+            as messages are processed.
+        """
+        reconciler = self.reconciler(progress_callback=progress_callback)
+        return reconciler.reconcile(batch_id, resume=resume)
 
-    @Manager.calls_manager
-    def reconcile_outbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+    def reconcile_inbound_cache(self, batch_id, resume=False):
+        return self.reconciler().reconcile_inbound(batch_id, resume=resume)
+
+    def reconcile_outbound_cache(self, batch_id, resume=False):
+        return self.reconciler().reconcile_outbound(batch_id, resume=resume)
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
@@ -183,7 +180,8 @@ class MessageStore(object):
     def batch_done(self, batch_id):
         batch = yield self.batches.load(batch_id)
         tag_keys = yield batch.backlinks.currenttags()
-        for tags_bunch in self.manager.load_all_bunches(CurrentTag, tag_keys):
+        for tags_bunch in self.manager.load_all_bunches_concurrently(
+                CurrentTag, tag_keys, ordered=False):
             for tag in (yield tags_bunch):
                 tag.current_batch.set(None)
                 yield tag.save()
@@ -243,6 +241,27 @@ class MessageStore(object):
 
         yield msg_record.save()
 
+    @Manager.calls_manager
+    def get_events_for_messages(self, msg_ids):
+        """
+        Return the events for a list of outbound message ids.
+
+        The event keys are found with an exact secondary index lookup per
+        message, with all the lookups in flight at once, and the events are
+        then loaded in bunches by key.
+        """
+        # Start every lookup before waiting on any of them.
+        lookups = [self.events.index_keys_page('message', msg_id)
+                   for msg_id in msg_ids]
+        event_keys = []
+        for lookup in lookups:
+            event_keys.extend((yield lookup))
+        events = []
+        for bunch in self.events.load_all_bunches_concurrently(
+                event_keys, ordered=False):
+            events.extend(event.event for event in (yield bunch))
+        returnValue(events)
+
     @Manager.calls_manager
     def get_inbound_message(self, msg_id):
         msg = yield self.inbound_messages.load(msg_id)
@@ -262,32 +281,51 @@ class MessageStore(object):
         return self.cache.get_event_status(batch_id)
 
     def batch_outbound_keys(self, batch_id):
-        mr = self.manager.mr_from_field(OutboundMessage, 'batch', batch_id)
-        return mr.get_keys()
+        return self.outbound_messages.index_keys('batch', batch_id)
+
+    def batch_outbound_keys_page(self, batch_id, max_results=None,
+                                 continuation=None):
+        """Fetch a page of outbound message keys for a batch.
+
+        :returns:
+            (A deferred that fires with) a
+            :class:`vumi.persist.model.VumiIndexPage`.
+        """
+        return self.outbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results,
+            continuation=continuation)
 
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
 
     def batch_inbound_keys(self, batch_id):
-        mr = self.manager.mr_from_field(InboundMessage, 'batch', batch_id)
-        return mr.get_keys()
+        return self.inbound_messages.index_keys('batch', batch_id)
+
+    def batch_inbound_keys_page(self, batch_id, max_results=None,
+                                continuation=None):
+        """Fetch a page of inbound message keys for a batch.
+
+        :returns:
+            (A deferred that fires with) a
+            :class:`vumi.persist.model.VumiIndexPage`.
+        """
+        return self.inbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results,
+            continuation=continuation)
 
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
 
     def message_event_keys(self, msg_id):
-        mr = self.manager.mr_from_field(Event, 'message', msg_id)
-        return mr.get_keys()
+        return self.events.index_keys('message', msg_id)
 
     def batch_inbound_count(self, batch_id):
-        return self.inbound_messages.index_lookup(
-            'batch', batch_id).get_count()
+        return self.inbound_messages.index_count('batch', batch_id)
 
     def batch_outbound_count(self, batch_id):
-        return self.outbound_messages.index_lookup(
-            'batch', batch_id).get_count()
+        return self.outbound_messages.index_count('batch', batch_id)
 
     @inlineCallbacks
     def find_inbound_keys_matching(self, batch_id, query, ttl=None,
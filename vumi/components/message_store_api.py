@@ -6,6 +6,7 @@ from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.internet.defer import inlineCallbacks
 
+from vumi import log
 from vumi.service import Worker
 from vumi.message import JSONMessageEncoder
 from vumi.transports.httprpc import httprpc
@@ -21,6 +22,9 @@ class MatchResource(resource.Resource):
     """
 
     DEFAULT_RESULT_SIZE = 20
+    # Number of bunches of messages to load from Riak at once. `None` uses
+    # the Riak manager's `load_bunch_concurrency`.
+    LOAD_BUNCH_CONCURRENCY = None
 
     REQ_TTL_HEADER = 'X-VMS-Match-TTL'
     REQ_WAIT_HEADER = 'X-VMS-Match-Wait'
@@ -28,6 +32,7 @@ class MatchResource(resource.Resource):
     RESP_COUNT_HEADER = 'X-VMS-Result-Count'
     RESP_TOKEN_HEADER = 'X-VMS-Result-Token'
     RESP_IN_PROGRESS_HEADER = 'X-VMS-Match-In-Progress'
+    RESP_NEXT_CURSOR_HEADER = 'X-VMS-Result-Next-Cursor'
 
     def __init__(self, direction, message_store, batch_id):
         """
@@ -52,8 +57,10 @@ class MatchResource(resource.Resource):
         self._in_progress_cb = functools.partial(
             message_store.is_query_in_progress, batch_id)
         self._load_bunches_cb = {
-            'inbound': message_store.inbound_messages.load_all_bunches,
-            'outbound': message_store.outbound_messages.load_all_bunches,
+            'inbound': (
+                message_store.inbound_messages.load_all_bunches_concurrently),
+            'outbound': (
+                message_store.outbound_messages.load_all_bunches_concurrently),
         }.get(direction)
 
     def _add_resp_header(self, request, key, value):
@@ -103,27 +110,82 @@ class MatchResource(resource.Resource):
         self._add_resp_header(request, self.RESP_IN_PROGRESS_HEADER,
             str(int(in_progress)))
         self._add_resp_header(request, self.RESP_COUNT_HEADER, str(count))
+        if 0 <= stop < count - 1:
+            self._add_resp_header(request, self.RESP_NEXT_CURSOR_HEADER,
+                str(stop + 1))
         if keys_only:
             request.write(json.dumps(keys))
+            request.finish()
         else:
-            messages = []
-            for bunch in self._load_bunches_cb(keys):
+            yield self._stream_messages(request, keys)
+
+    @inlineCallbacks
+    def _stream_messages(self, request, keys):
+        """
+        Write the messages for `keys` to `request` as a JSON list, in the
+        order of `keys`.
+
+        Several bunches of messages are loaded at once and each bunch is
+        written as soon as it and the bunches before it have arrived, so
+        only a few bunches are held in memory at a time.
+        """
+        positions = dict((key, i) for i, key in enumerate(keys))
+        bunches = self._load_bunches_cb(
+            keys, concurrency=self.LOAD_BUNCH_CONCURRENCY)
+        disconnected = []
+        request.notifyFinish().addErrback(
+            lambda f: disconnected.append(f))
+
+        separator = ''
+        request.write('[')
+        try:
+            for bunch_d in bunches:
+                if disconnected:
+                    break
+                bunch = yield bunch_d
                 # inbound & outbound messages have a `.msg` attribute which
-                # is the actual message stored, they share the same message_id
-                # as the key.
-                messages.extend([msg.msg.payload for msg in (yield bunch)
-                                    if msg.msg])
-
-            # sort the results in the order that the keys specified
-            messages.sort(key=lambda msg: keys.index(msg['message_id']))
-            request.write(json.dumps(messages, cls=JSONMessageEncoder))
-        request.finish()
+                # is the actual message stored, they share the same
+                # message_id as the key. Bunches are loaded in key order,
+                # but the messages in a bunch may arrive in any order.
+                payloads = sorted(
+                    [msg.msg.payload for msg in bunch if msg.msg],
+                    key=lambda payload: positions[payload['message_id']])
+                for payload in payloads:
+                    request.write(separator)
+                    request.write(json.dumps(payload, cls=JSONMessageEncoder))
+                    separator = ','
+        except Exception:
+            log.err(None, "Error loading messages for match results.")
+            # The status line has already been sent, so the best we can do
+            # is drop the connection without completing the response.
+            request.transport.loseConnection()
+            return
+        finally:
+            bunches.close()
+        if not disconnected:
+            request.write(']')
+            request.finish()
 
     def render_GET(self, request):
+        """
+        Return a page of the results for a match operation.
+
+        The page starts at result `start` (or `cursor`) and ends at result
+        `stop` inclusive, or holds `limit` results if `stop` isn't given.
+        If there are more results after this page, the
+        `RESP_NEXT_CURSOR_HEADER` header is set to the `cursor` to ask for
+        to get the next page.
+        """
         token = request.args['token'][0]
-        start = int(request.args['start'][0] if 'start' in request.args else 0)
+        if 'cursor' in request.args:
+            start = int(request.args['cursor'][0])
+        else:
+            start = int(request.args['start'][0]
+                        if 'start' in request.args else 0)
+        limit = int(request.args['limit'][0] if 'limit' in request.args
+                    else self.DEFAULT_RESULT_SIZE)
         stop = int(request.args['stop'][0] if 'stop' in request.args
-                    else (start + self.DEFAULT_RESULT_SIZE - 1))
+                    else (start + limit - 1))
         asc = bool(int(request.args['asc'][0]) if 'asc' in request.args
                     else False)
         keys_only = bool(int(request.args['keys'][0]) if 'keys' in request.args
@@ -6,11 +6,42 @@ import json
 
 from twisted.internet.defer import returnValue
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, LuaScript
 from vumi.message import TransportEvent
 from vumi.errors import VumiError
 
 
+def _store_query_results_emulation(redis, keys, args):
+    score_set_key, result_key = keys
+    ttl, message_keys = args[0], args[1:]
+    added = 0
+    for key in message_keys:
+        score = redis.zscore(score_set_key, key)
+        if score is not None:
+            redis.zadd(result_key, **{key: score})
+            added += 1
+    redis.expire(result_key, int(ttl))
+    return added
+
+
+# Copies the scores of the given message keys from the inbound or outbound
+# set of a batch into a search result set, skipping keys that aren't in the
+# cache. The result set's TTL is set with each chunk so that partial
+# results don't outlive a search that is never finished.
+STORE_QUERY_RESULTS_SCRIPT = LuaScript("""
+local added = 0
+for i = 2, #ARGV do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score then
+        redis.call('ZADD', KEYS[2], score, ARGV[i])
+        added = added + 1
+    end
+end
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return added
+""", emulation=_store_query_results_emulation)
+
+
 class MessageStoreCacheException(VumiError):
     pass
 
@@ -29,9 +60,12 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    RECONCILE_KEY = 'reconcile'
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
+    # Number of search result keys to store per round trip
+    SEARCH_RESULT_CHUNK_SIZE = 1000
 
     def __init__(self, redis):
         # Store redis as `manager` as well since @Manager.calls_manager
@@ -68,6 +102,9 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def reconcile_key(self, batch_id):
+        return self.batch_key(self.RECONCILE_KEY, batch_id)
+
     @Manager.calls_manager
     def batch_start(self, batch_id):
         """
@@ -93,8 +130,10 @@ class MessageStoreCache(object):
                   ['delivery_report.%s' % status
                    for status in TransportEvent.DELIVERY_STATUSES] +
                   ['sent'])
+        pipe = self.redis.pipeline()
         for event in events:
-            yield self.redis.hsetnx(self.status_key(batch_id), event, 0)
+            pipe.hsetnx(self.status_key(batch_id), event, 0)
+        yield pipe.execute()
 
     def get_batch_ids(self):
         """
@@ -116,13 +155,16 @@ class MessageStoreCache(object):
                 cached values your UI values might be off while the
                 reconciliation is taking place.
         """
-        yield self.redis.delete(self.inbound_key(batch_id))
-        yield self.redis.delete(self.outbound_key(batch_id))
-        yield self.redis.delete(self.event_key(batch_id))
-        yield self.redis.delete(self.status_key(batch_id))
-        yield self.redis.delete(self.to_addr_key(batch_id))
-        yield self.redis.delete(self.from_addr_key(batch_id))
-        yield self.redis.srem(self.batch_key(), batch_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.inbound_key(batch_id))
+        pipe.delete(self.outbound_key(batch_id))
+        pipe.delete(self.event_key(batch_id))
+        pipe.delete(self.status_key(batch_id))
+        pipe.delete(self.to_addr_key(batch_id))
+        pipe.delete(self.from_addr_key(batch_id))
+        pipe.delete(self.reconcile_key(batch_id))
+        pipe.srem(self.batch_key(), batch_id)
+        yield pipe.execute()
 
     def get_timestamp(self, datetime):
         """
@@ -130,24 +172,57 @@ class MessageStoreCache(object):
         """
         return time.mktime(datetime.timetuple())
 
+    def _add_timestamped(self, redis, key, value, timestamp):
+        """
+        Add a value, weighted with the timestamp, to the sorted set at `key`
+        using `redis`, which may be a pipeline.
+        """
+        return redis.zadd(key, **{value.encode('utf-8'): timestamp})
+
     @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'], timestamp)
+        pipe = self.redis.pipeline()
+        self._add_timestamped(
+            pipe, self.outbound_key(batch_id), msg['message_id'], timestamp)
+        self._add_timestamped(
+            pipe, self.to_addr_key(batch_id), msg['to_addr'], timestamp)
+        new_entry, _ = yield pipe.execute()
+        if new_entry:
+            yield self.increment_event_status(batch_id, 'sent')
+
+    @Manager.calls_manager
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add a list of outbound messages to the cache for the given batch_id
+        using a single pipelined round trip (plus one more to update the
+        'sent' count if any messages are new).
+        """
+        if not msgs:
+            return
+        message_keys, to_addrs = {}, {}
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            message_keys[msg['message_id'].encode('utf-8')] = timestamp
+            to_addrs[msg['to_addr'].encode('utf-8')] = timestamp
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.outbound_key(batch_id), **message_keys)
+        pipe.zadd(self.to_addr_key(batch_id), **to_addrs)
+        new_entries, _ = yield pipe.execute()
+        if new_entries:
+            yield self.redis.hincrby(self.status_key(batch_id), 'sent',
+                                     new_entries)
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-            })
+        new_entry = yield self._add_timestamped(
+            self.redis, self.outbound_key(batch_id), message_key, timestamp)
         if new_entry:
             yield self.increment_event_status(batch_id, 'sent')
 
@@ -161,10 +236,41 @@ class MessageStoreCache(object):
         new_entry = yield self.add_event_key(batch_id, event_id)
         if new_entry:
             event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.status_key(batch_id), event_type, 1)
+            if event_type == 'delivery_report':
+                pipe.hincrby(self.status_key(batch_id), '%s.%s' % (
+                    event_type, event['delivery_status']), 1)
+            yield pipe.execute()
+
+    @Manager.calls_manager
+    def add_events(self, batch_id, events):
+        """
+        Add a list of events to the cache for the given batch_id. Events
+        that are already known are ignored and the status counters are
+        updated once per event type.
+        """
+        if not events:
+            return
+        pipe = self.redis.pipeline()
+        for event in events:
+            pipe.sadd(self.event_key(batch_id), event['event_id'])
+        new_entries = yield pipe.execute()
+
+        counts = {}
+        for event, new_entry in zip(events, new_entries):
+            if not new_entry:
+                continue
+            event_type = event['event_type']
+            counts[event_type] = counts.get(event_type, 0) + 1
             if event_type == 'delivery_report':
-                yield self.increment_event_status(batch_id,
-                    '%s.%s' % (event_type, event['delivery_status']))
+                status = '%s.%s' % (event_type, event['delivery_status'])
+                counts[status] = counts.get(status, 0) + 1
+
+        pipe = self.redis.pipeline()
+        for event_type, count in counts.iteritems():
+            pipe.hincrby(self.status_key(batch_id), event_type, count)
+        yield pipe.execute()
 
     def add_event_key(self, batch_id, event_key):
         """
@@ -195,26 +301,45 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
+        pipe = self.redis.pipeline()
+        self._add_timestamped(
+            pipe, self.inbound_key(batch_id), msg['message_id'], timestamp)
+        self._add_timestamped(
+            pipe, self.from_addr_key(batch_id), msg['from_addr'], timestamp)
+        yield pipe.execute()
+
+    @Manager.calls_manager
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add a list of inbound messages to the cache for the given batch_id
+        using a single pipelined round trip.
+        """
+        if not msgs:
+            return
+        message_keys, from_addrs = {}, {}
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            message_keys[msg['message_id'].encode('utf-8')] = timestamp
+            from_addrs[msg['from_addr'].encode('utf-8')] = timestamp
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.inbound_key(batch_id), **message_keys)
+        pipe.zadd(self.from_addr_key(batch_id), **from_addrs)
+        yield pipe.execute()
 
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id
         """
-        return self.redis.zadd(self.inbound_key(batch_id), **{
-            message_key.encode('utf-8'): timestamp,
-            })
+        return self._add_timestamped(
+            self.redis, self.inbound_key(batch_id), message_key, timestamp)
 
     def add_from_addr(self, batch_id, from_addr, timestamp):
         """
         Add a from_addr to this batch_id, weighted by timestamp. Generally
         this information is retrieved when `add_inbound_message()` is called.
         """
-        return self.redis.zadd(self.from_addr_key(batch_id), **{
-            from_addr.encode('utf-8'): timestamp,
-            })
+        return self._add_timestamped(
+            self.redis, self.from_addr_key(batch_id), from_addr, timestamp)
 
     def get_from_addrs(self, batch_id, asc=False):
         """
@@ -234,9 +359,8 @@ class MessageStoreCache(object):
         Add a to-addr to this batch_id, weighted by timestamp. Generally
         this information is retrieved when `add_outbound_message()` is called.
         """
-        return self.redis.zadd(self.to_addr_key(batch_id), **{
-            to_addr.encode('utf-8'): timestamp,
-            })
+        return self._add_timestamped(
+            self.redis, self.to_addr_key(batch_id), to_addr, timestamp)
 
     def get_to_addrs(self, batch_id, asc=False):
         """
@@ -358,24 +482,33 @@ class MessageStoreCache(object):
 
     @Manager.calls_manager
     def store_query_results(self, batch_id, token, keys, direction,
-                            ttl=None):
+                            ttl=None, chunk_size=None):
         """
         Store the inbound query results for a query that was started with
         `start_inbound_query`. Internally this grabs the timestamps from
         the cache (there is an assumption that it has already been reconciled)
         and orders the results accordingly.
 
+        Keys are stored in chunks of `chunk_size` with a single round trip
+        each, so `count_query_results` shows how many results have been
+        stored so far while `is_query_in_progress` is still true. Keys that
+        aren't in the cache are left out of the results.
+
         :param str token:
             The token to store the results under.
         :param list keys:
-            The list of keys to store.
+            The list (or other iterable) of keys to store.
         :param str direction:
             Which messages to search, either inbound or outbound.
         :param int ttl:
             How long to store the results for.
             Defaults to DEFAULT_SEARCH_RESULT_TTL.
+        :param int chunk_size:
+            How many keys to store per round trip.
+            Defaults to SEARCH_RESULT_CHUNK_SIZE.
         """
         ttl = ttl or self.DEFAULT_SEARCH_RESULT_TTL
+        chunk_size = chunk_size or self.SEARCH_RESULT_CHUNK_SIZE
         result_key = self.search_result_key(batch_id, token)
         if direction == 'inbound':
             score_set_key = self.inbound_key(batch_id)
@@ -386,17 +519,26 @@ class MessageStoreCache(object):
 
         # populate the results set weighted according to the timestamps
         # that are already known in the cache.
+        chunk = []
         for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-                })
+            chunk.append(key.encode('utf-8'))
+            if len(chunk) >= chunk_size:
+                yield self._store_query_results_chunk(
+                    score_set_key, result_key, chunk, ttl)
+                chunk = []
+        if chunk:
+            yield self._store_query_results_chunk(
+                score_set_key, result_key, chunk, ttl)
 
-        # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
         yield self.redis.srem(self.search_token_key(batch_id), token)
 
+    def _store_query_results_chunk(self, score_set_key, result_key, keys,
+                                   ttl):
+        return self.redis.run_script(
+            STORE_QUERY_RESULTS_SCRIPT, keys=[score_set_key, result_key],
+            args=[ttl] + keys)
+
     def is_query_in_progress(self, batch_id, token):
         """
         Check whether a search is still in progress for the given token.
@@ -414,7 +556,29 @@ class MessageStoreCache(object):
 
     def count_query_results(self, batch_id, token):
         """
-        Return the number of results for the query token.
+        Return the number of results for the query token. While the query
+        is in progress, this is the number of results stored so far.
         """
         result_key = self.search_result_key(batch_id, token)
         return self.redis.zcard(result_key)
+
+    def get_reconcile_checkpoint(self, batch_id, direction):
+        """
+        Return the last message key (in sorted key order) that a
+        reconciliation of the given direction has finished with, or `None`
+        if there is no checkpoint.
+        """
+        return self.redis.hget(self.reconcile_key(batch_id), direction)
+
+    def set_reconcile_checkpoint(self, batch_id, direction, key):
+        """
+        Record that all message keys for the given direction up to and
+        including `key` have been reconciled.
+        """
+        return self.redis.hset(self.reconcile_key(batch_id), direction, key)
+
+    def clear_reconcile_checkpoints(self, batch_id):
+        """
+        Remove all reconciliation checkpoints for the given batch_id.
+        """
+        return self.redis.delete(self.reconcile_key(batch_id))
@@ -0,0 +1,168 @@
+# -*- test-case-name: vumi.components.tests.test_message_store_reconciler -*-
+# -*- coding: utf-8 -*-
+
+"""Bulk reconciliation of the message store cache."""
+
+from bisect import bisect_right
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredList, FirstError)
+
+
+class CacheReconciler(object):
+    """
+    Rebuilds the Redis cache for a batch from the messages and events
+    stored in Riak.
+
+    Message keys are sorted and loaded in bunches (of the Riak manager's
+    `load_bunch_size`) with up to `concurrency` bunches in flight at once.
+    Each bunch is written to the cache in a single pipelined call and the
+    events for all the outbound messages in a bunch are fetched with a
+    single map-reduce.
+
+    Once every bunch up to a given point has been written, the last key
+    of that bunch is stored as a checkpoint so that an interrupted
+    reconciliation can be resumed without starting over. All cache writes
+    are idempotent, so reprocessing a bunch after a resume is harmless.
+
+    If a bunch fails to load or process, no further bunches are started and
+    the reconciliation fails with that error. The checkpoint is never moved
+    past a failed bunch, so resuming retries it.
+
+    :param MessageStore store:
+        The message store to reconcile the cache of.
+    :param int concurrency:
+        The maximum number of bunches to load at once.
+    :param progress_callback:
+        An optional callable that is called as
+        `progress_callback(batch_id, direction, done, total)` each time a
+        bunch of messages has been processed.
+    """
+
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, store, concurrency=None, progress_callback=None):
+        self.store = store
+        self.cache = store.cache
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.progress_callback = progress_callback
+
+    @inlineCallbacks
+    def reconcile(self, batch_id, resume=False):
+        """
+        Reconcile the inbound and outbound caches for the given batch_id.
+
+        :param bool resume:
+            If `True`, the cache is not cleared first and any messages
+            before the stored checkpoints are skipped.
+        """
+        if not resume:
+            yield self.cache.clear_batch(batch_id)
+        yield self.cache.batch_start(batch_id)
+        yield self.reconcile_inbound(batch_id, resume=resume)
+        yield self.reconcile_outbound(batch_id, resume=resume)
+        yield self.cache.clear_reconcile_checkpoints(batch_id)
+
+    def reconcile_inbound(self, batch_id, resume=False):
+        return self._reconcile(
+            batch_id, 'inbound', self.store.batch_inbound_keys,
+            self.store.inbound_messages, self._process_inbound_bunch, resume)
+
+    def reconcile_outbound(self, batch_id, resume=False):
+        return self._reconcile(
+            batch_id, 'outbound', self.store.batch_outbound_keys,
+            self.store.outbound_messages, self._process_outbound_bunch,
+            resume)
+
+    def _process_inbound_bunch(self, batch_id, msg_records):
+        return self.cache.add_inbound_messages(
+            batch_id, [record.msg for record in msg_records])
+
+    @inlineCallbacks
+    def _process_outbound_bunch(self, batch_id, msg_records):
+        yield self.cache.add_outbound_messages(
+            batch_id, [record.msg for record in msg_records])
+        events = yield self.store.get_events_for_messages(
+            [record.key for record in msg_records])
+        yield self.cache.add_events(batch_id, events)
+
+    @inlineCallbacks
+    def _reconcile(self, batch_id, direction, get_keys, proxy,
+                   process_bunch, resume):
+        keys = sorted((yield get_keys(batch_id)))
+        skipped = 0
+        if resume:
+            checkpoint = yield self.cache.get_reconcile_checkpoint(
+                batch_id, direction)
+            if checkpoint is not None:
+                skipped = bisect_right(keys, checkpoint)
+                keys = keys[skipped:]
+
+        progress = _BunchProgress(
+            keys, self.store.manager.load_bunch_size, skipped)
+
+        # `load_all_bunches()` only starts loading a bunch when we ask for
+        # it, so sharing the iterator between workers bounds the number of
+        # bunches in flight.
+        bunches = enumerate(proxy.load_all_bunches(keys))
+        workers = [self._reconcile_worker(
+            batch_id, direction, bunches, process_bunch, progress)
+            for _ in range(self.concurrency)]
+        try:
+            yield DeferredList(workers, fireOnOneErrback=True,
+                               consumeErrors=True)
+        except FirstError, e:
+            e.subFailure.raiseException()
+        returnValue(progress.done)
+
+    @inlineCallbacks
+    def _reconcile_worker(self, batch_id, direction, bunches, process_bunch,
+                          progress):
+        for index, bunch_d in bunches:
+            if progress.failed:
+                break
+            try:
+                msg_records = yield bunch_d
+                yield process_bunch(batch_id, msg_records)
+            except Exception:
+                progress.failed = True
+                raise
+            checkpoint = progress.bunch_done(index)
+            if checkpoint is not None:
+                yield self.cache.set_reconcile_checkpoint(
+                    batch_id, direction, checkpoint)
+            if self.progress_callback is not None:
+                self.progress_callback(
+                    batch_id, direction, progress.done, progress.total)
+
+
+class _BunchProgress(object):
+    """
+    Tracks which bunches have been processed and the key up to which every
+    bunch has been processed.
+    """
+
+    def __init__(self, keys, bunch_size, skipped=0):
+        self.done = skipped
+        self.total = skipped + len(keys)
+        starts = range(0, len(keys), bunch_size)
+        self._last_keys = [keys[min(i + bunch_size, len(keys)) - 1]
+                           for i in starts]
+        self._bunch_sizes = [min(bunch_size, len(keys) - i) for i in starts]
+        self._finished = set()
+        self._next_index = 0
+        self.failed = False
+
+    def bunch_done(self, index):
+        """
+        Mark a bunch as processed and return the new checkpoint key, or
+        `None` if the checkpoint hasn't moved.
+        """
+        checkpoint = None
+        self.done += self._bunch_sizes[index]
+        self._finished.add(index)
+        while self._next_index in self._finished:
+            self._finished.remove(self._next_index)
+            checkpoint = self._last_keys[self._next_index]
+            self._next_index += 1
+        return checkpoint
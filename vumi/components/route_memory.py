@@ -0,0 +1,147 @@
+# -*- test-case-name: vumi.components.tests.test_route_memory -*-
+
+"""Remembering where messages were routed so that replies and events for
+them can be routed back."""
+
+import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+
+from vumi.utils import LRUCache
+
+
+class RouteMemory(object):
+    """Remembers a route for each message id.
+
+    Routes are stored as JSON under `route:<message_id>` using a single
+    `SETEX`, so Redis expires them without any further calls. Recently
+    stored routes can also be kept in a local LRU cache, which saves the
+    round trip to Redis for events that arrive shortly after the message
+    was sent.
+
+    Locally cached routes expire after the same `ttl` as those in Redis.
+    Rather than scheduling a timer for each route, expired routes are
+    dropped when they are looked up and :meth:`sweep` is called
+    periodically to remove them in batches.
+
+    :param redis:
+        Redis manager object.
+    :param int ttl:
+        Seconds before a route is forgotten. `None` means never.
+    :param int local_cache_size:
+        Maximum number of routes to cache locally. `0` disables the local
+        cache.
+    :param float sweep_interval:
+        Seconds between sweeps of expired routes from the local cache.
+    :param clock:
+        Provider of `callLater` and `seconds`, used to expire locally cached
+        routes. Defaults to the reactor.
+    """
+
+    def __init__(self, redis, ttl=None, local_cache_size=0,
+                 sweep_interval=60, clock=reactor):
+        self.redis = redis
+        self.clock = clock
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.local_cache = None
+        if local_cache_size:
+            self.local_cache = LRUCache(local_cache_size)
+        self._sweep_call = None
+
+    @classmethod
+    def from_redis_config(cls, config, key_prefix=None, **kw):
+        """Create a `RouteMemory` instance using `TxRedisManager`.
+        """
+        from vumi.persist.txredis_manager import TxRedisManager
+        d = TxRedisManager.from_config(config)
+        if key_prefix is not None:
+            d.addCallback(lambda m: m.sub_manager(key_prefix))
+        return d.addCallback(lambda m: cls(m, **kw))
+
+    def stop(self, stop_redis=True):
+        if self._sweep_call is not None and self._sweep_call.active():
+            self._sweep_call.cancel()
+        self._sweep_call = None
+        if stop_redis:
+            return self.redis._close()
+        return succeed(None)
+
+    def route_key(self, message_id):
+        return "route:%s" % (message_id,)
+
+    def remember(self, message_id, route):
+        """Store the route for a message.
+
+        :param str message_id:
+            The id of the message.
+        :param route:
+            Any JSON serializable value.
+        """
+        if self.local_cache is not None:
+            self._cache_route(message_id, route)
+        key = self.route_key(message_id)
+        value = json.dumps(route)
+        if self.ttl:
+            return self.redis.setex(key, int(self.ttl), value)
+        return self.redis.set(key, value)
+
+    def lookup(self, message_id):
+        """Return (a deferred that fires with) the route stored for a
+        message, or `None` if there isn't one.
+        """
+        if self.local_cache is not None:
+            entry = self.local_cache.get(message_id)
+            if entry is not None:
+                route, expires_at = entry
+                if expires_at is None or expires_at > self.clock.seconds():
+                    return succeed(route)
+                self.local_cache.pop(message_id)
+        d = self.redis.get(self.route_key(message_id))
+        d.addCallback(lambda value: json.loads(value)
+                      if value is not None else None)
+        return d
+
+    def forget(self, message_id):
+        """Remove the route stored for a message."""
+        if self.local_cache is not None:
+            self.local_cache.pop(message_id)
+        return self.redis.delete(self.route_key(message_id))
+
+    def _cache_route(self, message_id, route):
+        expires_at = None
+        if self.ttl:
+            expires_at = self.clock.seconds() + self.ttl
+            self._schedule_sweep()
+        self.local_cache[message_id] = (route, expires_at)
+
+    def _schedule_sweep(self):
+        if self._sweep_call is None or not self._sweep_call.active():
+            self._sweep_call = self.clock.callLater(
+                self.sweep_interval, self.sweep)
+
+    def sweep(self):
+        """Remove expired routes from the local cache.
+
+        Routes are checked from least to most recently used, stopping at the
+        first one that hasn't expired. Expired routes that have been looked
+        up since they were stored may be left behind, but those are removed
+        when they are next looked up or pushed out of the cache.
+
+        Returns the number of routes removed.
+        """
+        now = self.clock.seconds()
+        removed = 0
+        while True:
+            oldest = self.local_cache.oldest()
+            if oldest is None:
+                break
+            message_id, (route, expires_at) = oldest
+            if expires_at is None or expires_at > now:
+                break
+            self.local_cache.pop(message_id)
+            removed += 1
+        if len(self.local_cache):
+            self._schedule_sweep()
+        return removed
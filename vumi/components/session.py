@@ -112,6 +112,8 @@ class SessionManager(object):
 
         """
         ukey = "%s:%s" % ('session', user_id)
+        pipe = self.redis.pipeline()
         for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+            pipe.hset(ukey, s_key, s_value)
+        yield pipe.execute()
         returnValue(session)
@@ -9,13 +9,168 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, LuaScript
 
 
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+# The free list may contain tags that aren't in the free set (because
+# acquiring a specific tag doesn't remove it from the free list), so the
+# free set is what determines whether a tag is free. Stale entries are
+# skipped when acquiring and pruned when releasing once they outnumber the
+# free tags.
+
+# Encode a string the way Python's json.dumps() does, so that owned tag
+# entries created by Lua match those created in Python.
+LUA_JSON_STRING = r"""
+local function json_string(s)
+    local escapes = {['"'] = '\\"', ['\\'] = '\\\\', ['\n'] = '\\n',
+                     ['\r'] = '\\r', ['\t'] = '\\t', ['\b'] = '\\b',
+                     ['\f'] = '\\f'}
+    local out = {}
+    local i = 1
+    while i <= #s do
+        local c = s:byte(i)
+        local cp, len
+        if c < 0x80 then
+            cp, len = c, 1
+        elseif c < 0xE0 then
+            cp, len = c % 0x20, 2
+        elseif c < 0xF0 then
+            cp, len = c % 0x10, 3
+        else
+            cp, len = c % 0x08, 4
+        end
+        for j = i + 1, i + len - 1 do
+            cp = cp * 0x40 + s:byte(j) % 0x40
+        end
+        local ch = s:sub(i, i)
+        i = i + len
+        if len == 1 and escapes[ch] then
+            table.insert(out, escapes[ch])
+        elseif cp >= 0x20 and cp < 0x7F then
+            table.insert(out, ch)
+        elseif cp < 0x10000 then
+            table.insert(out, string.format('\\u%04x', cp))
+        else
+            cp = cp - 0x10000
+            table.insert(out, string.format('\\u%04x\\u%04x',
+                0xD800 + math.floor(cp / 0x400), 0xDC00 + cp % 0x400))
+        end
+    end
+    return '"' .. table.concat(out) .. '"'
+end
+"""
+
+
+def _owned_tag_entry(pool_json, local_tag):
+    return "[%s, %s]" % (pool_json, json.dumps(local_tag.decode("UTF-8")))
+
+
+def _acquire_tag_emulation(redis, keys, args):
+    free_list_key, free_set_key, inuse_set_key, reason_key, owner_key = keys
+    reason, pool_json = args
+    while True:
+        tag = redis.lpop(free_list_key)
+        if tag is None:
+            return None
+        if redis.smove(free_set_key, inuse_set_key, tag):
+            break
+    redis.hset(reason_key, tag, reason)
+    redis.sadd(owner_key, _owned_tag_entry(pool_json, tag))
+    return tag
+
+
+ACQUIRE_TAG_SCRIPT = LuaScript(LUA_JSON_STRING + """
+local tag
+repeat
+    tag = redis.call('LPOP', KEYS[1])
+    if not tag then
+        return false
+    end
+until redis.call('SMOVE', KEYS[2], KEYS[3], tag) == 1
+redis.call('HSET', KEYS[4], tag, ARGV[1])
+redis.call('SADD', KEYS[5], '[' .. ARGV[2] .. ', ' .. json_string(tag) .. ']')
+return tag
+""", emulation=_acquire_tag_emulation)
+
+
+def _acquire_specific_tag_emulation(redis, keys, args):
+    free_set_key, inuse_set_key, reason_key, owner_key = keys
+    local_tag, reason, owned_tag_entry = args
+    if not redis.smove(free_set_key, inuse_set_key, local_tag):
+        return 0
+    redis.hset(reason_key, local_tag, reason)
+    redis.sadd(owner_key, owned_tag_entry)
+    return 1
+
+
+ACQUIRE_SPECIFIC_TAG_SCRIPT = LuaScript("""
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[3])
+return 1
+""", emulation=_acquire_specific_tag_emulation)
+
+
+def _release_tag_emulation(redis, keys, args):
+    (free_list_key, free_set_key, inuse_set_key, reason_key,
+     unowned_key, owners_prefix) = keys
+    local_tag, owned_tag_entry = args
+    if not redis.smove(inuse_set_key, free_set_key, local_tag):
+        return 0
+    redis.rpush(free_list_key, local_tag)
+    reason = redis.hget(reason_key, local_tag)
+    if reason is not None:
+        owner = json.loads(reason).get('owner')
+        owner_key = unowned_key
+        if isinstance(owner, basestring):
+            owner_key = "%s%s:tags" % (owners_prefix, owner.encode("UTF-8"))
+        redis.srem(owner_key, owned_tag_entry)
+    if redis.llen(free_list_key) > 2 * redis.scard(free_set_key):
+        tags = redis.lrange(free_list_key, 0, -1)
+        redis.delete(free_list_key)
+        seen = set()
+        for tag in tags:
+            if tag not in seen and redis.sismember(free_set_key, tag):
+                seen.add(tag)
+                redis.rpush(free_list_key, tag)
+    return 1
+
+
+RELEASE_TAG_SCRIPT = LuaScript("""
+if redis.call('SMOVE', KEYS[3], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+local reason = redis.call('HGET', KEYS[4], ARGV[1])
+if reason then
+    local owner = cjson.decode(reason)['owner']
+    local owner_key = KEYS[5]
+    if type(owner) == 'string' then
+        owner_key = KEYS[6] .. owner .. ':tags'
+    end
+    redis.call('SREM', owner_key, ARGV[2])
+end
+if redis.call('LLEN', KEYS[1]) > 2 * redis.call('SCARD', KEYS[2]) then
+    local tags = redis.call('LRANGE', KEYS[1], 0, -1)
+    redis.call('DEL', KEYS[1])
+    local seen = {}
+    for _, tag in ipairs(tags) do
+        if not seen[tag] and redis.call('SISMEMBER', KEYS[2], tag) == 1 then
+            seen[tag] = true
+            redis.call('RPUSH', KEYS[1], tag)
+        end
+    end
+end
+return 1
+""", emulation=_release_tag_emulation)
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
@@ -78,8 +233,10 @@ class TagpoolManager(object):
         metadata = dict((self._encode(k), json.dumps(v))
                         for k, v in metadata.iteritems())
         yield self._register_pool(pool)
-        yield self.redis.delete(metadata_key)
-        yield self.redis.hmset(metadata_key, metadata)
+        pipe = self.redis.pipeline()
+        pipe.delete(metadata_key)
+        pipe.hmset(metadata_key, metadata)
+        yield pipe.execute()
 
     @Manager.calls_manager
     def purge_pool(self, pool):
@@ -90,11 +247,13 @@ class TagpoolManager(object):
             raise TagpoolError('%s tags of pool %s still in use.' % (
                                in_use_count, pool))
         else:
-            yield self.redis.delete(free_set_key)
-            yield self.redis.delete(free_list_key)
-            yield self.redis.delete(inuse_set_key)
-            yield self.redis.delete(metadata_key)
-            yield self._unregister_pool(pool)
+            pipe = self.redis.pipeline()
+            pipe.delete(free_set_key)
+            pipe.delete(free_list_key)
+            pipe.delete(inuse_set_key)
+            pipe.delete(metadata_key)
+            pipe.srem(self._pool_list_key(), self._encode(pool))
+            yield pipe.execute()
 
     @Manager.calls_manager
     def list_pools(self):
@@ -145,13 +304,6 @@ class TagpoolManager(object):
         pool_list_key = self._pool_list_key()
         yield self.redis.sadd(pool_list_key, pool)
 
-    @Manager.calls_manager
-    def _unregister_pool(self, pool):
-        """Remove a pool to list of pools."""
-        pool = self._encode(pool)
-        pool_list_key = self._pool_list_key()
-        yield self.redis.srem(pool_list_key, pool)
-
     def _tag_pool_keys(self, pool):
         pool = self._encode(pool)
         return tuple(":".join(["tagpools", pool, state])
@@ -164,30 +316,35 @@ class TagpoolManager(object):
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
+        tag = yield self.redis.run_script(ACQUIRE_TAG_SCRIPT, keys=[
+            free_list_key, free_set_key, inuse_set_key,
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner),
+        ], args=[self._reason_json(owner, reason), json.dumps(pool)])
         returnValue(self._decode(tag) if tag is not None else None)
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
+        owned_tag_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
+        moved = yield self.redis.run_script(ACQUIRE_SPECIFIC_TAG_SCRIPT, keys=[
+            free_set_key, inuse_set_key, self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner),
+        ], args=[local_tag, self._reason_json(owner, reason), owned_tag_entry])
         returnValue(moved)
 
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
+        owned_tag_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        yield self.redis.run_script(RELEASE_TAG_SCRIPT, keys=[
+            free_list_key, free_set_key, inuse_set_key,
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(None),
+            # Not a real key, but the script needs the prefixed form to find
+            # the owner's tag list.
+            ":".join(["tagpools", "owners", ""]),
+        ], args=[local_tag, owned_tag_entry])
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
@@ -195,9 +352,11 @@ class TagpoolManager(object):
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
         old_tags = set(old_tags)
+        pipe = self.redis.pipeline()
         for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+            pipe.sadd(free_set_key, tag)
+            pipe.rpush(free_list_key, tag)
+        yield pipe.execute()
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
@@ -209,25 +368,9 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
+    def _reason_json(self, owner, reason):
         if reason is None:
             reason = {}
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
@@ -0,0 +1,145 @@
+"""Tests for vumi.components.delayed_queue."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.components.delayed_queue import DelayedQueue
+from vumi.tests.utils import PersistenceMixin
+
+
+class DelayedQueueTestCase(TestCase, PersistenceMixin):
+    timeout = 2
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = yield self.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.delivered = []
+        self.queue = self.mk_queue()
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.queue.stop()
+        yield self._persist_tearDown()
+
+    def mk_queue(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return DelayedQueue(self.manager, self.deliver, **kw)
+
+    def deliver(self, payload):
+        self.delivered.append(payload)
+
+    @inlineCallbacks
+    def test_schedule(self):
+        item_id = yield self.queue.schedule(10, {'foo': 'bar'})
+        self.assertEqual(1, (yield self.queue.count()))
+        self.assertEqual(1010, (yield self.queue.get_due_time(item_id)))
+        self.assertEqual('{"foo": "bar"}',
+                         (yield self.manager.hget('items', item_id)))
+
+    @inlineCallbacks
+    def test_schedule_with_item_id(self):
+        yield self.queue.schedule(10, 'foo', item_id='item1')
+        yield self.queue.schedule(20, 'bar', item_id='item1')
+        self.assertEqual(1, (yield self.queue.count()))
+        self.assertEqual(1020, (yield self.queue.get_due_time('item1')))
+
+    @inlineCallbacks
+    def test_schedule_bad_payload(self):
+        try:
+            yield self.queue.schedule(10, object())
+        except TypeError:
+            pass
+        else:
+            self.fail("Expected TypeError.")
+        self.assertEqual([], (yield self.manager.keys()))
+
+    @inlineCallbacks
+    def test_cancel(self):
+        item_id = yield self.queue.schedule(0, 'foo')
+        yield self.queue.cancel(item_id)
+        self.assertEqual(0, (yield self.queue.count()))
+        self.assertEqual(0, (yield self.queue.deliver_due()))
+        self.assertEqual([], (yield self.manager.keys()))
+
+    @inlineCallbacks
+    def test_claim_due(self):
+        yield self.queue.schedule(5, 'later', item_id='item1')
+        yield self.queue.schedule(-10, 'first', item_id='item2')
+        yield self.queue.schedule(0, 'second', item_id='item3')
+        claimed = yield self.queue.claim_due()
+        self.assertEqual([
+            ('item2', 990, '"first"'),
+            ('item3', 1000, '"second"'),
+        ], claimed)
+        self.assertEqual(1, (yield self.queue.count()))
+        self.assertEqual(None, (yield self.manager.hget('items', 'item2')))
+        self.assertEqual([], (yield self.queue.claim_due()))
+
+    @inlineCallbacks
+    def test_claim_due_limit(self):
+        for i in range(5):
+            yield self.queue.schedule(-i, i)
+        claimed = yield self.queue.claim_due(limit=2)
+        self.assertEqual(['4', '3'], [payload for _, _, payload in claimed])
+        self.assertEqual(3, (yield self.queue.count()))
+
+    @inlineCallbacks
+    def test_deliver_due(self):
+        yield self.queue.schedule(10, 'later')
+        yield self.queue.schedule(0, 'second')
+        yield self.queue.schedule(-10, {'first': True})
+        delivered = yield self.queue.deliver_due()
+        self.assertEqual(2, delivered)
+        self.assertEqual([{'first': True}, 'second'], self.delivered)
+        self.assertEqual(1, (yield self.queue.count()))
+
+        self.assertEqual(1, (yield self.queue.deliver_due(now=1010)))
+        self.assertEqual([{'first': True}, 'second', 'later'],
+                         self.delivered)
+        self.assertEqual([], (yield self.manager.keys()))
+
+    @inlineCallbacks
+    def test_deliver_due_in_batches(self):
+        self.queue = self.mk_queue(batch_size=3)
+        for i in range(7):
+            yield self.queue.schedule(i - 10, i)
+        self.assertEqual(7, (yield self.queue.deliver_due()))
+        self.assertEqual(range(7), self.delivered)
+
+    @inlineCallbacks
+    def test_deliver_due_failure(self):
+        def deliver(payload):
+            if payload == 'bad':
+                raise ValueError("Bad payload.")
+            self.delivered.append(payload)
+
+        self.queue = self.mk_queue(batch_size=2)
+        self.queue.callback = deliver
+        yield self.queue.schedule(-3, 'first')
+        yield self.queue.schedule(-2, 'bad', item_id='bad')
+        yield self.queue.schedule(-1, 'third')
+        self.assertEqual(1, (yield self.queue.deliver_due()))
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(['first'], self.delivered)
+        self.assertEqual(2, (yield self.queue.count()))
+        self.assertEqual(998, (yield self.queue.get_due_time('bad')))
+
+        self.queue.callback = self.deliver
+        self.assertEqual(2, (yield self.queue.deliver_due()))
+        self.assertEqual(['first', 'bad', 'third'], self.delivered)
+
+    @inlineCallbacks
+    def test_start_and_stop(self):
+        yield self.queue.schedule(5, 'foo')
+        self.queue.start(10)
+        self.assertTrue(self.queue.is_running)
+        self.assertEqual([], self.delivered)
+        self.clock.advance(10)
+        self.assertEqual(['foo'], self.delivered)
+        yield self.queue.stop()
+        self.assertFalse(self.queue.is_running)
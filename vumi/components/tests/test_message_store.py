@@ -282,6 +282,27 @@ class TestMessageStore(TestMessageStoreBase):
                 message_id=TransportEvent.generate_id()), batch_id=batch_id)
         self.assertEqual(2, (yield self.store.batch_outbound_count(batch_id)))
 
+    @inlineCallbacks
+    def test_inbound_keys_page(self):
+        msg_id, _msg, batch_id = yield self._create_inbound(by_batch=True)
+        msg_id2 = TransportEvent.generate_id()
+        yield self.store.add_inbound_message(self.mkmsg_in(
+                message_id=msg_id2), batch_id=batch_id)
+
+        page1 = yield self.store.batch_inbound_keys_page(
+            batch_id, max_results=1)
+        self.assertTrue(page1.has_next_page())
+        page2 = yield page1.next_page()
+        self.assertEqual(sorted([msg_id, msg_id2]),
+                         sorted(list(page1) + list(page2)))
+
+    @inlineCallbacks
+    def test_outbound_keys_page(self):
+        msg_id, _msg, batch_id = yield self._create_outbound(by_batch=True)
+        page = yield self.store.batch_outbound_keys_page(batch_id)
+        self.assertEqual([msg_id], list(page))
+        self.assertFalse(page.has_next_page())
+
     @inlineCallbacks
     def test_inbound_keys_matching(self):
         msg_id, msg, batch_id = yield self._create_inbound(content='hello')
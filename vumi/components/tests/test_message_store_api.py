@@ -254,3 +254,41 @@ class MessageStoreAPITestCase(VumiWorkerTestCase, PersistenceMixin):
         self.assertResultCount(response, 0)
         self.assertEqual(json.loads(response.delivered_body), [])
         self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_streamed_match_resource_in_bunches(self):
+        self.store.manager.load_bunch_size = 3
+        messages = yield self.create_inbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('inbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&start=0&stop=21' % (
+                self.batch_id, token))
+        self.assertResultCount(response, 22)
+        self.assertJSONResultEqual(response.delivered_body, messages)
+        self.assertEqual(response.headers.getRawHeaders(
+            MatchResource.RESP_NEXT_CURSOR_HEADER), None)
+
+    @inlineCallbacks
+    def test_cursor_match_resource(self):
+        messages = yield self.create_outbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('outbound', self.batch_id, '.*',
+                                                wait=True)
+        url = 'batch/%s/outbound/match/?token=%s&limit=8' % (
+            self.batch_id, token)
+        pages = []
+        response = yield self.do_get(url)
+        pages.append(response.delivered_body)
+        [cursor] = response.headers.getRawHeaders(
+            MatchResource.RESP_NEXT_CURSOR_HEADER)
+        while cursor is not None:
+            response = yield self.do_get('%s&cursor=%s' % (url, cursor))
+            pages.append(response.delivered_body)
+            [cursor] = response.headers.getRawHeaders(
+                MatchResource.RESP_NEXT_CURSOR_HEADER, [None])
+        self.assertEqual(3, len(pages))
+        self.assertJSONResultEqual(pages[0], messages[:8])
+        self.assertJSONResultEqual(pages[1], messages[8:16])
+        self.assertJSONResultEqual(pages[2], messages[16:])
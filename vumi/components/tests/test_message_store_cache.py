@@ -342,3 +342,92 @@ class TestMessageStoreCache(ApplicationTestCase):
         self.assertEqual(
             (yield self.cache.count_query_results(self.batch_id, token)),
             10)
+
+    @inlineCallbacks
+    def test_store_query_results_in_chunks(self):
+        now = datetime.now()
+        message_ids = []
+        for i in range(10):
+            msg_out = self.mkmsg_out(content='hello-%s' % (i,))
+            msg_out['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_outbound_message(self.batch_id, msg_out)
+            message_ids.append(msg_out['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'outbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        counts = []
+        store_chunk = self.cache._store_query_results_chunk
+
+        @inlineCallbacks
+        def record_progress(*args):
+            counts.append((
+                (yield self.cache.count_query_results(self.batch_id, token)),
+                (yield self.cache.is_query_in_progress(self.batch_id, token)),
+            ))
+            yield store_chunk(*args)
+
+        self.cache._store_query_results_chunk = record_progress
+        # Keys that aren't in the cache are left out.
+        yield self.cache.store_query_results(
+            self.batch_id, token, message_ids + [u'unknown'], 'outbound',
+            120, chunk_size=4)
+        self.assertEqual([(0, True), (4, True), (8, True)], counts)
+        self.assertFalse(
+            (yield self.cache.is_query_in_progress(self.batch_id, token)))
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            list(reversed(message_ids)))
+        result_key = self.cache.search_result_key(self.batch_id, token)
+        self.assertTrue(0 < (yield self.redis.ttl(result_key)) <= 120)
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        messages = yield self.add_messages(self.batch_id,
+            lambda batch_id, msg: None)
+        yield self.cache.add_inbound_messages(self.batch_id, messages)
+        keys = yield self.cache.get_inbound_message_keys(self.batch_id)
+        self.assertEqual(keys, [m['message_id'] for m in messages])
+        from_addrs = yield self.cache.get_from_addrs(self.batch_id)
+        self.assertEqual(from_addrs, [m['from_addr'] for m in messages])
+
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        messages = yield self.add_messages(self.batch_id,
+            lambda batch_id, msg: None)
+        yield self.cache.add_outbound_messages(self.batch_id, messages[:5])
+        yield self.cache.add_outbound_messages(self.batch_id, messages)
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(keys, [m['message_id'] for m in messages])
+        to_addrs = yield self.cache.get_to_addrs(self.batch_id)
+        self.assertEqual(to_addrs, [m['to_addr'] for m in messages])
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 10)
+
+    @inlineCallbacks
+    def test_add_events(self):
+        ack = self.mkmsg_ack()
+        events = [ack, ack, self.mkmsg_ack(),
+                  self.mkmsg_delivery(status='delivered'),
+                  self.mkmsg_delivery(status='failed')]
+        yield self.cache.add_events(self.batch_id, events)
+        yield self.cache.add_events(self.batch_id, events)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['ack'], 2)
+        self.assertEqual(status['delivery_report'], 2)
+        self.assertEqual(status['delivery_report.delivered'], 1)
+        self.assertEqual(status['delivery_report.failed'], 1)
+        self.assertEqual(status['delivery_report.pending'], 0)
+
+    @inlineCallbacks
+    def test_reconcile_checkpoints(self):
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        yield self.cache.set_reconcile_checkpoint(
+            self.batch_id, 'inbound', 'key1')
+        self.assertEqual('key1', (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'outbound')))
+        yield self.cache.clear_reconcile_checkpoints(self.batch_id)
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for vumi.components.message_store_reconciler."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.components.tests.test_message_store import TestMessageStoreBase
+
+
+class TestCacheReconciler(TestMessageStoreBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestCacheReconciler, self).setUp()
+        # Small bunches so that we exercise concurrency and checkpoints.
+        self.manager.load_bunch_size = 3
+        self.progress = []
+
+    def clear_cache(self):
+        self.store.cache.redis._client._data = {}
+
+    def record_progress(self, batch_id, direction, done, total):
+        self.progress.append((direction, done, total))
+
+    @inlineCallbacks
+    def create_batch(self, inbound=7, outbound=7):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, inbound)
+        messages = yield self.create_outbound_messages(batch_id, outbound)
+        for msg in messages:
+            yield self.store.add_event(self.mkmsg_ack(
+                user_message_id=msg['message_id'],
+                sent_message_id=msg['message_id']))
+        yield self.store.add_event(self.mkmsg_delivery(
+            status='delivered', user_message_id=messages[0]['message_id']))
+        returnValue(batch_id)
+
+    @inlineCallbacks
+    def assert_reconciled(self, batch_id, inbound=7, outbound=7):
+        cache = self.store.cache
+        self.assertEqual(inbound,
+                         (yield cache.count_inbound_message_keys(batch_id)))
+        self.assertEqual(outbound,
+                         (yield cache.count_outbound_message_keys(batch_id)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], outbound)
+        self.assertEqual(batch_status['ack'], outbound)
+        self.assertEqual(batch_status['delivery_report'], 1)
+        self.assertEqual(batch_status['delivery_report.delivered'], 1)
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        batch_id = yield self.create_batch()
+        self.clear_cache()
+        reconciler = self.store.reconciler(
+            concurrency=2, progress_callback=self.record_progress)
+        yield reconciler.reconcile(batch_id)
+        yield self.assert_reconciled(batch_id)
+        checkpoint = yield self.store.cache.get_reconcile_checkpoint(
+            batch_id, 'outbound')
+        self.assertEqual(None, checkpoint)
+
+    @inlineCallbacks
+    def test_reconcile_progress(self):
+        batch_id = yield self.create_batch()
+        yield self.store.reconcile_cache(
+            batch_id, progress_callback=self.record_progress)
+        self.assertEqual(
+            set([('inbound', 7), ('outbound', 7)]),
+            set((direction, total) for direction, _, total in self.progress))
+        inbound_done = [done for direction, done, _ in self.progress
+                        if direction == 'inbound']
+        self.assertEqual(sorted(inbound_done), inbound_done)
+        self.assertEqual(7, inbound_done[-1])
+        self.assertEqual(3, len(inbound_done))
+
+    @inlineCallbacks
+    def test_reconcile_resume(self):
+        batch_id = yield self.create_batch(inbound=0)
+        keys = sorted((yield self.store.batch_outbound_keys(batch_id)))
+        self.clear_cache()
+        yield self.store.cache.set_reconcile_checkpoint(
+            batch_id, 'outbound', keys[2])
+        yield self.store.reconcile_cache(
+            batch_id, resume=True, progress_callback=self.record_progress)
+        cached_keys = yield self.store.cache.get_outbound_message_keys(
+            batch_id)
+        self.assertEqual(keys[3:], sorted(cached_keys))
+        self.assertEqual(('outbound', 7, 7), self.progress[-1])
+        checkpoint = yield self.store.cache.get_reconcile_checkpoint(
+            batch_id, 'outbound')
+        self.assertEqual(None, checkpoint)
+
+    @inlineCallbacks
+    def test_reconcile_resume_after_failure(self):
+        batch_id = yield self.create_batch()
+        keys = sorted((yield self.store.batch_inbound_keys(batch_id)))
+        self.clear_cache()
+        reconciler = self.store.reconciler(concurrency=1)
+        process_bunch = reconciler._process_inbound_bunch
+        processed = []
+
+        def failing_process_bunch(batch_id, msg_records):
+            processed.append(msg_records)
+            if len(processed) == 2:
+                raise ValueError("Failed to process bunch.")
+            return process_bunch(batch_id, msg_records)
+
+        reconciler._process_inbound_bunch = failing_process_bunch
+        try:
+            yield reconciler.reconcile(batch_id)
+        except ValueError:
+            pass
+        else:
+            self.fail("Expected ValueError.")
+        # Only the bunch before the failed one is checkpointed and nothing
+        # after the failed bunch is processed.
+        self.assertEqual(2, len(processed))
+        self.assertEqual(keys[2],
+                         (yield self.store.cache.get_reconcile_checkpoint(
+                             batch_id, 'inbound')))
+
+        reconciler._process_inbound_bunch = process_bunch
+        yield reconciler.reconcile(batch_id, resume=True)
+        yield self.assert_reconciled(batch_id)
+        cached_keys = yield self.store.cache.get_inbound_message_keys(
+            batch_id)
+        self.assertEqual(keys, sorted(cached_keys))
+
+    @inlineCallbacks
+    def test_reconcile_records_checkpoint(self):
+        batch_id = yield self.create_batch()
+        keys = sorted((yield self.store.batch_inbound_keys(batch_id)))
+        self.clear_cache()
+        yield self.store.reconcile_inbound_cache(batch_id)
+        self.assertEqual(keys[-1],
+                         (yield self.store.cache.get_reconcile_checkpoint(
+                             batch_id, 'inbound')))
+
+    @inlineCallbacks
+    def test_get_events_for_messages(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 4)
+        acks = []
+        for msg in messages:
+            ack = self.mkmsg_ack(user_message_id=msg['message_id'])
+            yield self.store.add_event(ack)
+            acks.append(ack)
+        # Old-style events only have the message id in their index.
+        old_ack = self.mkmsg_ack(user_message_id=messages[3]['message_id'])
+        event_record = self.store.events(
+            old_ack['event_id'], event=old_ack,
+            message=messages[3]['message_id'])
+        event_record._riak_object._data.pop('message')
+        yield event_record.save()
+
+        events = yield self.store.get_events_for_messages(
+            [messages[0]['message_id'], messages[3]['message_id']])
+        self.assertEqual(
+            sorted([acks[0]['event_id'], acks[3]['event_id'],
+                    old_ack['event_id']]),
+            sorted([event['event_id'] for event in events]))
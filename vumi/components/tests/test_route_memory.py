@@ -0,0 +1,112 @@
+"""Tests for vumi.components.route_memory."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.components.route_memory import RouteMemory
+from vumi.tests.utils import PersistenceMixin
+
+
+class RouteMemoryTestCase(TestCase, PersistenceMixin):
+    timeout = 2
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = yield self.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.clock = Clock()
+        self.memory = self.mk_route_memory()
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.memory.stop()
+        yield self._persist_tearDown()
+
+    def mk_route_memory(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return RouteMemory(self.manager, **kw)
+
+    @inlineCallbacks
+    def test_remember_and_lookup(self):
+        yield self.memory.remember('msg1', ['conn1', 'default'])
+        route = yield self.memory.lookup('msg1')
+        self.assertEqual(route, ['conn1', 'default'])
+        route = yield self.memory.lookup('unknown')
+        self.assertEqual(route, None)
+
+    @inlineCallbacks
+    def test_remember_sets_ttl(self):
+        self.memory = self.mk_route_memory(ttl=60)
+        yield self.memory.remember('msg1', 'app1')
+        ttl = yield self.manager.ttl('route:msg1')
+        self.assertTrue(50 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_remember_without_ttl(self):
+        yield self.memory.remember('msg1', 'app1')
+        ttl = yield self.manager.ttl('route:msg1')
+        self.assertEqual(ttl, None)
+
+    @inlineCallbacks
+    def test_forget(self):
+        self.memory = self.mk_route_memory(local_cache_size=10)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.memory.forget('msg1')
+        route = yield self.memory.lookup('msg1')
+        self.assertEqual(route, None)
+
+    @inlineCallbacks
+    def test_lookup_from_local_cache(self):
+        self.memory = self.mk_route_memory(local_cache_size=10)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.manager.delete('route:msg1')
+        route = yield self.memory.lookup('msg1')
+        self.assertEqual(route, 'app1')
+
+    @inlineCallbacks
+    def test_lookup_falls_back_to_redis(self):
+        self.memory = self.mk_route_memory(local_cache_size=1)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.memory.remember('msg2', 'app2')
+        self.assertFalse('msg1' in self.memory.local_cache)
+        route = yield self.memory.lookup('msg1')
+        self.assertEqual(route, 'app1')
+
+    @inlineCallbacks
+    def test_lookup_expired_local_route(self):
+        self.memory = self.mk_route_memory(ttl=60, local_cache_size=10)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.manager.set('route:msg1', '"other"')
+        self.clock.advance(61)
+        route = yield self.memory.lookup('msg1')
+        self.assertEqual(route, 'other')
+        self.assertFalse('msg1' in self.memory.local_cache)
+
+    @inlineCallbacks
+    def test_sweep(self):
+        self.memory = self.mk_route_memory(
+            ttl=60, local_cache_size=10, sweep_interval=30)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.memory.remember('msg2', 'app2')
+        self.clock.advance(20)
+        yield self.memory.remember('msg3', 'app3')
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(10)
+        self.assertEqual(['msg1', 'msg2', 'msg3'],
+                         self.memory.local_cache.keys())
+        self.clock.advance(30)
+        self.assertEqual(['msg3'], self.memory.local_cache.keys())
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(30)
+        self.assertEqual([], self.memory.local_cache.keys())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    @inlineCallbacks
+    def test_stop_cancels_sweep(self):
+        self.memory = self.mk_route_memory(ttl=60, local_cache_size=10)
+        yield self.memory.remember('msg1', 'app1')
+        yield self.memory.stop(stop_redis=False)
+        self.assertEqual([], self.clock.getDelayedCalls())
@@ -118,12 +118,33 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
-                         free_local_tags)
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
+        # The free list isn't updated, but tag5 is skipped when acquiring.
+        acquired = []
+        for _ in range(10):
+            acquired.append((yield self.tpm.acquire_tag("poolA")))
+        self.assertEqual(acquired,
+                         [("poolA", t) for t in free_local_tags] + [None])
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)), [])
+
+    @inlineCallbacks
+    def test_release_specific_tag_prunes_free_list(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(3)]
+        yield self.tpm.declare_tags(tags)
+        # The free list is pruned once it has more than twice as many
+        # entries as there are free tags.
+        for _ in range(4):
+            yield self.tpm.acquire_specific_tag(tags[1])
+            yield self.tpm.release_tag(tags[1])
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag0", "tag1", "tag2"])
+        self.assertEqual((yield redis.smembers(tkey("free:set"))),
+                         set(["tag0", "tag1", "tag2"]))
 
     @inlineCallbacks
     def test_acquire_specific_unicode_tag(self):
@@ -271,6 +292,26 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         my_tags = yield self.tpm.owned_tags(u"mé")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_owned_tags_after_release(self):
+        tags = [[u"poöl1", u"tág\"1"], [u"poöl1", u"tág2"]]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tag(tags[0][0], owner=u"mé")
+        yield self.tpm.acquire_specific_tag(tags[1], owner=u"mé")
+        my_tags = yield self.tpm.owned_tags(u"mé")
+        self.assertEqual(sorted(my_tags), tags)
+        yield self.tpm.release_tag(tags[0])
+        yield self.tpm.release_tag(tags[1])
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+
+    @inlineCallbacks
+    def test_acquire_tag_loads_flushed_scripts(self):
+        tags = [("poolA", "tag1"), ("poolA", "tag2")]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[0])
+        yield self.redis._client.script_flush()
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[1])
+
     @inlineCallbacks
     def test_owned_tags_unicode_tags(self):
         tags = [[u"poöl1", u"tág1"], [u"poöl2", u"tág2"]]
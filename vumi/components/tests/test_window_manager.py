@@ -83,6 +83,44 @@ class WindowManagerTestCase(TestCase, PersistenceMixin):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_get_next_keys(self):
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+
+        flight_keys = yield self.wm.get_next_keys(self.window_id, 4)
+        self.assertEqual(flight_keys, keys[:4])
+        flight_keys = yield self.wm.get_next_keys(self.window_id)
+        self.assertEqual(flight_keys, keys[4:10])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        yield self.assert_in_flight(self.window_id, 10)
+        yield self.assert_count_waiting(self.window_id, 2)
+
+        yield self.wm.remove_key(self.window_id, keys[0])
+        yield self.assert_in_flight(self.window_id, 9)
+        flight_keys = yield self.wm.get_next_keys(self.window_id)
+        self.assertEqual(flight_keys, keys[10:11])
+
+    @inlineCallbacks
+    def test_get_next_keys_empty_window(self):
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        self.assertEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+    @inlineCallbacks
+    def test_legacy_flight_keys(self):
+        for i in range(10):
+            yield self.wm.add(self.window_id, i)
+        yield self.redis.lpush(
+            self.wm.legacy_flight_key(self.window_id), 'legacy_key')
+        flight_keys = yield self.wm.get_next_keys(self.window_id)
+        self.assertEqual(len(flight_keys), 9)
+        yield self.assert_in_flight(self.window_id, 10)
+        self.assertEqual((yield self.redis.llen(
+            self.wm.legacy_flight_key(self.window_id))), 0)
+        yield self.wm.remove_key(self.window_id, 'legacy_key')
+        yield self.assert_in_flight(self.window_id, 9)
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
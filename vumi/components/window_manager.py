@@ -3,10 +3,109 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import LuaScript
+
+
+# Keys that are in flight are kept in a sorted set scored by the time they
+# were taken from the window, so that checking for space, removing a key
+# and expiring old keys don't need to scan a list. The flight stats sorted
+# set holds the same keys and times but isn't trimmed when keys expire.
+
+# Older versions kept keys in flight in a list. Any keys found there are
+# moved into the sorted set the next time the window is read from.
+def _migrate_legacy_flight_keys(redis, flight_key, legacy_flight_key, now):
+    legacy_keys = redis.lrange(legacy_flight_key, 0, -1)
+    for key in legacy_keys:
+        redis.zadd(flight_key, **{key: now})
+    if legacy_keys:
+        redis.delete(legacy_flight_key)
+
+
+LUA_MIGRATE_LEGACY_FLIGHT_KEYS = """
+local legacy_keys = redis.call('LRANGE', KEYS[4], 0, -1)
+for _, key in ipairs(legacy_keys) do
+    redis.call('ZADD', KEYS[2], ARGV[3], key)
+end
+if #legacy_keys > 0 then
+    redis.call('DEL', KEYS[4])
+end
+"""
+
+
+def _get_next_keys_emulation(redis, keys, args):
+    window_key, flight_key, stats_key, legacy_flight_key = keys
+    window_size, limit, now = int(args[0]), int(args[1]), float(args[2])
+    _migrate_legacy_flight_keys(redis, flight_key, legacy_flight_key, now)
+    count = min(window_size - redis.zcard(flight_key), limit)
+    next_keys = []
+    for i in range(count):
+        key = redis.rpop(window_key)
+        if key is None:
+            break
+        redis.zadd(flight_key, **{key: now})
+        redis.zadd(stats_key, **{key: now})
+        next_keys.append(key)
+    return next_keys
+
+
+GET_NEXT_KEYS_SCRIPT = LuaScript(LUA_MIGRATE_LEGACY_FLIGHT_KEYS + """
+local count = math.min(tonumber(ARGV[1]) - redis.call('ZCARD', KEYS[2]),
+                       tonumber(ARGV[2]))
+local next_keys = {}
+for i = 1, count do
+    local key = redis.call('RPOP', KEYS[1])
+    if not key then
+        break
+    end
+    redis.call('ZADD', KEYS[2], ARGV[3], key)
+    redis.call('ZADD', KEYS[3], ARGV[3], key)
+    next_keys[i] = key
+end
+return next_keys
+""", emulation=_get_next_keys_emulation)
+
+
+def _remove_key_emulation(redis, keys, args):
+    (flight_key, stats_key, data_key, key_stats_key, external_map_key,
+     internal_map_prefix) = keys
+    [key] = args
+    redis.zrem(flight_key, key)
+    redis.zrem(stats_key, key)
+    redis.delete(data_key)
+    redis.delete(key_stats_key)
+    external_id = redis.get(external_map_key)
+    if external_id is not None:
+        redis.delete(external_map_key)
+        redis.delete(internal_map_prefix + external_id)
+
+
+REMOVE_KEY_SCRIPT = LuaScript("""
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3], KEYS[4])
+local external_id = redis.call('GET', KEYS[5])
+if external_id then
+    redis.call('DEL', KEYS[5], KEYS[6] .. external_id)
+end
+""", emulation=_remove_key_emulation)
+
+
+def _clear_expired_flight_keys_emulation(redis, keys, args):
+    [flight_key] = keys
+    [max_score] = args
+    expired_keys = redis.zrangebyscore(flight_key, '-inf', max_score)
+    for key in expired_keys:
+        redis.zrem(flight_key, key)
+    return len(expired_keys)
+
+
+CLEAR_EXPIRED_FLIGHT_KEYS_SCRIPT = LuaScript("""
+return redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+""", emulation=_clear_expired_flight_keys_emulation)
 
 
 class WindowException(Exception):
@@ -16,7 +115,8 @@ class WindowException(Exception):
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
-    FLIGHT_KEY = 'inflight'
+    FLIGHT_KEY = 'flight'
+    LEGACY_FLIGHT_KEY = 'inflight'
     FLIGHT_STATS_KEY = 'flightstats'
     MAP_KEY = 'keymap'
 
@@ -57,6 +157,9 @@ class WindowManager(object):
     def flight_key(self, *keys):
         return self.window_key(self.FLIGHT_KEY, *keys)
 
+    def legacy_flight_key(self, *keys):
+        return self.window_key(self.LEGACY_FLIGHT_KEY, *keys)
+
     def stats_key(self, *keys):
         return self.window_key(self.FLIGHT_STATS_KEY, *keys)
 
@@ -89,42 +192,44 @@ class WindowManager(object):
     @inlineCallbacks
     def add(self, window_id, data, key=None):
         key = key or uuid.uuid4().get_hex()
-        # The redis.set() has to complete before redis.lpush(),
-        # otherwise the key can be popped from the window before the
-        # data is available.
-        yield self.redis.set(self.window_key(window_id, key),
-                             json.dumps(data))
-        yield self.redis.lpush(self.window_key(window_id), key)
+        # The pipeline sends these in order, so the redis.set() completes
+        # before redis.lpush() and the key can't be popped from the window
+        # before the data is available.
+        pipe = self.redis.pipeline()
+        pipe.set(self.window_key(window_id, key), json.dumps(data))
+        pipe.lpush(self.window_key(window_id), key)
+        yield pipe.execute()
         returnValue(key)
 
     @inlineCallbacks
     def get_next_key(self, window_id):
+        """Move the next key in a window into flight, if there is space for
+        it, and return it. Returns `None` if the window is full or empty.
+        """
+        next_keys = yield self.get_next_keys(window_id, 1)
+        if next_keys:
+            returnValue(next_keys[0])
 
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
-
-    def _clear_timestamp(self, window_id, flight_key):
-        return self.redis.zrem(self.stats_key(window_id), flight_key)
+    @inlineCallbacks
+    def get_next_keys(self, window_id, limit=None):
+        """Move as many keys from a window into flight as there is space
+        for (but no more than `limit`, if given) and return them in the
+        order they were added.
+
+        The check for space and the move happen atomically in a single
+        call to redis.
+        """
+        if limit is None:
+            limit = self.window_size
+        next_keys = yield self.redis.run_script(
+            GET_NEXT_KEYS_SCRIPT,
+            keys=[self.window_key(window_id), self.flight_key(window_id),
+                  self.stats_key(window_id),
+                  self.legacy_flight_key(window_id)],
+            args=[self.window_size, limit, repr(self.get_clocktime())])
+        if next_keys:
+            log.debug('Window %s sent %s keys' % (window_id, len(next_keys)))
+        returnValue(next_keys or [])
 
     def count_waiting(self, window_id):
         window_key = self.window_key(window_id)
@@ -132,39 +237,52 @@ class WindowManager(object):
 
     def count_in_flight(self, window_id):
         flight_key = self.flight_key(window_id)
-        return self.redis.llen(flight_key)
+        return self.redis.zcard(flight_key)
 
     def get_expired_flight_keys(self, window_id):
         return self.redis.zrangebyscore(self.stats_key(window_id),
             '-inf', self.get_clocktime() - self.flight_lifetime)
 
+    def clear_expired_flight_keys_for_window(self, window_id):
+        """Free the space in a window used by keys that have been in flight
+        for longer than `flight_lifetime`. Expired keys are still returned
+        by :meth:`get_expired_flight_keys` until they are removed.
+        """
+        return self.redis.run_script(
+            CLEAR_EXPIRED_FLIGHT_KEYS_SCRIPT,
+            keys=[self.flight_key(window_id)],
+            args=[repr(self.get_clocktime() - self.flight_lifetime)])
+
     @inlineCallbacks
     def clear_expired_flight_keys(self):
         windows = yield self.get_windows()
-        for window_id in windows:
-            expired_keys = yield self.get_expired_flight_keys(window_id)
-            for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+        yield gatherResults([
+            self.clear_expired_flight_keys_for_window(window_id)
+            for window_id in windows])
 
     @inlineCallbacks
     def get_data(self, window_id, key):
         json_data = yield self.redis.get(self.window_key(window_id, key))
         returnValue(json.loads(json_data))
 
-    @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        """Remove a key from flight, along with its data and any external id
+        mapping, in a single atomic call to redis.
+        """
+        return self.redis.run_script(
+            REMOVE_KEY_SCRIPT,
+            keys=[self.flight_key(window_id), self.stats_key(window_id),
+                  self.window_key(window_id, key),
+                  self.stats_key(window_id, key),
+                  self.map_key(window_id, 'external', key),
+                  self.map_key(window_id, 'internal', '')],
+            args=[key])
 
-    @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
-        yield self.redis.set(self.map_key(window_id, 'internal', external_id),
-            flight_key)
-        yield self.redis.set(self.map_key(window_id, 'external', flight_key),
-            external_id)
+        pipe = self.redis.pipeline()
+        pipe.set(self.map_key(window_id, 'internal', external_id), flight_key)
+        pipe.set(self.map_key(window_id, 'external', flight_key), external_id)
+        return pipe.execute()
 
     def get_internal_id(self, window_id, external_id):
         return self.redis.get(self.map_key(window_id, 'internal', external_id))
@@ -176,10 +294,13 @@ class WindowManager(object):
     def clear_external_id(self, window_id, flight_key):
         external_id = yield self.get_external_id(window_id, flight_key)
         if external_id:
-            yield self.redis.delete(self.map_key(window_id, 'external',
-                                                 flight_key))
-            yield self.redis.delete(self.map_key(window_id, 'internal',
-                                                 external_id))
+            pipe = self.redis.pipeline()
+            self._clear_external_id(pipe, window_id, flight_key, external_id)
+            yield pipe.execute()
+
+    def _clear_external_id(self, pipe, window_id, flight_key, external_id):
+        pipe.delete(self.map_key(window_id, 'external', flight_key))
+        pipe.delete(self.map_key(window_id, 'internal', external_id))
 
     def monitor(self, key_callback, interval=10, cleanup=True,
                 cleanup_callback=None):
@@ -196,15 +317,23 @@ class WindowManager(object):
     def _monitor_windows(self, key_callback, cleanup=True,
                          cleanup_callback=None):
         windows = yield self.get_windows()
-        for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
+        yield gatherResults([
+            self._monitor_window(window_id, key_callback, cleanup,
+                                 cleanup_callback)
+            for window_id in windows])
+
+    @inlineCallbacks
+    def _monitor_window(self, window_id, key_callback, cleanup,
+                        cleanup_callback):
+        keys = yield self.get_next_keys(window_id)
+        while keys:
+            for key in keys:
                 yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
-
-            # Remove empty windows if required
-            if cleanup and not ((yield self.count_waiting(window_id)) or
-                                (yield self.count_in_flight(window_id))):
-                if cleanup_callback:
-                    cleanup_callback(window_id)
-                yield self.remove_window(window_id)
+            keys = yield self.get_next_keys(window_id)
+
+        # Remove empty windows if required
+        if cleanup and not ((yield self.count_waiting(window_id)) or
+                            (yield self.count_in_flight(window_id))):
+            if cleanup_callback:
+                cleanup_callback(window_id)
+            yield self.remove_window(window_id)
@@ -8,6 +8,7 @@ from zope.interface import Interface
 from twisted.python.components import Adapter, registerAdapter
 
 from vumi.errors import ConfigError
+from vumi.utils import LRUCache
 
 
 class IConfigData(Interface):
@@ -239,3 +240,53 @@ class Config(object):
                 # Skip non-static fields on static configs.
                 continue
             field.validate(self)
+
+
+class ConfigCache(object):
+    """Memoized config objects.
+
+    Building a config object validates every field, which is wasteful when
+    the same config data is used for many messages. Config objects are
+    read-only, so they can safely be shared.
+
+    :param config_class: The :class:`Config` subclass to build.
+    :param int max_size:
+        The maximum number of config objects to keep. The least recently
+        used config object is dropped when this is exceeded.
+    """
+
+    def __init__(self, config_class, max_size=100):
+        self.config_class = config_class
+        self._configs = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key, get_config_data):
+        """Return the config object for `cache_key`.
+
+        On a cache miss a new config object is built from the result of
+        calling `get_config_data()`.
+        """
+        config = self._configs.get(cache_key)
+        if config is not None:
+            self.hits += 1
+            return config
+        self.misses += 1
+        config = self.config_class(get_config_data())
+        self._configs[cache_key] = config
+        return config
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """Return the cache's hit and miss counts and hit rate."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+        }
+
+    def clear(self):
+        self._configs.clear()
@@ -13,7 +13,7 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, concurrency=1, ordering_key=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -21,6 +21,8 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._concurrency = concurrency
+        self._ordering_key = ordering_key
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -67,7 +69,9 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(self._rkey(mtype), handler,
                                              message_class=msg_class,
-                                             paused=True)
+                                             paused=True,
+                                             concurrency=self._concurrency,
+                                             ordering_key=self._ordering_key)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         self._set_prefetch_count(consumer)
@@ -10,10 +10,11 @@ from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
+from vumi.utils import load_class_by_string, get_first_word, PrefixTrie
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
 from vumi.components import SessionManager
+from vumi.components.route_memory import RouteMemory
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -477,10 +478,18 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    :param int routing_memory_cache_size:
+        Number of outbound message ids to also keep in a local cache so
+        that events arriving soon after a message was sent don't need a
+        trip to Redis. Default is 0 (no local cache).
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
 
+    # Key for rules that match any to_addr in the rule index.
+    ANY_TO_ADDR = object()
+
     def setup_routing(self):
         self.r_config = self.config.get('redis_manager', {})
         self.r_prefix = self.config['dispatcher_name']
@@ -497,18 +506,30 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.rule_index = self.build_rule_index(self.rules)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
             'expire_routing_memory', self.DEFAULT_ROUTING_TIMEOUT))
+        self.routing_memory_cache_size = int(self.config.get(
+            'routing_memory_cache_size', 0))
 
         # FIXME: The following is a hack to deal with sync-only setup.
+        self.route_memory = None
         self._redis_d = TxRedisManager.from_config(self.r_config)
         self._redis_d.addCallback(lambda m: m.sub_manager(self.r_prefix))
         self._redis_d.addCallback(self._setup_redis)
 
+    def teardown_routing(self):
+        if self.route_memory is not None:
+            return self.route_memory.stop()
+
     def _setup_redis(self, redis):
         self.redis = redis
+        self.route_memory = RouteMemory(
+            self.redis, self.expire_routing_timeout,
+            local_cache_size=self.routing_memory_cache_size)
+        # Only used to look up routes stored before RouteMemory was.
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
 
@@ -524,22 +545,48 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     def publish_exposed_event(self, name, msg):
         self.dispatcher.publish_inbound_event(name, msg)
 
-    def is_msg_matching_routing_rules(self, keyword, msg, rule):
-        return all([keyword == rule['keyword'],
-                    (not 'to_addr' in rule) or
-                    (msg['to_addr'] == rule['to_addr']),
-                    (not 'prefix' in rule) or
-                    (msg['from_addr'].startswith(rule['prefix']))])
+    def build_rule_index(self, rules):
+        """Index routing rules by keyword, then by `to_addr` (with
+        `ANY_TO_ADDR` for rules without one) and then by `from_addr` prefix
+        in a :class:`vumi.utils.PrefixTrie`. Each trie value is a list of
+        `(position, rule)` pairs so that matches can be put back in rule
+        order."""
+        prefixes = {}
+        for position, rule in enumerate(rules):
+            to_addrs = prefixes.setdefault(rule['keyword'], {})
+            rule_prefixes = to_addrs.setdefault(
+                rule.get('to_addr', self.ANY_TO_ADDR), {})
+            rule_prefixes.setdefault(rule.get('prefix', ''), []).append(
+                (position, rule))
+        index = {}
+        for keyword, to_addrs in prefixes.iteritems():
+            index[keyword] = dict(
+                (to_addr, PrefixTrie(rule_prefixes))
+                for to_addr, rule_prefixes in to_addrs.iteritems())
+        return index
+
+    def get_matching_rules(self, keyword, msg):
+        """Return the rules matching a message, in rule order."""
+        to_addrs = self.rule_index.get(keyword)
+        if to_addrs is None:
+            return []
+        matches = []
+        for to_addr in [msg['to_addr'], self.ANY_TO_ADDR]:
+            trie = to_addrs.get(to_addr)
+            if trie is not None:
+                for rules in trie.lookup_all(msg['from_addr'] or ''):
+                    matches.extend(rules)
+        matches.sort()
+        return [rule for _position, rule in matches]
 
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
         matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
+        for rule in self.get_matching_rules(keyword, msg):
+            matched = True
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
         if not matched:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
@@ -549,9 +596,11 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
-        message_key = self.get_message_key(msg['user_message_id'])
-        session = yield self.session_manager.load_session(message_key)
-        name = session.get('name')
+        name = yield self.route_memory.lookup(msg['user_message_id'])
+        if name is None:
+            message_key = self.get_message_key(msg['user_message_id'])
+            session = yield self.session_manager.load_session(message_key)
+            name = session.get('name')
         if not name:
             log.error("No transport_name for return route found in Redis"
                       " while dispatching transport event for message %s"
@@ -567,9 +616,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            yield self.session_manager.create_session(
-                message_key, name=msg['transport_name'])
+            yield self.route_memory.remember(
+                msg['message_id'], msg['transport_name'])
         else:
             log.error("No transport for %s" % (msg['from_addr'],))
 
@@ -2,10 +2,12 @@
 
 """Basic tools for building dispatchers."""
 
-from twisted.internet.defer import gatherResults, maybeDeferred
+from twisted.internet.defer import (
+    gatherResults, maybeDeferred, inlineCallbacks, returnValue)
 
 from vumi.worker import BaseWorker
-from vumi.config import ConfigDict, ConfigList
+from vumi.config import ConfigDict, ConfigList, ConfigInt
+from vumi.components.route_memory import RouteMemory
 from vumi import log
 
 
@@ -112,11 +114,36 @@ class RoutingTableDispatcherConfig(Dispatcher.CONFIG_CLASS):
     routing_table = ConfigDict(
         "Routing table. Keys are connector names, values are dicts mapping "
         "endpoint names to [connector, endpoint] pairs.", required=True)
+    redis_manager = ConfigDict(
+        "Redis client configuration. If set, the connector and endpoint each "
+        "outbound message arrived on are remembered and events for the "
+        "message are routed back to them instead of through the routing "
+        "table.", static=True)
+    expire_routing_memory = ConfigInt(
+        "Time in seconds before outbound message ids are forgotten.",
+        default=60 * 60 * 24 * 7, static=True)
+    routing_memory_cache_size = ConfigInt(
+        "Number of outbound message ids to also keep in a local cache.",
+        default=0, static=True)
 
 
 class RoutingTableDispatcher(Dispatcher):
     CONFIG_CLASS = RoutingTableDispatcherConfig
 
+    route_memory = None
+
+    @inlineCallbacks
+    def setup_dispatcher(self):
+        config = self.get_static_config()
+        if config.redis_manager is not None:
+            self.route_memory = yield RouteMemory.from_redis_config(
+                config.redis_manager, ttl=config.expire_routing_memory,
+                local_cache_size=config.routing_memory_cache_size)
+
+    def teardown_dispatcher(self):
+        if self.route_memory is not None:
+            return self.route_memory.stop()
+
     def find_target(self, config, msg, connector_name):
         endpoint_name = msg.get_routing_endpoint()
         endpoint_routing = config.routing_table.get(connector_name)
@@ -137,14 +164,28 @@ class RoutingTableDispatcher(Dispatcher):
             return
         return self.publish_inbound(msg, target[0], target[1])
 
+    @inlineCallbacks
     def process_outbound(self, config, msg, connector_name):
         target = self.find_target(config, msg, connector_name)
         if target is None:
             return
-        return self.publish_outbound(msg, target[0], target[1])
-
+        if self.route_memory is not None:
+            yield self.route_memory.remember(
+                msg['message_id'],
+                [connector_name, msg.get_routing_endpoint()])
+        yield self.publish_outbound(msg, target[0], target[1])
+
+    @inlineCallbacks
+    def find_event_target(self, config, event, connector_name):
+        if self.route_memory is not None:
+            target = yield self.route_memory.lookup(event['user_message_id'])
+            if target is not None:
+                returnValue(target)
+        returnValue(self.find_target(config, event, connector_name))
+
+    @inlineCallbacks
     def process_event(self, config, event, connector_name):
-        target = self.find_target(config, event, connector_name)
+        target = yield self.find_event_target(config, event, connector_name)
         if target is None:
             return
-        return self.publish_event(event, target[0], target[1])
+        yield self.publish_event(event, target[0], target[1])
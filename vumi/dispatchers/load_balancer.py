@@ -4,9 +4,12 @@
 
 import itertools
 
+from twisted.internet.defer import inlineCallbacks, succeed
+
 from vumi import log
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import BaseDispatchRouter
+from vumi.components.route_memory import RouteMemory
 
 
 class LoadBalancingRouter(BaseDispatchRouter):
@@ -24,8 +27,21 @@ class LoadBalancingRouter(BaseDispatchRouter):
     :param bool rewrite_transport_name:
         If set to true, rewrites message `transport_names` in both
         directions. Default: true.
+    :param dict redis_manager:
+        If set (and `reply_affinity` is true), the transport each inbound
+        message arrived on is also remembered in Redis. This is used to
+        route replies that have lost the load balancer's helper metadata.
+        Requires `dispatcher_name`, which is used as the key prefix.
+    :param int expire_routing_memory:
+        Time in seconds before inbound message ids are expired from the
+        routing store. Default is seven days.
+    :param int routing_memory_cache_size:
+        Number of inbound message ids to also keep in a local cache.
+        Default is 0 (no local cache).
     """
 
+    DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
+
     def setup_routing(self):
         self.reply_affinity = self.config.get('reply_affinity', True)
         self.rewrite_transport_names = self.config.get(
@@ -40,6 +56,24 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.transport_name_cycle = itertools.cycle(
             self.dispatcher.transport_names)
         self.transport_name_set = set(self.dispatcher.transport_names)
+        self.route_memory = None
+        r_config = self.config.get('redis_manager')
+        if self.reply_affinity and r_config is not None:
+            d = RouteMemory.from_redis_config(
+                r_config, self.config['dispatcher_name'],
+                ttl=int(self.config.get('expire_routing_memory',
+                                        self.DEFAULT_ROUTING_TIMEOUT)),
+                local_cache_size=int(self.config.get(
+                    'routing_memory_cache_size', 0)))
+            d.addCallback(self._setup_route_memory)
+            return d
+
+    def _setup_route_memory(self, route_memory):
+        self.route_memory = route_memory
+
+    def teardown_routing(self):
+        if self.route_memory is not None:
+            return self.route_memory.stop()
 
     def push_transport_name(self, msg, transport_name):
         hm = msg['helper_metadata']
@@ -55,11 +89,15 @@ class LoadBalancingRouter(BaseDispatchRouter):
             return None
         return transport_names.pop()
 
+    @inlineCallbacks
     def dispatch_inbound_message(self, msg):
         if self.reply_affinity:
             # TODO: we should really be pushing the endpoint name
             #       but it isn't available here
             self.push_transport_name(msg, msg['transport_name'])
+            if self.route_memory is not None:
+                yield self.route_memory.remember(
+                    msg['message_id'], msg['transport_name'])
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
@@ -69,9 +107,16 @@ class LoadBalancingRouter(BaseDispatchRouter):
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
 
+    def lookup_transport_name(self, msg):
+        transport_name = self.pop_transport_name(msg)
+        if transport_name is None and self.route_memory is not None:
+            return self.route_memory.lookup(msg['in_reply_to'])
+        return succeed(transport_name)
+
+    @inlineCallbacks
     def dispatch_outbound_message(self, msg):
         if self.reply_affinity and msg['in_reply_to']:
-            transport_name = self.pop_transport_name(msg)
+            transport_name = yield self.lookup_transport_name(msg)
             if transport_name not in self.transport_name_set:
                 log.warning("LoadBalancer is configured for reply affinity but"
                             " reply for unknown load balancer endpoint %r was"
@@ -494,9 +494,15 @@ class TestContentKeywordRouter(DispatcherTestCase):
         yield self.redis._purge_all()  # just in case
 
     @inlineCallbacks
-    def tearDown(self):
-        yield self.router.session_manager.stop()
-        yield super(TestContentKeywordRouter, self).tearDown()
+    def test_teardown_stops_route_memory(self):
+        self.config['routing_memory_cache_size'] = 10
+        dispatcher = yield self.get_dispatcher(self.config)
+        router = dispatcher._router
+        yield router._redis_d
+        yield router.route_memory.remember('1', 'app1')
+        self.assertTrue(router.route_memory._sweep_call.active())
+        yield dispatcher.stopWorker()
+        self.assertEqual(None, router.route_memory._sweep_call)
 
     @inlineCallbacks
     def test_inbound_message_routing(self):
@@ -566,12 +572,39 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                         direction='inbound')
         self.assertEqual(app1_inbound_msg, [msg])
 
+    def test_get_matching_rules(self):
+        self.router.rules = [
+            {'app': 'app1', 'keyword': 'kw', 'prefix': '+2567'},
+            {'app': 'app2', 'keyword': 'kw', 'to_addr': '8181'},
+            {'app': 'app3', 'keyword': 'kw', 'prefix': '+256',
+             'to_addr': '8181'},
+            {'app': 'fallback_app', 'keyword': 'kw'},
+            {'app': 'app1', 'keyword': 'other'},
+            ]
+        self.router.rule_index = self.router.build_rule_index(
+            self.router.rules)
+
+        def matching_apps(to_addr, from_addr):
+            msg = self.mkmsg_in(to_addr=to_addr, from_addr=from_addr)
+            return [rule['app']
+                    for rule in self.router.get_matching_rules('kw', msg)]
+
+        self.assertEqual(['app1', 'app2', 'app3', 'fallback_app'],
+                         matching_apps('8181', '+256788601462'))
+        self.assertEqual(['app2', 'fallback_app'],
+                         matching_apps('8181', '+27831234567'))
+        self.assertEqual(['app1', 'fallback_app'],
+                         matching_apps('8282', '+256788601462'))
+        self.assertEqual(['fallback_app'],
+                         matching_apps('8282', '+256123'))
+        self.assertEqual([], self.router.get_matching_rules(
+            'unknown', self.mkmsg_in()))
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         msg = self.mkmsg_ack(user_message_id='1',
                              transport_name='transport1')
-        yield self.router.session_manager.create_session(
-            'message:1', name='app2')
+        yield self.router.route_memory.remember('1', 'app2')
 
         yield self.dispatch(msg,
                             transport_name='transport1',
@@ -584,6 +617,21 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                       direction='event')
         self.assertEqual(app1_event_msg, [])
 
+    @inlineCallbacks
+    def test_inbound_event_routing_from_session(self):
+        msg = self.mkmsg_ack(user_message_id='1',
+                             transport_name='transport1')
+        yield self.router.session_manager.create_session(
+            'message:1', name='app2')
+
+        yield self.dispatch(msg,
+                            transport_name='transport1',
+                            direction='event')
+
+        app2_event_msg = self.get_dispatched_messages('app2',
+                                                      direction='event')
+        self.assertEqual(app2_event_msg, [msg])
+
     @inlineCallbacks
     def test_inbound_event_routing_failing_publisher_not_defined(self):
         msg = self.mkmsg_ack(transport_name='transport1')
@@ -631,8 +679,10 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                        direction='outbound')
         self.assertEqual(transport2_msgs, [])
 
-        session = yield self.router.session_manager.load_session('message:1')
-        self.assertEqual(session['name'], 'app2')
+        route = yield self.router.route_memory.lookup('1')
+        self.assertEqual(route, 'app2')
+        ttl = yield self.redis.ttl('route:1')
+        self.assertTrue(0 < ttl <= 3)
 
 
 class TestRedirectOutboundRouterForSMPP(DispatcherTestCase):
@@ -116,6 +116,29 @@ class TestRoutingTableDispatcher(VumiWorkerTestCase):
             [self.with_endpoint(msg, 'ep1')],
             self.get_dispatched_events('app1'))
 
+    @inlineCallbacks
+    def test_inbound_event_routing_with_route_memory(self):
+        yield self.get_dispatcher(redis_manager={'FAKE_REDIS': 'yes'})
+        msg = self.mkmsg_out(message_id='msg1')
+        msg.set_routing_endpoint('ep2')
+        yield self.dispatch_outbound(msg, 'app1')
+        self.assertEqual(
+            [self.with_endpoint(msg)],
+            self.get_dispatched_outbound('transport2'))
+
+        self.clear_all_dispatched()
+        ack = self.mkmsg_ack(user_message_id='msg1')
+        yield self.dispatch_event(ack, 'transport2')
+        self.assert_rkeys_used('transport2.event', 'app1.event')
+        self.assertEqual(
+            [self.with_endpoint(ack, 'ep2')],
+            self.get_dispatched_events('app1'))
+
+        self.clear_all_dispatched()
+        ack = self.mkmsg_ack(user_message_id='unknown')
+        yield self.dispatch_event(ack, 'transport2')
+        self.assert_rkeys_used('transport2.event', 'app2.event')
+
     def get_dispatcher_consumers(self, dispatcher):
         consumers = []
         for conn in dispatcher.connectors.values():
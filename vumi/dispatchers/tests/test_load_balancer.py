@@ -11,6 +11,7 @@ class BaseLoadBalancingTestCase(VumiWorkerTestCase):
 
     reply_affinity = None
     rewrite_transport_names = None
+    redis_manager = None
 
     @inlineCallbacks
     def setUp(self):
@@ -28,6 +29,9 @@ class BaseLoadBalancingTestCase(VumiWorkerTestCase):
             config['reply_affinity'] = self.reply_affinity
         if self.rewrite_transport_names is not None:
             config['rewrite_transport_names'] = self.rewrite_transport_names
+        if self.redis_manager is not None:
+            config['dispatcher_name'] = 'load_balancer'
+            config['redis_manager'] = self.redis_manager
         self.dispatcher = DummyDispatcher(config)
         self.router = LoadBalancingRouter(self.dispatcher, config)
         yield self.router.setup_routing()
@@ -118,6 +122,38 @@ class TestLoadBalancingWithReplyAffinity(BaseLoadBalancingTestCase):
         self.assertEqual(publishers['transport_1'].msgs, [msg1])
 
 
+class TestLoadBalancingWithRouteMemory(BaseLoadBalancingTestCase):
+
+    reply_affinity = True
+    redis_manager = {'FAKE_REDIS': 'yes'}
+
+    @inlineCallbacks
+    def test_inbound_message_routing(self):
+        msg = self.mkmsg_in(content='msg 1', transport_name='transport_2')
+        yield self.router.dispatch_inbound_message(msg)
+        route = yield self.router.route_memory.lookup(msg['message_id'])
+        self.assertEqual(route, 'transport_2')
+
+    @inlineCallbacks
+    def test_outbound_message_routing(self):
+        msg = self.mkmsg_in(content='msg 1', transport_name='transport_2')
+        yield self.router.dispatch_inbound_message(msg)
+        reply = self.mkmsg_out(content='reply', in_reply_to=msg['message_id'])
+        yield self.router.dispatch_outbound_message(reply)
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(publishers['transport_1'].msgs, [])
+        self.assertEqual(publishers['transport_2'].msgs, [reply])
+
+    @inlineCallbacks
+    def test_outbound_message_routing_prefers_helper_metadata(self):
+        yield self.router.route_memory.remember('msg X', 'transport_2')
+        msg = self.mkmsg_out(content='msg 1', in_reply_to='msg X')
+        self.router.push_transport_name(msg, 'transport_1')
+        yield self.router.dispatch_outbound_message(msg)
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(publishers['transport_1'].msgs, [msg])
+
+
 class TestLoadBalancingWithRewriteTransportNames(BaseLoadBalancingTestCase):
 
     rewrite_transport_names = True
@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
+import re
 import json
 from uuid import uuid4
 from datetime import datetime
@@ -12,16 +13,35 @@ from vumi.utils import to_kwargs
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# Anything `datetime.strptime` accepts for VUMI_DATE_FORMAT matches this, so
+# we can skip the (expensive) failed parse for most strings.
+VUMI_DATE_RE = re.compile(
+    r"\d{4}-\d\d?-\d\d?\s+\d\d?:\d\d?:\d\d?\.\d{1,6}\Z")
+
+
+def decode_date_time(value):
+    """
+    Return `value` as a datetime if it is a string in VUMI_DATE_FORMAT,
+    otherwise return it unchanged.
+    """
+    if not isinstance(value, basestring) or not VUMI_DATE_RE.match(value):
+        return value
+    try:
+        return datetime.strptime(value, VUMI_DATE_FORMAT)
+    except ValueError:
+        return value
+
+
+def encode_date_time(obj):
+    """JSON `default` hook that serializes datetimes in VUMI_DATE_FORMAT."""
+    if isinstance(obj, datetime):
+        return obj.strftime(VUMI_DATE_FORMAT)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
 
 def date_time_decoder(json_object):
     for key, value in json_object.items():
-        try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
-        except ValueError:
-            continue
-        except TypeError:
-            continue
+        json_object[key] = decode_date_time(value)
     return json_object
 
 
@@ -33,12 +53,65 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+class JSONMessageCodec(object):
+    """
+    Serializes message payloads to and from JSON.
+
+    :param json_module:
+        Module used for the actual JSON work. It must provide `dumps()` and
+        `loads()` compatible with the stdlib `json` module, as `simplejson`
+        does. Defaults to `json`.
+    :param date_time_fields:
+        If given, only these top-level fields are decoded as datetimes.
+        Otherwise any string value at any depth that is in VUMI_DATE_FORMAT
+        is decoded.
+    """
+
+    def __init__(self, json_module=None, date_time_fields=None):
+        if json_module is None:
+            json_module = json
+        if date_time_fields is not None:
+            date_time_fields = frozenset(date_time_fields)
+        self.json_module = json_module
+        self.date_time_fields = date_time_fields
+
+    def encode(self, obj):
+        return self.json_module.dumps(obj, default=encode_date_time)
+
+    def decode(self, json_string):
+        if self.date_time_fields is None:
+            return self.json_module.loads(
+                json_string, object_hook=date_time_decoder)
+        obj = self.json_module.loads(json_string)
+        if isinstance(obj, dict):
+            for field in self.date_time_fields.intersection(obj):
+                obj[field] = decode_date_time(obj[field])
+        return obj
+
+
+_message_codec = JSONMessageCodec()
+
+
+def get_message_codec():
+    return _message_codec
+
+
+def set_message_codec(codec):
+    """
+    Replace the codec used by `from_json()` and `to_json()` (and therefore
+    by all messages). Returns the previous codec.
+    """
+    global _message_codec
+    old_codec, _message_codec = _message_codec, codec
+    return old_codec
+
+
 def from_json(json_string):
-    return json.loads(json_string, object_hook=date_time_decoder)
+    return _message_codec.decode(json_string)
 
 
 def to_json(obj):
-    return json.dumps(obj, cls=JSONMessageEncoder)
+    return _message_codec.encode(obj)
 
 
 class Message(object):
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
+import hashlib
 from functools import wraps
 from itertools import takewhile, dropwhile
 
@@ -25,6 +26,24 @@ def maybe_async(func):
     return wrapper
 
 
+# Python implementations of Lua scripts, keyed by the script's SHA1.
+_script_emulations = {}
+
+
+def register_script_emulation(source, emulation):
+    """Register a Python function for :class:`FakeRedis` to call in place
+    of the given Lua script.
+
+    The function is called as `emulation(redis, keys, args)`, where `redis`
+    makes synchronous calls on the :class:`FakeRedis` instance.
+    """
+    _script_emulations[hashlib.sha1(source).hexdigest()] = emulation
+
+
+class ResponseError(Exception):
+    """An error returned by (fake) redis."""
+
+
 class FakeRedis(object):
     """In process and memory implementation of redis-like data store.
 
@@ -40,6 +59,7 @@ class FakeRedis(object):
     def __init__(self, charset='utf-8', errors='strict', async=False):
         self._data = {}
         self._expiries = {}
+        self._scripts = set()
         self._is_async = async
         self.clock = Clock()
         self._charset = charset
@@ -59,6 +79,9 @@ class FakeRedis(object):
             value = value.encode(self._charset, self._charset_errors)
         return value
 
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
     def _clean_up_expires(self):
         for key in self._expiries.keys():
             delayed = self._expiries.pop(key)
@@ -106,6 +129,11 @@ class FakeRedis(object):
         value = self._encode(value)  # set() sets string value
         self._data[key] = value
 
+    @maybe_async
+    def setex(self, key, seconds, value):
+        self.set.sync(self, key, value)
+        self.expire.sync(self, key, seconds)
+
     @maybe_async
     def setnx(self, key, value):
         value = self._encode(value)  # set() sets string value
@@ -395,6 +423,79 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Script operations
+
+    @maybe_async
+    def script_load(self, source):
+        sha1 = hashlib.sha1(source).hexdigest()
+        self._scripts.add(sha1)
+        return sha1
+
+    @maybe_async
+    def script_flush(self):
+        self._scripts.clear()
+
+    @maybe_async
+    def evalsha(self, sha1, numkeys, *keys_and_args):
+        if sha1 not in self._scripts:
+            raise ResponseError("NOSCRIPT No matching script."
+                                " Please use EVAL.")
+        emulation = _script_emulations.get(sha1)
+        if emulation is None:
+            raise NotImplementedError(
+                "No emulation registered for script %s" % (sha1,))
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        return emulation(_SyncCalls(self), keys, args)
+
+
+class FakeRedisPipeline(object):
+    """A pipeline for :class:`FakeRedis`.
+
+    Calls are queued and run together (and therefore atomically) when
+    `execute()` is called, which returns a list of their results.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+        self._commands = []
+
+    @property
+    def _is_async(self):
+        return self._fake_redis._is_async
+
+    @property
+    def clock(self):
+        return self._fake_redis.clock
+
+    def __getattr__(self, name):
+        func = getattr(getattr(self._fake_redis, name), 'sync', None)
+        if func is None:
+            raise AttributeError(name)
+
+        def queue_command(*args, **kw):
+            self._commands.append((func, args, kw))
+            return self
+        return queue_command
+
+    @maybe_async
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return [func(self._fake_redis, *args, **kw)
+                for func, args, kw in commands]
+
+
+class _SyncCalls(object):
+    """Makes synchronous calls on a :class:`FakeRedis`, regardless of
+    whether it is async or not.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+
+    def __getattr__(self, name):
+        func = getattr(self._fake_redis, name).sync
+        return lambda *args, **kw: func(self._fake_redis, *args, **kw)
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
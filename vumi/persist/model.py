@@ -4,6 +4,8 @@
 
 from functools import wraps
 
+from twisted.internet.defer import returnValue
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -12,6 +14,10 @@ class ModelMigrationError(VumiError):
     pass
 
 
+class IndexPagingError(VumiError):
+    pass
+
+
 class ModelMetaClass(type):
     def __new__(mcs, name, bases, dict):
         # set default bucket suffix
@@ -264,6 +270,20 @@ class Model(object):
         """
         return manager.load_all_bunches(cls, keys)
 
+    @classmethod
+    def load_all_bunches_concurrently(cls, manager, keys, concurrency=None,
+                                      ordered=True):
+        """Load batches of objects for the given list of keys, with several
+        batches being loaded at once.
+
+        See :meth:`Manager.load_all_bunches_concurrently`.
+
+        :returns:
+            An iterator over (possibly deferred) lists of model instances.
+        """
+        return manager.load_all_bunches_concurrently(
+            cls, keys, concurrency=concurrency, ordered=ordered)
+
     @classmethod
     def index_lookup(cls, manager, field_name, value):
         """Find objects by index.
@@ -272,6 +292,54 @@ class Model(object):
         """
         return manager.mr_from_field(cls, field_name, value)
 
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, end_value=None,
+                        max_results=None, continuation=None):
+        """Find a page of object keys by index, using a secondary index query
+        rather than a map-reduce.
+
+        :param int max_results:
+            The maximum number of keys to return in the page. All matching
+            keys are returned if this is `None`.
+        :param str continuation:
+            The continuation of a previous page, to fetch the page after it.
+
+        :returns:
+            (A deferred that fires with) a :class:`VumiIndexPage`.
+        """
+        index_name, start_value, end_value = (
+            VumiMapReduce._index_vals_for_field(
+                cls, field_name, value, end_value))
+        return manager.index_keys_page(
+            cls, index_name, start_value, end_value, max_results=max_results,
+            continuation=continuation)
+
+    @classmethod
+    def index_keys(cls, manager, field_name, value, end_value=None):
+        """Find object keys by index, fetching them a page at a time if
+        the manager has paging enabled.
+
+        :returns:
+            (A deferred that fires with) a list of keys.
+        """
+        index_name, start_value, end_value = (
+            VumiMapReduce._index_vals_for_field(
+                cls, field_name, value, end_value))
+        return manager.index_keys(cls, index_name, start_value, end_value)
+
+    @classmethod
+    def index_count(cls, manager, field_name, value, end_value=None):
+        """Count objects by index, fetching their keys a page at a time if
+        the manager has paging enabled.
+
+        :returns:
+            (A deferred that fires with) the number of matching objects.
+        """
+        index_name, start_value, end_value = (
+            VumiMapReduce._index_vals_for_field(
+                cls, field_name, value, end_value))
+        return manager.index_count(cls, index_name, start_value, end_value)
+
     @classmethod
     def index_match(cls, manager, query, field_name, value):
         """
@@ -477,17 +545,66 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class VumiIndexPage(object):
+    """A page of keys returned by a secondary index query.
+
+    Iterating over a page returns the keys in it. If there are more keys
+    to be fetched, :meth:`next_page` fetches the page after this one.
+    """
+
+    def __init__(self, manager, model, index_name, start_value, end_value,
+                 max_results, keys, continuation=None):
+        self._manager = manager
+        self._model = model
+        self._index_name = index_name
+        self._start_value = start_value
+        self._end_value = end_value
+        self._max_results = max_results
+        self.keys = keys
+        self.continuation = continuation
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+    def next_page(self):
+        """Fetch the page after this one.
+
+        :returns:
+            (A deferred that fires with) a :class:`VumiIndexPage`, or `None`
+            if this is the last page.
+        """
+        if not self.has_next_page():
+            return None
+        return self._manager.index_keys_page(
+            self._model, self._index_name, self._start_value,
+            self._end_value, max_results=self._max_results,
+            continuation=self.continuation)
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 4
+    DEFAULT_INDEX_PAGE_SIZE = None  # paged index queries are disabled
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, load_bunch_concurrency=None,
+                 index_page_size=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
+        self.load_bunch_concurrency = (load_bunch_concurrency or
+                                       self.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        self.index_page_size = (index_page_size or
+                                self.DEFAULT_INDEX_PAGE_SIZE)
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
         self._bucket_cache = {}
@@ -588,10 +705,134 @@ class Manager(object):
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
-        while keys:
-            batch_keys = keys[:self.load_bunch_size]
-            keys = keys[self.load_bunch_size:]
-            yield self._load_bunch(model, batch_keys)
+        for bunch_keys in self._bunch_keys(keys):
+            yield self._load_bunch(model, bunch_keys)
+
+    def load_all_bunches_concurrently(self, model, keys, concurrency=None,
+                                      ordered=True):
+        """Load batches of model instances for a list of keys from Riak,
+        with several batches being loaded at once.
+
+        Managers that can't load batches concurrently load them one at a
+        time, in order, like :meth:`load_all_bunches`.
+
+        :param int concurrency:
+            The maximum number of batches to be loading or waiting to be
+            consumed at once. Defaults to `load_bunch_concurrency`.
+        :param bool ordered:
+            If `True`, batches are returned in the order of `keys`.
+            Otherwise they're returned in the order they finish loading.
+
+        :returns:
+            An iterator over (possibly deferred) lists of model instances.
+        """
+        return self.load_all_bunches(model, keys)
+
+    def _bunch_keys(self, keys):
+        """Split a list of keys into lists of at most `load_bunch_size`."""
+        for i in xrange(0, len(keys), self.load_bunch_size):
+            yield keys[i:i + self.load_bunch_size]
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index.
+
+        :param int max_results:
+            The maximum number of keys to return in the page. All matching
+            keys are returned if this is `None`.
+        :param str continuation:
+            The continuation of a previous page, to fetch the page after it.
+
+        :returns:
+            (A deferred that fires with) a :class:`VumiIndexPage`.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .index_keys_page(...)")
+
+    def _index_paging_kw(self, max_results, continuation):
+        """Build the paging arguments for a client library index query.
+
+        These are left out when they aren't needed, so unpaged queries still
+        work with client libraries that don't support paging.
+        """
+        kw = {}
+        if max_results is not None:
+            kw['max_results'] = max_results
+        if continuation is not None:
+            kw['continuation'] = continuation
+        return kw
+
+    def _index_page(self, results, model, index_name, start_value, end_value,
+                    max_results):
+        """Wrap the results of a client library index query in a
+        :class:`VumiIndexPage`.
+
+        A full page without a continuation means that either Riak or the
+        client library doesn't support paging. Rather than silently
+        dropping the keys after the first page, we raise
+        :class:`IndexPagingError`.
+        """
+        keys = list(results)
+        continuation = getattr(results, 'continuation', None)
+        if (max_results is not None and continuation is None and
+                len(keys) >= max_results):
+            raise IndexPagingError(
+                "Index query for %r returned a full page of %s keys without a"
+                " continuation. Paged index queries need Riak 1.4 or later"
+                " and a client library that supports paging." % (
+                    index_name, len(keys)))
+        return VumiIndexPage(
+            self, model, index_name, start_value, end_value, max_results,
+            keys, continuation)
+
+    def index_keys(self, model, index_name, start_value, end_value=None):
+        """Fetch all the keys from a secondary index, `index_page_size` keys
+        at a time.
+
+        If `index_page_size` is `None`, paging is disabled and the keys are
+        fetched with a map-reduce instead.
+
+        :returns:
+            (A deferred that fires with) a list of keys.
+        """
+        if self.index_page_size is None:
+            return self.mr_from_index(
+                model, index_name, start_value, end_value).get_keys()
+
+        def add_keys(keys, page):
+            keys.extend(page)
+            return keys
+        return self.call_decorator(self._walk_index_pages)(
+            model, index_name, start_value, end_value, add_keys, [])
+
+    def index_count(self, model, index_name, start_value, end_value=None):
+        """Count the keys in a secondary index, `index_page_size` keys at a
+        time.
+
+        This avoids both a map-reduce and holding all the keys in memory at
+        once. If `index_page_size` is `None`, paging is disabled and the keys
+        are counted with a map-reduce instead.
+
+        :returns:
+            (A deferred that fires with) the number of keys.
+        """
+        if self.index_page_size is None:
+            return self.mr_from_index(
+                model, index_name, start_value, end_value).get_count()
+        return self.call_decorator(self._walk_index_pages)(
+            model, index_name, start_value, end_value,
+            lambda count, page: count + len(page), 0)
+
+    def _walk_index_pages(self, model, index_name, start_value, end_value,
+                          func, acc):
+        page = yield self.index_keys_page(
+            model, index_name, start_value, end_value,
+            max_results=self.index_page_size)
+        acc = func(acc, page)
+        while page.has_next_page():
+            page = yield page.next_page()
+            acc = func(acc, page)
+        returnValue(acc)
 
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
@@ -658,9 +899,22 @@ class ModelProxy(object):
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
+    def load_all_bunches_concurrently(self, *args, **kw):
+        return self._modelcls.load_all_bunches_concurrently(
+            self._manager, *args, **kw)
+
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
+    def index_keys_page(self, *args, **kw):
+        return self._modelcls.index_keys_page(self._manager, *args, **kw)
+
+    def index_keys(self, *args, **kw):
+        return self._modelcls.index_keys(self._manager, *args, **kw)
+
+    def index_count(self, *args, **kw):
+        return self._modelcls.index_count(self._manager, *args, **kw)
+
     def index_match(self, query, field_name, value):
         return self._modelcls.index_match(self._manager, query, field_name,
                                             value)
@@ -1,10 +1,11 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
 import os
+import hashlib
 from functools import wraps
 
 from vumi.persist.ast_magic import make_function
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, register_script_emulation
 
 
 def make_callfunc(name, redis_call):
@@ -44,6 +45,38 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class LuaScript(object):
+    """A Lua script to be run on the redis server with EVALSHA.
+
+    See :meth:`Manager.run_script`.
+
+    :param str source:
+        The Lua source of the script.
+    :param emulation:
+        A function used to run the script in place of Lua when the manager
+        is backed by a :class:`FakeRedis`. It is called as
+        `emulation(redis, keys, args)`, where `redis` makes synchronous
+        redis calls.
+    """
+
+    def __init__(self, source, emulation=None):
+        self.source = source
+        self.sha1 = hashlib.sha1(source).hexdigest()
+        if emulation is not None:
+            register_script_emulation(source, emulation)
+
+
+def is_noscript_error(err):
+    """Check whether an exception is redis telling us that it doesn't have
+    a script in its cache.
+    """
+    # Newer versions of redis-py strip the prefix off the message and
+    # raise a NoScriptError instead.
+    if type(err).__name__ == 'NoScriptError':
+        return True
+    return str(err).startswith('NOSCRIPT')
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
@@ -154,6 +187,50 @@ class Manager(object):
     def close_manager(self):
         return self._close()
 
+    def pipeline(self, transaction=False):
+        """Return a :class:`Pipeline` for batching redis calls.
+
+        Calls made on the pipeline are queued (with this manager's key prefix
+        applied) and sent together when its `execute()` method is called.
+
+        :param bool transaction:
+            If `True`, the queued calls are wrapped in MULTI/EXEC. Not all
+            managers support this, so code that is shared between managers
+            should use a Lua script where atomicity is required.
+        """
+        return Pipeline(self, transaction)
+
+    def run_script(self, script, keys=(), args=()):
+        """Run a :class:`LuaScript` on the redis server.
+
+        The script is run with EVALSHA and loaded into the server's script
+        cache with SCRIPT LOAD if it isn't already there.
+
+        :param LuaScript script:
+            The script to run.
+        :param list keys:
+            Keys to pass to the script as `KEYS`. This manager's key prefix
+            is applied to these.
+        :param list args:
+            Arguments to pass to the script as `ARGV`.
+        """
+        return self._run_script(
+            script, [self._key(key) for key in keys], list(args))
+
+    def _run_script(self, script, keys, args):
+        """Run a :class:`LuaScript` with already prefixed keys.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_script(...)")
+
+    def _execute_pipeline(self, calls, transaction):
+        """Send a list of `(call, args, kw)` tuples to redis in one batch.
+
+        Should return (a deferred that fires with) the list of results.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._execute_pipeline(...)")
+
     def _close(self):
         """Close redis connection."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -274,3 +351,54 @@ class Manager(object):
     expire = RedisCall(['key', 'seconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+
+
+class Pipeline(Manager):
+    """A batch of redis calls to be sent together.
+
+    This has the same redis call methods as the manager it was created from.
+    Each call is queued and returns the pipeline itself so that calls can be
+    chained. Use `execute()` to send the queued calls and get (a deferred
+    that fires with) a list of their results.
+
+    Example::
+
+      pipe = manager.pipeline()
+      pipe.hset('foo', 'bar', 'baz').sadd('foos', 'foo')
+      results = yield pipe.execute()
+    """
+
+    def __init__(self, manager, transaction=False):
+        super(Pipeline, self).__init__(
+            manager._client, manager._key_prefix, manager._key_separator)
+        self._manager = manager
+        self.transaction = transaction
+        self._calls = []
+        self._filters = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def pipeline(self, transaction=False):
+        raise NotImplementedError("Pipelines can't be nested.")
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw))
+        self._filters.append(None)
+        return self
+
+    def _filter_redis_results(self, func, results):
+        self._filters[-1] = func
+        return results
+
+    def _apply_filters(self, filters, results):
+        return [func(result) if func is not None else result
+                for func, result in zip(filters, results)]
+
+    def execute(self):
+        """Send all queued calls and return a list of their results."""
+        calls, self._calls = self._calls, []
+        filters, self._filters = self._filters, []
+        results = self._manager._execute_pipeline(calls, self.transaction)
+        return self._manager._filter_redis_results(
+            lambda results: self._apply_filters(filters, results), results)
@@ -2,7 +2,7 @@
 
 import redis
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, is_noscript_error
 from vumi.persist.fake_redis import FakeRedis
 from vumi.utils import flatten_generator
 
@@ -49,6 +49,25 @@ class RedisManager(Manager):
         """
         return getattr(self._client, call)(*args, **kw)
 
+    def _execute_pipeline(self, calls, transaction):
+        """Send a batch of redis calls using a client pipeline.
+        """
+        pipe = self._client.pipeline(transaction=transaction)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        return pipe.execute()
+
+    def _run_script(self, script, keys, args):
+        """Run a Lua script, loading it first if redis doesn't have it.
+        """
+        try:
+            return self._client.evalsha(script.sha1, len(keys), *(keys + args))
+        except Exception, e:
+            if not is_noscript_error(e):
+                raise
+        self._client.script_load(script.source)
+        return self._client.evalsha(script.sha1, len(keys), *(keys + args))
+
     def _filter_redis_results(self, func, results):
         """Filter results of a redis call.
         """
@@ -22,6 +22,10 @@ class RiakManager(Manager):
         bucket_prefix = config.pop('bucket_prefix')
         load_bunch_size = config.pop('load_bunch_size',
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        index_page_size = config.pop('index_page_size',
+                                     cls.DEFAULT_INDEX_PAGE_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
         transport_type = config.pop('transport_type', 'http')
@@ -53,7 +57,9 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency,
+                   index_page_size=index_page_size)
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -97,6 +103,15 @@ class RiakManager(Manager):
             riak_object = migrator(riak_object).get_riak_object()
         return None
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        bucket = self.bucket_for_modelcls(model)
+        results = bucket.get_index(
+            index_name, start_value, end_value,
+            **self._index_paging_kw(max_results, continuation))
+        return self._index_page(results, model, index_name, start_value,
+                                end_value, max_results)
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import (
+    FakeRedis, ResponseError, register_script_emulation)
 
 
 class FakeRedisTestCase(TestCase):
@@ -60,6 +63,12 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(False, 'setnx', "mykey", "other")
         yield self.assert_redis_op("value", 'get', "mykey")
 
+    @inlineCallbacks
+    def test_setex(self):
+        yield self.assert_redis_op(None, 'setex', "mykey", 10, "value")
+        yield self.assert_redis_op("value", 'get', "mykey")
+        yield self.assert_redis_op(9, 'ttl', "mykey")
+
     @inlineCallbacks
     def test_incr_with_by_param(self):
         yield self.redis.set("inc", 1)
@@ -314,6 +323,30 @@ class FakeRedisTestCase(TestCase):
         yield self.redis.hset("hash_key", "a", 1.0)
         yield self.assert_redis_op('hash', 'type', 'hash_key')
 
+    @inlineCallbacks
+    def test_evalsha(self):
+        source = "return {KEYS, ARGV}"
+        register_script_emulation(source, lambda redis, keys, args: [
+            list(keys), list(args)])
+        self.assertRaises(ResponseError, self.redis.evalsha,
+                          hashlib.sha1(source).hexdigest(), 0)
+        sha1 = yield self.redis.script_load(source)
+        self.assertEqual(hashlib.sha1(source).hexdigest(), sha1)
+        yield self.assert_redis_op([["k"], ["a", "b"]], 'evalsha',
+                                   sha1, 1, "k", "a", "b")
+        yield self.redis.script_flush()
+        self.assertRaises(ResponseError, self.redis.evalsha, sha1, 0)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        self.assertEqual(pipe, pipe.set("foo", "bar"))
+        pipe.incr("counter").get("foo")
+        yield self.assert_redis_op(None, 'get', "foo")
+        results = yield pipe.execute()
+        self.assertEqual([None, 1, "bar"], results)
+        yield self.assert_redis_op("bar", 'get', "foo")
+
 
 class FakeRedisCharsetHandlingTestCase(TestCase):
 
@@ -4,7 +4,7 @@ from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError)
+    Model, Manager, ModelMigrator, ModelMigrationError, IndexPagingError)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf,
     ForeignKey, ManyToMany)
@@ -321,6 +321,68 @@ class TestModelOnTxRiak(TestCase):
             ["foo1", "foo2"], lookup, 'b', u"one")
         yield self.assert_mapreduce_results(["foo3"], lookup, 'b', None)
 
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+        yield indexed_model("foo4", a=2, b=u"one").save()
+
+        page = yield indexed_model.index_keys_page('b', u"one")
+        self.assertEqual(["foo1", "foo2", "foo4"], sorted(page))
+        self.assertFalse(page.has_next_page())
+
+        page1 = yield indexed_model.index_keys_page('a', 1, max_results=2)
+        self.assertEqual(["foo1", "foo2"], list(page1))
+        self.assertTrue(page1.has_next_page())
+        page2 = yield page1.next_page()
+        self.assertEqual(["foo3"], list(page2))
+        self.assertFalse(page2.has_next_page())
+        self.assertEqual(None, page2.next_page())
+
+    @Manager.calls_manager
+    def test_index_keys_and_count(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+        yield indexed_model("foo4", a=2, b=u"one").save()
+        self.manager.index_page_size = 2
+
+        keys = yield indexed_model.index_keys('a', 1)
+        self.assertEqual(["foo1", "foo2", "foo3"], sorted(keys))
+        keys = yield indexed_model.index_keys('a', 1, 2)
+        self.assertEqual(["foo1", "foo2", "foo3", "foo4"], sorted(keys))
+        self.assertEqual(3, (yield indexed_model.index_count('a', 1)))
+        self.assertEqual(1, (yield indexed_model.index_count('b', None)))
+        self.assertEqual(0, (yield indexed_model.index_count('a', 3)))
+
+    @Manager.calls_manager
+    def test_index_keys_and_count_without_paging(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=2, b=u"one").save()
+        self.assertEqual(None, self.manager.index_page_size)
+
+        def no_paging(*args, **kw):
+            self.fail("Paged index query made with paging disabled.")
+        self.patch(self.manager, 'index_keys_page', no_paging)
+
+        keys = yield indexed_model.index_keys('a', 1)
+        self.assertEqual(["foo1", "foo2"], sorted(keys))
+        self.assertEqual(2, (yield indexed_model.index_count('a', 1)))
+        self.assertEqual(0, (yield indexed_model.index_count('a', 3)))
+
+    def test_index_page_full_without_continuation(self):
+        page = self.manager._index_page(
+            ["foo1"], IndexedModel, 'a_bin', '1', None, 2)
+        self.assertEqual(["foo1"], list(page))
+        self.assertRaises(
+            IndexPagingError, self.manager._index_page,
+            ["foo1", "foo2"], IndexedModel, 'a_bin', '1', None, 2)
+
     @Manager.calls_manager
     def test_index_match(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -2,7 +2,7 @@
 
 from twisted.trial.unittest import TestCase
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, LuaScript, is_noscript_error
 
 
 class ManagerTestCase(TestCase):
@@ -34,3 +34,30 @@ class ManagerTestCase(TestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+    def test_pipeline_queues_calls(self):
+        manager = self.mk_manager()
+        pipe = manager.pipeline()
+        self.assertEqual(pipe, pipe.set('foo', 'bar'))
+        pipe.keys().sadd('foos', 'foo')
+        self.assertEqual(3, len(pipe))
+        self.assertEqual([
+            ('set', ('test:foo', 'bar'), {}),
+            ('keys', ('test:*',), {}),
+            ('sadd', ('test:foos', 'foo'), {}),
+        ], pipe._calls)
+        self.assertEqual(pipe._unkeys, pipe._filters[1])
+
+    def test_pipeline_not_nested(self):
+        pipe = self.mk_manager().pipeline()
+        self.assertRaises(NotImplementedError, pipe.pipeline)
+
+    def test_lua_script(self):
+        script = LuaScript("return 1")
+        self.assertEqual("e0e1f9fabfc9d4800c877a703b823ac0578ff8db",
+                         script.sha1)
+
+    def test_is_noscript_error(self):
+        self.assertTrue(is_noscript_error(
+            Exception("NOSCRIPT No matching script. Please use EVAL.")))
+        self.assertFalse(is_noscript_error(Exception("ERR Error")))
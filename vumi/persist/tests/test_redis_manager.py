@@ -2,6 +2,7 @@
 
 from twisted.trial.unittest import TestCase
 
+from vumi.persist.redis_base import LuaScript
 from vumi.tests.utils import import_skip
 
 
@@ -38,3 +39,28 @@ class RedisManagerTestCase(TestCase):
         self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
+
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        pipe.set('foo', 'bar').sadd('foos', 'foo').keys()
+        results = pipe.execute()
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, results[1])
+        self.assertEqual(['foo', 'foos'], sorted(results[2]))
+        self.assertEqual(0, len(pipe))
+        self.assertEqual('bar', self.manager.get('foo'))
+        self.assertEqual(set(['foo']), self.manager.smembers('foos'))
+
+    def test_empty_pipeline(self):
+        self.assertEqual([], self.manager.pipeline().execute())
+
+    def test_run_script(self):
+        script = LuaScript(
+            "return redis.call('GET', KEYS[1]) .. ARGV[1]",
+            emulation=lambda redis, keys, args: redis.get(keys[0]) + args[0])
+        self.manager.set('foo', 'bar')
+        self.assertEqual('barbaz',
+                         self.manager.run_script(script, ['foo'], ['baz']))
+        self.manager.set('foo', 'quux')
+        self.assertEqual('quuxbaz',
+                         self.manager.run_script(script, ['foo'], ['baz']))
@@ -3,6 +3,7 @@
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
+from vumi.persist.redis_base import LuaScript
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -37,3 +38,36 @@ class RedisManagerTestCase(TestCase):
         yield self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], (yield self.manager.keys()))
         self.assertEqual('baz', (yield self.manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        pipe.set('foo', 'bar').sadd('foos', 'foo').keys()
+        results = yield pipe.execute()
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, results[1])
+        self.assertEqual(['foo', 'foos'], sorted(results[2]))
+        self.assertEqual(0, len(pipe))
+        self.assertEqual('bar', (yield self.manager.get('foo')))
+        self.assertEqual(set(['foo']), (yield self.manager.smembers('foos')))
+
+    @inlineCallbacks
+    def test_empty_pipeline(self):
+        results = yield self.manager.pipeline().execute()
+        self.assertEqual([], results)
+
+    def test_transactional_pipeline(self):
+        self.assertRaises(NotImplementedError, self.manager.pipeline,
+                          transaction=True)
+
+    @inlineCallbacks
+    def test_run_script(self):
+        script = LuaScript(
+            "return redis.call('GET', KEYS[1]) .. ARGV[1]",
+            emulation=lambda redis, keys, args: redis.get(keys[0]) + args[0])
+        yield self.manager.set('foo', 'bar')
+        self.assertEqual('barbaz', (yield self.manager.run_script(
+            script, ['foo'], ['baz'])))
+        yield self.manager.set('foo', 'quux')
+        self.assertEqual('quuxbaz', (yield self.manager.run_script(
+            script, ['foo'], ['baz'])))
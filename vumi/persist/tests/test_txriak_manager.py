@@ -1,7 +1,7 @@
 """Tests for vumi.persist.txriak_manager."""
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 
 from vumi.persist.model import Manager
 from vumi.tests.utils import import_skip
@@ -60,6 +60,7 @@ class CommonRiakManagerTests(object):
                          manager.DEFAULT_LOAD_BUNCH_SIZE)
         self.assertEqual(manager.mapreduce_timeout,
                          manager.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.assertEqual(manager.index_page_size, None)
 
     def test_from_config_with_bunch_size(self):
         manager_cls = self.manager.__class__
@@ -68,6 +69,20 @@ class CommonRiakManagerTests(object):
                                            })
         self.assertEqual(manager.load_bunch_size, 10)
 
+    def test_from_config_with_bunch_concurrency(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_bunch_concurrency': 10,
+                                           })
+        self.assertEqual(manager.load_bunch_concurrency, 10)
+
+    def test_from_config_with_index_page_size(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'index_page_size': 10,
+                                           })
+        self.assertEqual(manager.index_page_size, 10)
+
     def test_from_config_with_mapreduce_timeout(self):
         manager_cls = self.manager.__class__
         manager = manager_cls.from_config({'bucket_prefix': 'test.',
@@ -149,6 +164,38 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    @Manager.calls_manager
+    def test_load_all_bunches_concurrently(self):
+        keys = []
+        for i in range(7):
+            keys.append("key%s" % (i,))
+            yield self.manager.store(self.mkdummy(keys[-1], {"a": i}))
+        keys.insert(3, "unknown")
+        self.manager.load_bunch_size = 2
+
+        result_data = []
+        for result_bunch in self.manager.load_all_bunches_concurrently(
+                DummyModel, keys, concurrency=3):
+            bunch = yield result_bunch
+            bunch.sort(key=lambda result: result.key)
+            result_data.extend(result.get_data() for result in bunch)
+        self.assertEqual(result_data, [{"a": i} for i in range(7)])
+
+    @Manager.calls_manager
+    def test_load_all_bunches_concurrently_unordered(self):
+        for i in range(5):
+            yield self.manager.store(self.mkdummy("key%s" % (i,), {"a": i}))
+        self.manager.load_bunch_size = 2
+        keys = ["key%s" % (i,) for i in range(5)]
+
+        result_data = []
+        for result_bunch in self.manager.load_all_bunches_concurrently(
+                DummyModel, keys, ordered=False):
+            bunch = yield result_bunch
+            result_data.extend(result.get_data() for result in bunch)
+        result_data.sort(key=lambda d: d["a"])
+        self.assertEqual(result_data, [{"a": i} for i in range(5)])
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -249,3 +296,104 @@ class TestTxRiakManager(CommonRiakManagerTests, TestCase):
             })
         self.assertEqual(type(manager.client.transport),
             transport.HTTPTransport)
+
+
+class StubBunchManager(Manager):
+    """A manager whose bunches are loaded by firing deferreds by hand."""
+
+    def __init__(self, load_bunch_size):
+        super(StubBunchManager, self).__init__(
+            None, 'test.', load_bunch_size=load_bunch_size)
+        self.loading = {}
+
+    def _load_bunch(self, model, keys):
+        d = Deferred()
+        self.loading[tuple(keys)] = d
+        return d
+
+    def finish(self, *keys):
+        self.loading.pop(keys).callback(list(keys))
+
+
+class TestConcurrentBunchLoader(TestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import ConcurrentBunchLoader
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.loader_class = ConcurrentBunchLoader
+        self.manager = StubBunchManager(2)
+
+    def result_of(self, d):
+        results = []
+        d.addBoth(results.append)
+        [result] = results
+        return result
+
+    def mk_loader(self, keys, concurrency, ordered=True):
+        return self.loader_class(
+            self.manager, DummyModel, keys, concurrency, ordered)
+
+    def test_ordered(self):
+        loader = self.mk_loader(list('abcde'), 2)
+        d1 = loader.next()
+        self.assertEqual(
+            sorted(self.manager.loading), [('a', 'b'), ('c', 'd')])
+        self.manager.finish('c', 'd')
+        self.manager.finish('a', 'b')
+        self.assertEqual(['a', 'b'], self.result_of(d1))
+        # Nothing more is loaded until we ask for the next bunch.
+        self.assertEqual({}, self.manager.loading)
+        d2 = loader.next()
+        self.assertEqual(['c', 'd'], self.result_of(d2))
+        self.assertEqual([('e',)], self.manager.loading.keys())
+        d3 = loader.next()
+        self.manager.finish('e')
+        self.assertEqual(['e'], self.result_of(d3))
+        self.assertRaises(StopIteration, loader.next)
+
+    def test_unordered(self):
+        loader = self.mk_loader(list('abcde'), 2, ordered=False)
+        d1 = loader.next()
+        self.assertEqual(
+            sorted(self.manager.loading), [('a', 'b'), ('c', 'd')])
+        self.manager.finish('c', 'd')
+        self.assertEqual(['c', 'd'], self.result_of(d1))
+        d2 = loader.next()
+        self.assertEqual(
+            sorted(self.manager.loading), [('a', 'b'), ('e',)])
+        self.manager.finish('e')
+        self.assertEqual(['e'], self.result_of(d2))
+        d3 = loader.next()
+        self.manager.finish('a', 'b')
+        self.assertEqual(['a', 'b'], self.result_of(d3))
+        self.assertRaises(StopIteration, loader.next)
+
+    def test_unordered_loaded_before_asked_for(self):
+        loader = self.mk_loader(list('abcd'), 2, ordered=False)
+        d1 = loader.next()
+        self.manager.finish('a', 'b')
+        self.manager.finish('c', 'd')
+        self.assertEqual(['a', 'b'], self.result_of(d1))
+        self.assertEqual(['c', 'd'], self.result_of(loader.next()))
+        self.assertRaises(StopIteration, loader.next)
+
+    def test_unordered_failure(self):
+        loader = self.mk_loader(list('ab'), 1, ordered=False)
+        d = loader.next()
+        self.manager.loading.pop(('a', 'b')).errback(ValueError("Bad."))
+        self.assertTrue(self.result_of(d).check(ValueError))
+        self.assertRaises(StopIteration, loader.next)
+
+    def test_close(self):
+        loader = self.mk_loader(list('abcde'), 2)
+        d1 = loader.next()
+        self.manager.finish('a', 'b')
+        self.assertEqual(['a', 'b'], self.result_of(d1))
+        loader.close()
+        # The bunch we didn't ask for is discarded without its error being
+        # logged and nothing more is loaded.
+        self.manager.loading.pop(('c', 'd')).errback(ValueError("Bad."))
+        self.assertRaises(StopIteration, loader.next)
+        self.assertEqual({}, self.manager.loading)
@@ -13,9 +13,9 @@ except ImportError:
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, Deferred, maybeDeferred)
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, is_noscript_error
 from vumi.persist.fake_redis import FakeRedis
 
 
@@ -85,6 +85,17 @@ class VumiRedis(txr.Redis):
                                             in results if success]))
         return d
 
+    # These match the redis-py API. script_load() doesn't exist in txredis
+    # 2.2 and its evalsha() takes keys and args as separate lists.
+
+    def evalsha(self, sha1, numkeys, *keys_and_args):
+        self._send('EVALSHA', sha1, numkeys, *keys_and_args)
+        return self.getResponse()
+
+    def script_load(self, source):
+        self._send('SCRIPT', 'LOAD', source)
+        return self.getResponse()
+
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
                                              withscores=withscores,
@@ -116,6 +127,13 @@ class TxRedisManager(Manager):
         manager._close = fake_redis.teardown
         return succeed(manager)
 
+    def pipeline(self, transaction=False):
+        if transaction:
+            raise NotImplementedError(
+                "TxRedisManager doesn't support transactional pipelines."
+                " Use a Lua script where atomicity is required.")
+        return super(TxRedisManager, self).pipeline(transaction)
+
     @classmethod
     def _manager_from_config(cls, config, key_prefix, key_separator):
         """Construct a manager from a dictionary of options.
@@ -157,6 +175,38 @@ class TxRedisManager(Manager):
         """
         return getattr(self._client, call)(*args, **kw)
 
+    def _execute_pipeline(self, calls, transaction):
+        """Send a batch of redis calls without waiting for each response.
+
+        txredis writes each command as soon as it is called and matches up
+        responses in order, so this costs a single round trip. The client
+        connection is shared, so we can't safely wrap the calls in
+        MULTI/EXEC and :meth:`pipeline` refuses transactional pipelines.
+        """
+        deferreds = [self._make_redis_call(call, *args, **kw)
+                     for call, args, kw in calls]
+        d = DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda results: [result for _, result in results])
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    def _run_script(self, script, keys, args):
+        """Run a Lua script, loading it first if redis doesn't have it.
+        """
+        def evalsha():
+            return self._client.evalsha(
+                script.sha1, len(keys), *(keys + args))
+
+        def load_and_retry(failure):
+            if not is_noscript_error(failure.value):
+                return failure
+            d = maybeDeferred(self._client.script_load, script.source)
+            return d.addCallback(lambda _: evalsha())
+
+        d = maybeDeferred(evalsha)
+        d.addErrback(load_and_retry)
+        return d
+
     def _filter_redis_results(self, func, results):
         """Filter results of a redis call.
         """
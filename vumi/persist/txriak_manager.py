@@ -2,14 +2,108 @@
 
 """A manager implementation on top of txriak."""
 
+from collections import deque
+
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
 from riakasaurus import transport
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred, succeed)
+    Deferred, inlineCallbacks, gatherResults, maybeDeferred, succeed, fail)
+from twisted.python.failure import Failure
 
 from vumi.persist.model import Manager
 
 
+class ConcurrentBunchLoader(object):
+    """An iterator over deferred bunches of model instances that loads
+    several bunches at once.
+
+    A bunch is only started when there is room for it, so at most
+    `concurrency` bunches are being loaded or waiting to be consumed at any
+    time. A consumer that is slow to ask for the next bunch therefore holds
+    up loading rather than letting loaded bunches pile up in memory.
+
+    If `ordered` is `True`, the deferreds returned fire with bunches in the
+    order of the keys. Otherwise each deferred fires with the next bunch to
+    finish loading.
+    """
+
+    def __init__(self, manager, model, keys, concurrency, ordered=True):
+        self._load_bunch = lambda bunch_keys: maybeDeferred(
+            manager._load_bunch, model, bunch_keys)
+        self._bunch_keys = manager._bunch_keys(keys)
+        self.concurrency = concurrency
+        self.ordered = ordered
+        # Deferreds for bunches, in key order. Only used if ordered.
+        self._pending = deque()
+        # The number of bunches loading, the results of those that have
+        # finished and the deferreds waiting for those that haven't. Only
+        # used if unordered.
+        self._loading = 0
+        self._loaded = deque()
+        self._waiting = deque()
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        """Stop loading bunches and discard any that haven't been consumed.
+        """
+        self._bunch_keys = iter([])
+        while self._pending:
+            # Nobody is going to consume these, so don't log their errors.
+            self._pending.popleft().addErrback(lambda f: None)
+        self._loaded.clear()
+
+    def next(self):
+        if self.ordered:
+            return self._next_ordered()
+        return self._next_unordered()
+
+    def _start_bunches(self, in_use):
+        started = []
+        while in_use + len(started) < self.concurrency:
+            bunch_keys = next(self._bunch_keys, None)
+            if bunch_keys is None:
+                break
+            started.append(self._load_bunch(bunch_keys))
+        return started
+
+    def _next_ordered(self):
+        self._pending.extend(self._start_bunches(len(self._pending)))
+        if not self._pending:
+            raise StopIteration()
+        return self._pending.popleft()
+
+    def _next_unordered(self):
+        # Deferreds we've already handed out will take bunches that are
+        # still loading, so don't count those against the limit.
+        in_use = self._loading + len(self._loaded) - len(self._waiting)
+        for d in self._start_bunches(in_use):
+            self._loading += 1
+            d.addBoth(self._bunch_loaded)
+        if self._loaded:
+            result = self._loaded.popleft()
+            if isinstance(result, Failure):
+                return fail(result)
+            return succeed(result)
+        if self._loading > len(self._waiting):
+            d = Deferred()
+            self._waiting.append(d)
+            return d
+        raise StopIteration()
+
+    def _bunch_loaded(self, result):
+        self._loading -= 1
+        if self._waiting:
+            d = self._waiting.popleft()
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        else:
+            self._loaded.append(result)
+
+
 class TxRiakManager(Manager):
     """A persistence manager for txriak."""
 
@@ -21,6 +115,10 @@ class TxRiakManager(Manager):
         bucket_prefix = config.pop('bucket_prefix')
         load_bunch_size = config.pop('load_bunch_size',
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        index_page_size = config.pop('index_page_size',
+                                     cls.DEFAULT_INDEX_PAGE_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
         transport_type = config.pop('transport_type', 'http')
@@ -41,7 +139,9 @@ class TxRiakManager(Manager):
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency,
+                   index_page_size=index_page_size)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -119,6 +219,22 @@ class TxRiakManager(Manager):
 
         return d.addCallback(build_model_object)
 
+    def load_all_bunches_concurrently(self, model, keys, concurrency=None,
+                                      ordered=True):
+        if concurrency is None:
+            concurrency = self.load_bunch_concurrency
+        return ConcurrentBunchLoader(self, model, keys, concurrency, ordered)
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        bucket = self.bucket_for_modelcls(model)
+        d = bucket.get_index(
+            index_name, start_value, end_value,
+            **self._index_paging_kw(max_results, continuation))
+        d.addCallback(self._index_page, model, index_name, start_value,
+                      end_value, max_results)
+        return d
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -0,0 +1,106 @@
+import sys
+import time
+from datetime import datetime
+from twisted.python import usage
+
+from vumi.message import (
+    TransportUserMessage, JSONMessageCodec, VUMI_DATE_FORMAT, to_json)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to encode and decode with each codec."],
+        ["metadata-fields", "f", "20",
+         "Number of fields in the message's helper and transport metadata."],
+    ]
+
+    longdesc = """Benchmarks vumi.message.JSONMessageCodec"""
+
+
+class NaiveJSONMessageCodec(JSONMessageCodec):
+    """
+    Decodes datetimes the way `vumi.message.from_json()` used to, by trying
+    `strptime()` on every value.
+    """
+
+    def decode(self, json_string):
+        return self.json_module.loads(json_string, object_hook=self.decoder)
+
+    def decoder(self, json_object):
+        for key, value in json_object.items():
+            try:
+                json_object[key] = datetime.strptime(value, VUMI_DATE_FORMAT)
+            except (ValueError, TypeError):
+                continue
+        return json_object
+
+
+class CodecBenchmark(object):
+    """
+    Encodes and decodes the same message with various codecs.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.metadata_fields = int(options['metadata-fields'])
+
+    def make_message(self):
+        metadata = dict(("field%d" % i, "value %d" % i)
+                        for i in range(self.metadata_fields))
+        return TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="Some content",
+            helper_metadata={'bench': metadata},
+            transport_metadata={'bench': metadata})
+
+    def get_codecs(self):
+        codecs = [
+            ("naive", NaiveJSONMessageCodec()),
+            ("default", JSONMessageCodec()),
+            ("timestamp only", JSONMessageCodec(
+                date_time_fields=['timestamp'])),
+        ]
+        try:
+            import simplejson
+        except ImportError:
+            print "simplejson not installed, skipping simplejson codecs."
+        else:
+            codecs.extend([
+                ("simplejson", JSONMessageCodec(json_module=simplejson)),
+                ("simplejson timestamp only", JSONMessageCodec(
+                    json_module=simplejson, date_time_fields=['timestamp'])),
+            ])
+        return codecs
+
+    def bench_codec(self, name, codec, msg_json):
+        start = time.time()
+        for _ in xrange(self.messages):
+            obj = codec.decode(msg_json)
+        decode_time = time.time() - start
+
+        start = time.time()
+        for _ in xrange(self.messages):
+            codec.encode(obj)
+        encode_time = time.time() - start
+
+        print "%s: decode %.2f msgs/s, encode %.2f msgs/s" % (
+            name, self.messages / decode_time, self.messages / encode_time)
+
+    def run(self):
+        msg_json = to_json(self.make_message().payload)
+        print "Message size: %d bytes" % len(msg_json)
+        for name, codec in self.get_codecs():
+            self.bench_codec(name, codec, msg_json)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    CodecBenchmark(options).run()
@@ -17,6 +17,10 @@ class Options(usage.Options):
          "Total number of messages to write and read back."],
         ["concurrent-messages", "c", "100",
          "Number of messages to read and write concurrently"],
+        ["bunch-size", "b", "100",
+         "Number of messages in each bunch when loading bunches."],
+        ["bunch-concurrency", "n", "4",
+         "Number of bunches to load concurrently."],
     ]
 
     longdesc = """Benchmarks vumi.persist.model.Model"""
@@ -34,6 +38,8 @@ class WriteReadBenchmark(object):
     def __init__(self, options):
         self.messages = int(options['messages'])
         self.concurrent = int(options['concurrent-messages'])
+        self.bunch_size = int(options['bunch-size'])
+        self.bunch_concurrency = int(options['bunch-concurrency'])
 
     def make_batches(self):
         num_batches, rem = divmod(self.messages, self.concurrent)
@@ -64,9 +70,40 @@ class WriteReadBenchmark(object):
             deferreds.append(model.load(msg['message_id']))
         return DeferredList(deferreds)
 
+    @inlineCallbacks
+    def read_bunches(self, name, bunches, keys):
+        start = time.time()
+        loaded = 0
+        for bunch_d in bunches:
+            bunch = yield bunch_d
+            loaded += len([msg_obj for msg_obj in bunch if msg_obj])
+        elapsed = time.time() - start
+        if loaded != len(keys):
+            raise RuntimeError("%s loaded %d of %d messages" % (
+                name, loaded, len(keys)))
+        print "%s bunch read took %.2f seconds (%.2f msgs/s)" % (
+                name, elapsed, loaded / elapsed)
+
+    @inlineCallbacks
+    def run_bunches(self, model, keys):
+        print "Reading in bunches of %d, %d bunches at a time." % (
+            self.bunch_size, self.bunch_concurrency)
+        yield self.read_bunches(
+            "Serial", model.load_all_bunches(keys), keys)
+        yield self.read_bunches(
+            "Concurrent ordered", model.load_all_bunches_concurrently(
+                keys, concurrency=self.bunch_concurrency), keys)
+        yield self.read_bunches(
+            "Concurrent unordered", model.load_all_bunches_concurrently(
+                keys, concurrency=self.bunch_concurrency, ordered=False),
+            keys)
+
     @inlineCallbacks
     def run(self):
-        manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
+        manager = TxRiakManager.from_config({
+            'bucket_prefix': 'test.bench.',
+            'load_bunch_size': self.bunch_size,
+        })
         model = manager.proxy(MessageModel)
         yield manager.purge_all()
 
@@ -103,6 +140,10 @@ class WriteReadBenchmark(object):
 
         print "Messages retrieved successfully."
 
+        yield self.run_bunches(
+            model, [msg['message_id'] for batch in msg_batches
+                    for msg in batch])
+
         yield manager.purge_all()
         print "Messages purged."
 
@@ -0,0 +1,97 @@
+import sys
+import time
+import binascii
+from twisted.python import usage
+
+from smpp.pdu_builder import DeliverSM
+
+from vumi.transports.smpp.clientserver.framing import PDUBuffer
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["pdus", "p", "5000",
+         "Number of deliver_sm PDUs in each burst."],
+        ["bursts", "b", "5",
+         "Number of bursts to feed through each framer."],
+        ["read-size", "r", "65536",
+         "Number of bytes handed to the framer per read."],
+    ]
+
+    longdesc = """Benchmarks SMPP PDU framing of bursts of deliver_sm PDUs"""
+
+
+class StringFramer(object):
+    """
+    Splits PDUs off the front of a string the way `EsmeTransceiver` and
+    `SmscServer` used to.
+    """
+
+    def __init__(self):
+        self.datastream = ''
+
+    def feed(self, data):
+        self.datastream += data
+
+    def pop_pdus(self):
+        pdus = []
+        while len(self.datastream) >= 16:
+            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
+            if len(self.datastream) < command_length:
+                break
+            pdus.append(self.datastream[0:command_length])
+            self.datastream = self.datastream[command_length:]
+        return pdus
+
+
+class FramingBenchmark(object):
+    """
+    Feeds bursts of deliver_sm PDUs through various framers.
+    """
+
+    def __init__(self, options):
+        self.pdus = int(options['pdus'])
+        self.bursts = int(options['bursts'])
+        self.read_size = int(options['read-size'])
+
+    def make_burst(self):
+        return ''.join(
+            DeliverSM(i + 1, short_message="Message number %d" % i).get_bin()
+            for i in xrange(self.pdus))
+
+    def get_framers(self):
+        return [
+            ("string", StringFramer),
+            ("bytearray", PDUBuffer),
+        ]
+
+    def bench_framer(self, name, framer_class, burst):
+        framer = framer_class()
+        popped = 0
+        start = time.time()
+        for _ in xrange(self.bursts):
+            for i in xrange(0, len(burst), self.read_size):
+                framer.feed(burst[i:i + self.read_size])
+                popped += len(framer.pop_pdus())
+        elapsed = time.time() - start
+        assert popped == self.pdus * self.bursts
+        print "%s: %.2f PDUs/s" % (name, popped / elapsed)
+
+    def run(self):
+        burst = self.make_burst()
+        print "Burst size: %d PDUs, %d bytes, read size: %d bytes" % (
+            self.pdus, len(burst), self.read_size)
+        for name, framer_class in self.get_framers():
+            self.bench_framer(name, framer_class, burst)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    FramingBenchmark(options).run()
@@ -1,12 +1,15 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+from collections import deque
 from copy import deepcopy
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed, Deferred,
+    DeferredSemaphore)
 from twisted.internet import protocol, reactor
 from twisted.web.resource import Resource
 import txamqp
@@ -75,6 +78,9 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
 
 
 class WorkerAMQClient(AMQClient):
+
+    _binding_caches = None
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -142,6 +148,19 @@ class WorkerAMQClient(AMQClient):
         # return the newly created & consuming consumer
         returnValue(consumer)
 
+    def get_binding_cache(self, publisher):
+        """
+        Return the binding cache shared by all publishers on this client
+        that publish to the same exchange.
+        """
+        if self._binding_caches is None:
+            self._binding_caches = {}
+        exchange_name = publisher.exchange_name
+        if exchange_name not in self._binding_caches:
+            self._binding_caches[exchange_name] = BindingCache(
+                publisher.list_bindings)
+        return self._binding_caches[exchange_name]
+
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
@@ -150,6 +169,7 @@ class WorkerAMQClient(AMQClient):
         # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
+        publisher.binding_cache = self.get_binding_cache(publisher)
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
         # start!
@@ -204,7 +224,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, concurrency=1,
+                ordering_key=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -217,6 +238,8 @@ class Worker(MultiService, object):
             'exchange_type': exchange_type,
             'durable': durable,
             'start_paused': paused,
+            'concurrency': concurrency,
+            'ordering_key': ordering_key,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -287,6 +310,16 @@ class Consumer(object):
     message_class = Message
     start_paused = False
 
+    # The maximum number of messages processed at the same time. With the
+    # default of 1, each message is fully processed (and acked) before the
+    # next is read from the queue.
+    concurrency = 1
+    # If set, messages sharing the same value for this field (e.g.
+    # ``from_addr``) are processed strictly in the order they arrive, even
+    # when ``concurrency`` allows other messages to be processed in
+    # parallel.
+    ordering_key = None
+
     @inlineCallbacks
     def start(self, channel, queue):
         self.channel = channel
@@ -294,17 +327,27 @@ class Consumer(object):
         self.keep_consuming = True
         self._testing = hasattr(channel, 'message_processed')
         self.paused = self.start_paused
+        self._in_flight = DeferredSemaphore(self.concurrency)
+        self._ordered_pending = {}
 
         @inlineCallbacks
         def read_messages():
             log.msg("Consumer starting...")
             try:
                 while self.keep_consuming:
+                    yield self._in_flight.acquire()
                     message = yield self.queue.get()
                     if isinstance(message, QueueCloseMarker):
+                        self._in_flight.release()
                         log.msg("Queue closed.")
                         return
-                    yield self.consume(message)
+                    if self.concurrency > 1:
+                        self._consume_in_flight(message)
+                    else:
+                        try:
+                            yield self.consume(message)
+                        finally:
+                            self._in_flight.release()
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
 
@@ -312,6 +355,56 @@ class Consumer(object):
         yield None
         returnValue(self)
 
+    def _consume_in_flight(self, message):
+        """
+        Process a message without blocking the read loop.
+
+        The in-flight slot acquired for this message is released once it
+        has been processed, whether or not processing succeeded.
+        """
+        d = maybeDeferred(self.decode_message, message)
+        d.addCallback(self._consume_decoded, message)
+        d.addErrback(lambda f: log.err(f, "Error consuming message"))
+        d.addBoth(lambda _: self._in_flight.release())
+        return d
+
+    def _consume_decoded(self, vumi_message, message):
+        key = self.get_ordering_key(vumi_message)
+        if key is None:
+            return self.consume(message, vumi_message)
+        d = Deferred()
+        pending = self._ordered_pending.get(key)
+        if pending is not None:
+            # Another message with this key is still being processed, so
+            # this one has to wait its turn.
+            pending.append((message, vumi_message, d))
+        else:
+            self._ordered_pending[key] = deque()
+            self._consume_ordered(key, message, vumi_message, d)
+        return d
+
+    def _consume_ordered(self, key, message, vumi_message, done):
+        def consume_next(result):
+            pending = self._ordered_pending[key]
+            if pending:
+                self._consume_ordered(key, *pending.popleft())
+            else:
+                del self._ordered_pending[key]
+            return result
+
+        d = maybeDeferred(self.consume, message, vumi_message)
+        d.addBoth(consume_next)
+        d.chainDeferred(done)
+
+    def get_ordering_key(self, vumi_message):
+        """
+        Return the key used to serialise processing of related messages or
+        ``None`` if the message may be processed in any order.
+        """
+        if self.ordering_key is None:
+            return None
+        return vumi_message.get(self.ordering_key)
+
     def pause(self):
         self.paused = True
         return self.channel.channel_flow(active=False)
@@ -320,10 +413,14 @@ class Consumer(object):
         self.paused = False
         return self.channel.channel_flow(active=True)
 
+    def decode_message(self, message):
+        return self.message_class.from_json(message.content.body)
+
     @inlineCallbacks
-    def consume(self, message):
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
+    def consume(self, message, vumi_message=None):
+        if vumi_message is None:
+            vumi_message = self.decode_message(message)
+        result = yield self.consume_message(vumi_message)
         if self._testing:
             self.channel.message_processed()
         if result is not False:
@@ -337,7 +434,10 @@ class Consumer(object):
         log.msg("Received message: %s" % message)
 
     def ack(self, message):
-        self.channel.basic_ack(message.delivery_tag, True)
+        # When messages are processed concurrently they may complete out of
+        # order, so we can't ack everything up to this delivery tag.
+        multiple = (self.concurrency == 1)
+        self.channel.basic_ack(message.delivery_tag, multiple)
 
     @inlineCallbacks
     def stop(self):
@@ -367,6 +467,109 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class BindingCache(object):
+    """
+    Cache of the routing keys bound to an exchange.
+
+    Bindings are fetched by calling `fetch_bindings`, which should return
+    (a deferred that fires with) a dict keyed by routing key. Known routing
+    keys are answered from the cache and a refresh is started in the
+    background once the cache is older than `ttl` seconds, so publishing a
+    known routing key never waits on a fetch.
+
+    Only unknown routing keys wait for a refresh. All lookups share a single
+    in-flight refresh and routing keys that are still unbound afterwards are
+    remembered for `negative_ttl` seconds. A lookup waits for at most one
+    refresh, so a lookup made while the first bindings are being fetched
+    doesn't trigger a second fetch.
+    """
+
+    UNDETECTED = {"bindings": "undetected"}
+
+    def __init__(self, fetch_bindings, ttl=60, negative_ttl=5, clock=None):
+        if clock is None:
+            clock = reactor
+        self.fetch_bindings = fetch_bindings
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.bindings = None
+        self.refreshed_at = None
+        self._unbound = {}
+        self._refresh_waiters = []
+
+    def bindings_detected(self):
+        return self.bindings is not None and self.bindings != self.UNDETECTED
+
+    def is_stale(self):
+        if self.refreshed_at is None:
+            return True
+        return self.clock.seconds() - self.refreshed_at >= self.ttl
+
+    def refresh(self):
+        """
+        Refresh the cached bindings.
+
+        If a refresh is already in flight, this waits for it instead of
+        starting a new one. The returned deferred fires with `None` once
+        the refresh is complete.
+        """
+        d = Deferred()
+        self._refresh_waiters.append(d)
+        if len(self._refresh_waiters) == 1:
+            fetch_d = maybeDeferred(self.fetch_bindings)
+            fetch_d.addCallback(self._update_bindings)
+            fetch_d.addErrback(lambda f: log.err(
+                f, "Error fetching routing key bindings"))
+            fetch_d.addBoth(self._notify_refresh_waiters)
+        return d
+
+    def _update_bindings(self, bindings):
+        now = self.clock.seconds()
+        self.bindings = bindings
+        self.refreshed_at = now
+        for key, expiry in self._unbound.items():
+            if expiry <= now:
+                del self._unbound[key]
+
+    def _notify_refresh_waiters(self, _result):
+        waiters, self._refresh_waiters = self._refresh_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _lookup(self, routing_key):
+        if not self.bindings_detected():
+            # The following is very noisy in the logs:
+            # log.msg("No bindings detected, is the RabbitMQ Management"
+            #         " plugin installed?")
+            return True
+        if routing_key in self.bindings:
+            return True
+        if self._unbound.get(routing_key, 0) > self.clock.seconds():
+            return False
+        return None
+
+    @inlineCallbacks
+    def is_bound(self, routing_key):
+        refreshed = False
+        if self.bindings is None:
+            yield self.refresh()
+            refreshed = True
+        elif self.is_stale():
+            # Refresh in the background and answer from what we have.
+            self.refresh()
+
+        is_bound = self._lookup(routing_key)
+        if is_bound is None and not refreshed:
+            yield self.refresh()
+            is_bound = self._lookup(routing_key)
+        if is_bound is None:
+            self._unbound[routing_key] = (
+                self.clock.seconds() + self.negative_ttl)
+            is_bound = False
+        returnValue(is_bound)
+
+
 class Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -379,11 +582,12 @@ class Publisher(object):
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
-        self.bound_routing_keys = {}
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
+        if not hasattr(self, 'binding_cache'):
+            self.binding_cache = BindingCache(self.list_bindings)
 
     @inlineCallbacks
     def list_bindings(self):
@@ -406,10 +610,9 @@ class Publisher(object):
                             bound_routing_keys.get(b['routing_key'], []) + \
                             [b['destination']]
         except:
-            bound_routing_keys = {"bindings": "undetected"}
+            bound_routing_keys = dict(BindingCache.UNDETECTED)
         returnValue(bound_routing_keys)
 
-    @inlineCallbacks
     def routing_key_is_bound(self, key):
         # Don't check for bound routing keys on RPC reply exchanges
         # The one-use queues are changing too frequently to cache efficiently,
@@ -417,23 +620,8 @@ class Publisher(object):
         # and the auto-generated queues & routing_keys are unlikley to
         # result in errors where routing keys are unbound
         if self.exchange_name[-4:].lower() == '_rpc':
-            returnValue(True)
-        if (len(self.bound_routing_keys) == 1 and
-                self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        if key in self.bound_routing_keys.keys():
-            returnValue(True)
-        self.bound_routing_keys = yield self.list_bindings()
-        if (len(self.bound_routing_keys) == 1 and
-                self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        returnValue(key in self.bound_routing_keys.keys())
+            return succeed(True)
+        return self.binding_cache.is_bound(key)
 
     @inlineCallbacks
     def check_routing_key(self, routing_key, require_bind):
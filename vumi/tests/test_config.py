@@ -3,7 +3,7 @@ from twisted.trial.unittest import TestCase
 from vumi.errors import ConfigError
 from vumi.config import (
     Config, ConfigField, ConfigText, ConfigInt, ConfigFloat, ConfigBool,
-    ConfigList, ConfigDict, ConfigUrl)
+    ConfigList, ConfigDict, ConfigUrl, ConfigCache)
 
 
 class ConfigTest(TestCase):
@@ -288,3 +288,42 @@ class ConfigFieldTest(TestCase):
         self.assertEqual(None, self.field_value(field))
         self.assert_field_invalid(field, object())
         self.assert_field_invalid(field, 1)
+
+
+class ConfigCacheTest(TestCase):
+    class FooConfig(Config):
+        "Test config."
+        foo = ConfigInt("foo")
+
+    def test_get_builds_config_once(self):
+        cache = ConfigCache(self.FooConfig)
+        calls = []
+
+        def get_config_data():
+            calls.append(1)
+            return {'foo': 1}
+
+        conf1 = cache.get('key', get_config_data)
+        conf2 = cache.get('key', get_config_data)
+        self.assertEqual(conf1.foo, 1)
+        self.assertTrue(conf1 is conf2)
+        self.assertEqual(calls, [1])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_get_evicts_least_recently_used(self):
+        cache = ConfigCache(self.FooConfig, max_size=2)
+        conf_a = cache.get('a', lambda: {'foo': 1})
+        cache.get('b', lambda: {'foo': 2})
+        cache.get('a', lambda: {'foo': 1})
+        cache.get('c', lambda: {'foo': 3})
+        self.assertTrue(cache.get('a', lambda: {'foo': 1}) is conf_a)
+        self.assertEqual(cache.get('b', lambda: {'foo': 4}).foo, 4)
+
+    def test_get_invalid_config_not_cached(self):
+        cache = ConfigCache(self.FooConfig)
+        self.assertRaises(ConfigError, cache.get, 'key',
+                          lambda: {'foo': 'bar'})
+        self.assertEqual(cache.get('key', lambda: {'foo': 1}).foo, 1)
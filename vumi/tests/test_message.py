@@ -1,8 +1,12 @@
+import json
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, JSONMessageCodec,
+                          set_message_codec, from_json, to_json)
 
 
 class MessageTest(TestCase):
@@ -18,6 +22,45 @@ class MessageTest(TestCase):
         self.assertFalse('a' in Message(b=5))
 
 
+class JSONMessageCodecTest(TestCase):
+
+    def test_round_trip(self):
+        codec = JSONMessageCodec()
+        dt = datetime(2012, 1, 2, 3, 4, 5, 678)
+        obj = {'timestamp': dt, 'meta': {'when': dt, 'what': 'foo'}}
+        self.assertEqual(codec.decode(codec.encode(obj)), obj)
+
+    def test_encode_datetime(self):
+        codec = JSONMessageCodec()
+        self.assertEqual(
+            json.loads(codec.encode({'a': datetime(2012, 1, 2, 3, 4, 5, 6)})),
+            {'a': '2012-01-02 03:04:05.000006'})
+
+    def test_decode_leaves_non_datetimes(self):
+        codec = JSONMessageCodec()
+        obj = {'a': '2012-01-02', 'b': '2012-13-02 03:04:05.000006',
+               'c': 5, 'd': None, 'e': ['2012-01-02 03:04:05.000006']}
+        self.assertEqual(codec.decode(json.dumps(obj)), obj)
+
+    def test_decode_date_time_fields(self):
+        codec = JSONMessageCodec(date_time_fields=['timestamp'])
+        ts = '2012-01-02 03:04:05.000006'
+        obj = codec.decode(json.dumps({'timestamp': ts, 'other': ts}))
+        self.assertEqual(obj, {
+            'timestamp': datetime(2012, 1, 2, 3, 4, 5, 6),
+            'other': ts,
+        })
+
+    def test_set_message_codec(self):
+        codec = JSONMessageCodec(date_time_fields=['timestamp'])
+        old_codec = set_message_codec(codec)
+        self.addCleanup(set_message_codec, old_codec)
+        ts = '2012-01-02 03:04:05.000006'
+        self.assertEqual(from_json(to_json({'other': ts})), {'other': ts})
+        msg = Message.from_json(json.dumps({'timestamp': ts}))
+        self.assertEqual(msg['timestamp'], datetime(2012, 1, 2, 3, 4, 5, 6))
+
+
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
         raise NotImplementedError()
@@ -1,7 +1,9 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, returnValue
+from twisted.internet.task import deferLater, Clock
+from twisted.internet import reactor
 
-from vumi.service import Worker, WorkerCreator
+from vumi.service import Worker, WorkerCreator, BindingCache
 from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
 from vumi.message import Message
 
@@ -46,6 +48,126 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def start_blocking_consumer(self, **kw):
+        worker = get_stubbed_worker(Worker)
+        started = []
+
+        def handler(msg):
+            d = Deferred()
+            started.append((msg['n'], d))
+            return d
+
+        yield worker.consume('test.routing.key', handler, **kw)
+        returnValue((worker._amqp_client.broker, started))
+
+    @inlineCallbacks
+    def publish_and_settle(self, broker, *payloads):
+        for payload in payloads:
+            broker.basic_publish('vumi', 'test.routing.key',
+                                 fake_amq_message(payload).content)
+        # Give the fake broker a chance to deliver the messages.
+        for _ in range(3):
+            yield deferLater(reactor, 0, lambda: None)
+
+    @inlineCallbacks
+    def test_consume_sequentially_by_default(self):
+        broker, started = yield self.start_blocking_consumer()
+        yield self.publish_and_settle(broker, {"n": 1}, {"n": 2})
+        self.assertEqual([n for n, _ in started], [1])
+        started[0][1].callback(None)
+        yield self.publish_and_settle(broker)
+        self.assertEqual([n for n, _ in started], [1, 2])
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        broker, started = yield self.start_blocking_consumer(concurrency=2)
+        yield self.publish_and_settle(broker, {"n": 1}, {"n": 2}, {"n": 3})
+        self.assertEqual([n for n, _ in started], [1, 2])
+        started[1][1].callback(None)
+        yield self.publish_and_settle(broker)
+        self.assertEqual([n for n, _ in started], [1, 2, 3])
+
+    @inlineCallbacks
+    def test_consume_concurrently_ordered_by_key(self):
+        broker, started = yield self.start_blocking_consumer(
+            concurrency=3, ordering_key='addr')
+        yield self.publish_and_settle(
+            broker, {"n": 1, "addr": "a"}, {"n": 2, "addr": "a"},
+            {"n": 3, "addr": "b"})
+        self.assertEqual([n for n, _ in started], [1, 3])
+        started[0][1].callback(None)
+        yield self.publish_and_settle(broker)
+        self.assertEqual([n for n, _ in started], [1, 3, 2])
+
+
+class TestBindingCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.fetches = []
+        self.cache = BindingCache(self.fetch_bindings, ttl=60,
+                                  negative_ttl=5, clock=self.clock)
+
+    def assert_fired_with(self, d, expected):
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(results, [expected])
+
+    def fetch_bindings(self):
+        d = Deferred()
+        self.fetches.append(d)
+        return d
+
+    def test_first_lookup_waits_for_refresh(self):
+        d = self.cache.is_bound('foo')
+        self.assertFalse(d.called)
+        self.assertEqual(len(self.fetches), 1)
+        self.fetches[0].callback({'foo': ['queue']})
+        self.assert_fired_with(d, True)
+
+    def test_concurrent_lookups_share_refresh(self):
+        d1 = self.cache.is_bound('foo')
+        d2 = self.cache.is_bound('bar')
+        self.assertEqual(len(self.fetches), 1)
+        self.fetches[0].callback({'foo': ['queue']})
+        self.assert_fired_with(d1, True)
+        # 'bar' is still unbound after the refresh it waited for, so it's
+        # negatively cached without fetching the bindings again.
+        self.assert_fired_with(d2, False)
+        self.assertEqual(len(self.fetches), 1)
+        self.assert_fired_with(self.cache.is_bound('bar'), False)
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_known_key_does_not_wait(self):
+        self.cache.is_bound('foo')
+        self.fetches[0].callback({'foo': ['queue']})
+        self.clock.advance(61)
+        d = self.cache.is_bound('foo')
+        self.assert_fired_with(d, True)
+        # A background refresh has been started.
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_unbound_key_is_negatively_cached(self):
+        self.cache.is_bound('foo')
+        self.fetches[0].callback({})
+        d = self.cache.is_bound('bar')
+        self.fetches[1].callback({})
+        self.assert_fired_with(d, False)
+        d = self.cache.is_bound('bar')
+        self.assert_fired_with(d, False)
+        self.assertEqual(len(self.fetches), 2)
+        self.clock.advance(5)
+        d = self.cache.is_bound('bar')
+        self.assertEqual(len(self.fetches), 3)
+        self.fetches[2].callback({'bar': ['queue']})
+        self.assert_fired_with(d, True)
+
+    def test_undetected_bindings(self):
+        d = self.cache.is_bound('foo')
+        self.fetches[0].callback(dict(BindingCache.UNDETECTED))
+        self.assert_fired_with(d, True)
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
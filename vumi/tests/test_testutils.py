@@ -1,7 +1,9 @@
 from twisted.trial.unittest import TestCase
 
 from vumi.service import Worker
-from vumi.tests.utils import get_stubbed_worker, Mocking, LogCatcher
+from vumi.tests.utils import (get_stubbed_worker, Mocking, LogCatcher,
+                              use_non_persistent_http_client)
+from vumi.utils import get_http_client
 from vumi.tests.fake_amqp import FakeAMQClient
 from vumi import log
 
@@ -36,6 +38,20 @@ class UtilsTestCase(TestCase):
         self.assertEqual({}, worker._amqp_client.vumi_options)
         self.assertEqual(options, worker.config)
 
+    def test_use_non_persistent_http_client(self):
+        cleanups = []
+
+        class StubCase(object):
+            def addCleanup(self, f, *args):
+                cleanups.append((f, args))
+
+        old_client = get_http_client()
+        use_non_persistent_http_client(StubCase())
+        self.assertFalse(get_http_client().pool.persistent)
+        [(f, args)] = cleanups
+        f(*args)
+        self.assertEqual(old_client, get_http_client())
+
 
 class LogCatcherTestCase(TestCase):
     def test_simple_catching(self):
@@ -2,7 +2,8 @@ import os.path
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.internet.defer import Deferred, inlineCallbacks, gatherResults
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
@@ -11,9 +12,11 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
+                        get_first_word, redis_from_config, LRUCache,
+                        PrefixTrie, OperatorRoutingTable, HttpClient,
+                        HttpQueueFullError, HttpTimeoutError)
 from vumi.persist.fake_redis import FakeRedis
-from vumi.tests.utils import import_skip
+from vumi.tests.utils import import_skip, use_non_persistent_http_client
 
 
 class UtilsTestCase(TestCase):
@@ -54,6 +57,59 @@ class UtilsTestCase(TestCase):
         self.assertEqual('VODACOM', get_operator_name('27821234567', mapping))
         self.assertEqual('UNKNOWN', get_operator_name('27801234567', mapping))
 
+    def test_prefix_trie(self):
+        trie = PrefixTrie({'27': 'ZA', '2782': 'VODACOM', 2783: 'MTN'})
+        self.assertEqual(3, len(trie))
+        self.assertEqual('VODACOM', trie.lookup('27821234567'))
+        self.assertEqual('MTN', trie.lookup('27831234567'))
+        self.assertEqual('ZA', trie.lookup('27711234567'))
+        self.assertEqual('ZA', trie.lookup('27'))
+        self.assertEqual(None, trie.lookup('2'))
+        self.assertEqual('UNKNOWN', trie.lookup('44123', 'UNKNOWN'))
+        trie.add('', 'ANY')
+        self.assertEqual('ANY', trie.lookup('44123', 'UNKNOWN'))
+
+    def test_prefix_trie_lookup_all(self):
+        trie = PrefixTrie({'27': 'ZA', '2782': 'VODACOM', '278': 'ZA8'})
+        self.assertEqual(['ZA', 'ZA8', 'VODACOM'],
+                         trie.lookup_all('27821234567'))
+        self.assertEqual(['ZA'], trie.lookup_all('2771'))
+        self.assertEqual([], trie.lookup_all('44'))
+        trie.add('', 'ANY')
+        self.assertEqual(['ANY'], trie.lookup_all(''))
+
+    def test_operator_routing_table(self):
+        table = OperatorRoutingTable(
+            {'27': {'2782': 'VODACOM', '2783': 'MTN', '278': 'OTHER'}},
+            '27', {'MTN': '27830000000'})
+        self.assertEqual(3, len(table))
+        self.assertEqual('MTN', table.get_operator_name('27831234567'))
+        self.assertEqual('VODACOM', table.get_operator_name('27821234567'))
+        self.assertEqual('OTHER', table.get_operator_name('27801234567'))
+        self.assertEqual('UNKNOWN', table.get_operator_name('27701234567'))
+        self.assertEqual('27830000000',
+                         table.get_operator_number('0831234567'))
+        self.assertEqual('27830000000',
+                         table.get_operator_number('+27831234567'))
+        self.assertEqual(None, table.get_operator_number('0821234567'))
+
+    def test_operator_routing_table_nested_prefixes(self):
+        table = OperatorRoutingTable({
+            '27': {'2782': 'VODACOM', '44': 'UNREACHABLE'},
+            '2783': {'27': 'MTN'},
+        })
+        self.assertEqual('VODACOM', table.get_operator_name('27821234567'))
+        self.assertEqual('MTN', table.get_operator_name('27831234567'))
+        self.assertEqual('UNKNOWN', table.get_operator_name('44123456'))
+
+    def test_operator_routing_table_large(self):
+        prefixes = dict(('27%04d' % i, 'NET%d' % (i % 7))
+                        for i in range(5000))
+        table = OperatorRoutingTable({'27': prefixes})
+        self.assertEqual(5000, len(table))
+        self.assertEqual('NET%d' % (1234 % 7),
+                         table.get_operator_name('271234567'))
+
     def test_get_first_word(self):
         self.assertEqual('KEYWORD',
                          get_first_word('KEYWORD rest of the message'))
@@ -75,6 +131,61 @@ class UtilsTestCase(TestCase):
             import_skip(e, 'redis')
 
 
+class LRUCacheTestCase(TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertRaises(KeyError, lambda: cache['b'])
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(cache.keys(), ['a', 'c'])
+        cache['a'] = 4
+        cache['d'] = 5
+        self.assertEqual(cache.keys(), ['a', 'd'])
+        self.assertEqual(cache.get('a'), 4)
+
+    def test_pop_and_delete(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'default'), 'default')
+        del cache['b']
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.keys(), [])
+
+    def test_clear(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache.clear()
+        self.assertFalse('a' in cache)
+        cache['b'] = 2
+        self.assertEqual(cache.keys(), ['b'])
+
+    def test_oldest(self):
+        cache = LRUCache(3)
+        self.assertEqual(cache.oldest(), None)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.oldest(), ('a', 1))
+        self.assertEqual(cache.oldest(), ('a', 1))
+        cache.get('a')
+        self.assertEqual(cache.oldest(), ('b', 2))
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, LRUCache, 0)
+
+
 class FakeHTTP10(Protocol):
     def dataReceived(self, data):
         self.transport.write(self.factory.response_body)
@@ -91,6 +202,7 @@ class HttpUtilsTestCase(TestCase):
 
     @inlineCallbacks
     def setUp(self):
+        use_non_persistent_http_client(self)
         self.root = Resource()
         self.root.isLeaf = True
         site_factory = Site(self.root)
@@ -285,3 +397,135 @@ class HttpUtilsTestCase(TestCase):
             self.assertTrue(reason.check('vumi.utils.HttpTimeoutError'))
         client_done.addBoth(check_client_response)
         yield client_done
+
+
+class HttpClientTestCase(TestCase):
+
+    timeout = 3
+
+    @inlineCallbacks
+    def setUp(self):
+        self.root = Resource()
+        self.root.isLeaf = True
+        self.root.render = self.render
+        self.requests = []
+        self.server_connections_lost = []
+        site_factory = Site(self.root)
+        site_factory.buildProtocol = self.wrap_build_protocol(
+            site_factory.buildProtocol)
+        self.webserver = yield reactor.listenTCP(0, site_factory)
+        addr = self.webserver.getHost()
+        self.url = "http://%s:%s/" % (addr.host, addr.port)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.webserver.loseConnection()
+        for request in self.requests:
+            if not request.finished:
+                request.finish()
+
+    def wrap_build_protocol(self, build_protocol):
+        def wrapped(addr):
+            channel = build_protocol(addr)
+            lost = Deferred()
+            self.server_connections_lost.append(lost)
+            connection_lost = channel.connectionLost
+
+            def wrapped_connection_lost(reason):
+                connection_lost(reason)
+                lost.callback(None)
+
+            channel.connectionLost = wrapped_connection_lost
+            return channel
+        return wrapped
+
+    def render(self, request):
+        self.requests.append(request)
+        if request.args.get('wait'):
+            return NOT_DONE_YET
+        return "Yay"
+
+    def finish_request(self, request, data="Done"):
+        request.write(data)
+        request.finish()
+
+    @inlineCallbacks
+    def test_persistent_connections(self):
+        client = HttpClient()
+        response = yield client.request(self.url, '')
+        self.assertEqual(response.delivered_body, "Yay")
+        response = yield client.request(self.url, '', method='GET')
+        self.assertEqual(response.delivered_body, "Yay")
+        self.assertEqual(2, client.stats['requests'])
+        self.assertEqual(1, len(self.server_connections_lost))
+        yield client.close()
+        yield gatherResults(self.server_connections_lost)
+
+    @inlineCallbacks
+    def test_max_per_host(self):
+        client = HttpClient(persistent=False, max_per_host=1)
+        d1 = client.request(self.url + '?wait=1', '')
+        d2 = client.request(self.url, '')
+        self.assertEqual(2, client.pending(self.url))
+        self.assertEqual(1, client.stats['queued'])
+        while not self.requests:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(1, len(self.requests))
+        self.finish_request(self.requests[0])
+        response1 = yield d1
+        response2 = yield d2
+        self.assertEqual(response1.delivered_body, "Done")
+        self.assertEqual(response2.delivered_body, "Yay")
+        self.assertEqual(0, client.pending(self.url))
+
+    @inlineCallbacks
+    def test_queue_full(self):
+        client = HttpClient(persistent=False, max_per_host=1,
+                            max_queued_per_host=0)
+        d1 = client.request(self.url + '?wait=1', '')
+        try:
+            yield client.request(self.url, '')
+        except HttpQueueFullError:
+            pass
+        else:
+            self.fail("Expected HttpQueueFullError.")
+        self.assertEqual(1, client.stats['rejected'])
+        while not self.requests:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.finish_request(self.requests[0])
+        yield d1
+        self.assertEqual(0, client.pending(self.url))
+
+    @inlineCallbacks
+    def test_timeout_while_queued(self):
+        client = HttpClient(persistent=False, max_per_host=1)
+        d1 = client.request(self.url + '?wait=1', '')
+        d2 = client.request(self.url, '', timeout=0.1)
+        try:
+            yield d2
+        except HttpTimeoutError:
+            pass
+        else:
+            self.fail("Expected HttpTimeoutError.")
+        self.assertEqual(1, client.pending(self.url))
+        self.assertEqual(1, client.stats['timeouts'])
+        while not self.requests:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.finish_request(self.requests[0])
+        yield d1
+        self.assertEqual(1, len(self.requests))
+
+    @inlineCallbacks
+    def test_metrics_hook(self):
+        metrics = []
+        client = HttpClient(persistent=False, max_per_host=1,
+                            metrics_hook=lambda *m: metrics.append(m))
+        d1 = client.request(self.url + '?wait=1', '')
+        d2 = client.request(self.url, '')
+        self.assertEqual([('queued', 1)], metrics)
+        while not self.requests:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.finish_request(self.requests[0])
+        yield gatherResults([d1, d2])
+        self.assertEqual(['queued', 'response_time', 'response_time'],
+                         [name for name, _ in metrics])
@@ -50,6 +50,11 @@ class TestBaseConfig(TestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_amqp_concurrency_defaults(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_concurrency, 1)
+        self.assertEqual(config.amqp_ordering_key, None)
+
 
 class TestBaseWorker(VumiWorkerTestCase):
 
@@ -142,16 +147,42 @@ class TestBaseWorker(VumiWorkerTestCase):
 
     def test_get_static_config(self):
         cfg = self.worker.get_static_config()
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'amqp_concurrency', 'amqp_ordering_key'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     @inlineCallbacks
     def test_get_config(self):
         msg = self.mkmsg_in()
         cfg = yield self.worker.get_config(msg)
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'amqp_concurrency', 'amqp_ordering_key'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg = self.mkmsg_in()
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertTrue(cfg1 is cfg2)
+        self.assertEqual(self.worker._config_cache.hits, 1)
+
+    def test_heartbeat_config_cache_stats(self):
+        self.worker.get_cached_config('a', lambda: {})
+        self.worker.get_cached_config('a', lambda: {})
+        self.worker.get_cached_config('b', lambda: {})
+        attrs = self.worker._gen_heartbeat_attrs()
+        self.assertEqual(attrs['config_cache'],
+                         {'hits': 1, 'misses': 2, 'hit_rate': 1.0 / 3})
+
+    def test_get_cached_config(self):
+        cfg1 = self.worker.get_cached_config('a', lambda: {})
+        cfg2 = self.worker.get_cached_config(
+            'b', lambda: {'amqp_prefetch_count': 5})
+        self.assertEqual(cfg1.amqp_prefetch_count, 20)
+        self.assertEqual(cfg2.amqp_prefetch_count, 5)
+        self.assertTrue(self.worker.get_cached_config('a', None) is cfg1)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
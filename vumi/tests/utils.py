@@ -16,7 +16,7 @@ from twisted.internet.defer import DeferredQueue, inlineCallbacks, returnValue
 from twisted.python import log
 
 from vumi.utils import (vumi_resource_path, import_module, flatten_generator,
-                        LogFilterSite)
+                        LogFilterSite, HttpClient, set_http_client)
 from vumi.service import get_spec, Worker, WorkerCreator
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.tests.fake_amqp import FakeAMQPBroker, FakeAMQClient
@@ -30,6 +30,16 @@ def import_skip(exc, *expected):
     raise SkipTest("Failed to import '%s'." % (module,))
 
 
+def use_non_persistent_http_client(test_case):
+    """Make HTTP requests non-persistent until `test_case` finishes.
+
+    Trial fails any test that leaves connections open when it finishes, so
+    tests that make HTTP requests shouldn't keep idle connections around.
+    """
+    old_client = set_http_client(HttpClient(persistent=False))
+    test_case.addCleanup(set_http_client, old_client)
+
+
 class UTCNearNow(object):
     def __init__(self, offset=10):
         self.now = datetime.utcnow()
@@ -422,6 +432,7 @@ class VumiWorkerTestCase(TestCase):
     def setUp(self):
         self._workers = []
         self._amqp = FakeAMQPBroker()
+        use_non_persistent_http_client(self)
 
     @inlineCallbacks
     def tearDown(self):
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.transports.tests.test_failures -*-
 
 import time
+import calendar
 from datetime import datetime
 from uuid import uuid4
 
@@ -10,6 +11,7 @@ from twisted.internet.task import LoopingCall
 from vumi.service import Worker
 from vumi.message import TransportMessage, to_json
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.components.delayed_queue import DelayedQueue
 
 
 class FailureMessage(TransportMessage):
@@ -97,6 +99,10 @@ class FailureWorker(Worker):
         redis = yield TxRedisManager.from_config(r_config)
         self.redis = redis.sub_manager("failures:%s" % (
                 self.config['transport_name'],))
+        self.retry_queue = DelayedQueue(
+            self.redis, self.deliver_queued_retry,
+            due_key='retry_due', items_key='retry_items')
+        yield self.migrate_legacy_retries()
 
     def start_retry_delivery(self):
         self.delivery_loop = None
@@ -141,56 +147,66 @@ class FailureWorker(Worker):
         key = self.failure_key()
         if not retry_delay:
             retry_delay = 0
-        yield self.redis.hmset(key, {
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, {
                 "message": message_json,
                 "reason": reason,
                 "retry_delay": str(retry_delay),
                 })
-        yield self.add_to_failure_set(key)
+        pipe.sadd("failure_keys", key)
         if retry_delay:
-            yield self.store_retry(key, retry_delay)
+            self._store_retry(pipe, key, retry_delay)
+        yield pipe.execute()
         returnValue(key)
 
     def get_failure(self, failure_key):
         return self.redis.hgetall(failure_key)
 
-    @inlineCallbacks
     def store_retry(self, failure_key, retry_delay, now=None):
-        timestamp = self.get_next_write_timestamp(retry_delay, now=now)
-        bucket_key = "retry_keys." + timestamp
-        yield self.redis.sadd(bucket_key, failure_key)
-        yield self.store_read_timestamp(timestamp)
+        pipe = self.redis.pipeline()
+        self._store_retry(pipe, failure_key, retry_delay, now=now)
+        return pipe.execute()
 
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        return self.redis.zadd('retry_timestamps', **{timestamp: score})
+    def _store_retry(self, pipe, failure_key, retry_delay, now=None):
+        due = self.get_next_retry_time(retry_delay, now=now)
+        self.retry_queue.schedule_in_pipeline(
+            pipe, due, failure_key, item_id=failure_key)
 
-    def get_next_write_timestamp(self, delta, now=None):
+    def get_next_retry_time(self, delta, now=None):
         if now is None:
             now = int(time.time())
-        timestamp = now + delta
-        timestamp += self.GRANULARITY - (timestamp % self.GRANULARITY)
+        timestamp = int(now + delta)
+        return timestamp + self.GRANULARITY - (timestamp % self.GRANULARITY)
+
+    def get_next_write_timestamp(self, delta, now=None):
+        timestamp = self.get_next_retry_time(delta, now=now)
         return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
 
     @inlineCallbacks
-    def get_next_read_timestamp(self):
-        now = int(time.time())
-        timestamp = datetime.utcfromtimestamp(now).isoformat().split('.')[0]
-        next_timestamp = yield self.redis.zrange('retry_timestamps', 0, 0)
-        if next_timestamp and next_timestamp[0] <= timestamp:
-            returnValue(next_timestamp[0])
-        returnValue(None)
+    def migrate_legacy_retries(self):
+        """
+        Move retries stored in the time bucket sets used by older versions
+        into the retry queue.
+        """
+        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
+        for timestamp in timestamps:
+            due = calendar.timegm(
+                time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+            bucket_key = "retry_keys." + timestamp
+            failure_keys = yield self.redis.smembers(bucket_key)
+            pipe = self.redis.pipeline()
+            for failure_key in failure_keys:
+                self.retry_queue.schedule_in_pipeline(
+                    pipe, due, failure_key, item_id=failure_key)
+            pipe.delete(bucket_key)
+            pipe.zrem('retry_timestamps', timestamp)
+            yield pipe.execute()
 
     @inlineCallbacks
     def get_next_retry_key(self):
-        timestamp = yield self.get_next_read_timestamp()
-        if not timestamp:
-            return
-        bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
-            yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
+        claimed = yield self.retry_queue.claim_due(limit=1)
+        if claimed:
+            returnValue(claimed[0][0])
 
     @inlineCallbacks
     def deliver_retry(self, retry_key, publisher):
@@ -198,13 +214,11 @@ class FailureWorker(Worker):
         published = yield publisher.publish_raw(failure['message'])
         returnValue(published)
 
-    @inlineCallbacks
+    def deliver_queued_retry(self, retry_key):
+        return self.deliver_retry(retry_key, self.retry_publisher)
+
     def deliver_retries(self):
-        while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
-                return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
+        return self.retry_queue.deliver_due()
 
     def next_retry_delay(self, delay):
         if not delay:
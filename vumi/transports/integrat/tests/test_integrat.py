@@ -6,7 +6,7 @@ from twisted.internet.defer import inlineCallbacks, DeferredQueue
 from twisted.web.server import Site
 
 from vumi.utils import http_request
-from vumi.tests.utils import MockHttpServer
+from vumi.tests.utils import MockHttpServer, use_non_persistent_http_client
 from vumi.transports.tests.utils import TransportTestCase
 from vumi.message import TransportUserMessage
 from vumi.transports.integrat.integrat import (IntegratHttpResource,
@@ -46,6 +46,7 @@ class TestIntegratHttpResource(TestCase):
 
     @inlineCallbacks
     def setUp(self):
+        use_non_persistent_http_client(self)
         self.msgs = []
         site_factory = Site(IntegratHttpResource("testgrat", "ussd",
             self._publish))
@@ -8,7 +8,7 @@ from twisted.web import http
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.transports.httprpc import HttpRpcTransport
-from vumi.utils import http_request_full, get_operator_name
+from vumi.utils import http_request_full, OperatorRoutingTable
 
 
 class MediaEdgeGSMTransport(HttpRpcTransport):
@@ -49,6 +49,7 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
         self._outbound_url_username = self.config.get('outbound_username', '')
         self._outbound_url_password = self.config.get('outbound_password', '')
         self._operator_mappings = self.config.get('operator_mappings', {})
+        self._operator_routing = OperatorRoutingTable(self._operator_mappings)
         return super(MediaEdgeGSMTransport, self).setup_transport()
 
     @inlineCallbacks
@@ -62,7 +63,7 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
                 "PWD": self._outbound_url_password,
                 "SmsID": message['message_id'],
                 "PhoneNumber": msisdn,
-                "Operator": get_operator_name(msisdn, self._operator_mappings),
+                "Operator": self._operator_routing.get_operator_name(msisdn),
                 "SmsBody": message['content'],
             }
 
@@ -6,7 +6,8 @@ import uuid
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 from twisted.internet.task import LoopingCall
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredQueue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredQueue, succeed)
 
 import binascii
 from smpp.pdu import unpack_pdu
@@ -17,6 +18,8 @@ from smpp.pdu_inspector import (
     MultipartMessage, detect_multipart, multipart_key)
 
 from vumi import log
+from vumi.persist.redis_base import LuaScript
+from vumi.transports.smpp.clientserver.framing import PDUBuffer
 
 
 def unpacked_pdu_opts(unpacked_pdu):
@@ -40,6 +43,29 @@ def update_ussd_pdu(sm_pdu, continue_session, session_info=None):
     return sm_pdu
 
 
+# We reset the counter once it reaches 0xFFFF0000, so blocks up to this
+# size can always be handed out without going past 0xFFFFFFFF.
+MAX_SEQ_BLOCK_SIZE = 0xFFFF
+
+
+def _reserve_seq_block_emulation(redis, keys, args):
+    last = redis.incr(keys[0], int(args[0]))
+    if last >= 0xFFFF0000:
+        redis.delete(keys[0])
+    return last
+
+
+# Reserve a block of sequence numbers and return the last one in the block.
+# The counter is reset atomically when it gets close to the upper limit.
+RESERVE_SEQ_BLOCK_SCRIPT = LuaScript("""
+local last = redis.call('INCRBY', KEYS[1], ARGV[1])
+if last >= 0xFFFF0000 then
+    redis.call('DEL', KEYS[1])
+end
+return last
+""", emulation=_reserve_seq_block_emulation)
+
+
 class EsmeTransceiver(Protocol):
     BIND_PDU = BindTransceiver
     CONNECTED_STATE = 'BOUND_TRX'
@@ -55,8 +81,12 @@ class EsmeTransceiver(Protocol):
         self.smpp_bind_timeout = self.config.smpp_bind_timeout
         self.smpp_enquire_link_interval = \
                 self.config.smpp_enquire_link_interval
-        self.datastream = ''
+        self.pdu_buffer = PDUBuffer()
         self.redis = redis
+        self.sequence_block_size = min(
+            max(self.config.sequence_block_size, 1), MAX_SEQ_BLOCK_SIZE)
+        self._seq_next, self._seq_last = 1, 0
+        self._unacked = set()
         self._lose_conn = None
         # The PDU queue ensures that PDUs are processed in the order
         # they arrive. `self._process_pdu_queue()` loops forever
@@ -71,65 +101,22 @@ class EsmeTransceiver(Protocol):
 
         The valid range of sequence number is 0x00000001 to 0xFFFFFFFF.
 
-        We start trying to wrap at 0xFFFF0000 so we can keep returning values
-        (up to 0xFFFF of them) even while someone else is in the middle of
-        resetting the counter.
+        Sequence numbers are reserved from Redis in blocks of
+        `sequence_block_size` and handed out locally until the block is
+        used up.
         """
-        seq = yield self.redis.incr('smpp_last_sequence_number')
-
-        if seq >= 0xFFFF0000:
-            # We're close to the upper limit, so try to reset. It doesn't
-            # matter if we actually succeed or not, since we're going to return
-            # `seq` anyway.
-            yield self._reset_seq_counter()
-
+        if self._seq_next > self._seq_last:
+            last = yield self.redis.run_script(
+                RESERVE_SEQ_BLOCK_SCRIPT, keys=['smpp_last_sequence_number'],
+                args=[self.sequence_block_size])
+            self._seq_next = last - self.sequence_block_size + 1
+            self._seq_last = last
+        seq = self._seq_next
+        self._seq_next += 1
         returnValue(seq)
 
-    @inlineCallbacks
-    def _reset_seq_counter(self):
-        """Reset the sequence counter in a safe manner.
-
-        NOTE: There is a potential race condition in this implementation. If we
-        acquire the lock and it expires while we still think we hold it, it's
-        possible for the sequence number to be reset by someone else between
-        the final vlue check and the reset call. This seems like a very
-        unlikely situation, so we'll leave it like that for now.
-
-        A better solution is to replace this whole method with a lua script
-        that we send to redis, but scripting support is still very new at the
-        time of writing.
-        """
-        # SETNX can be used as a lock.
-        locked = yield self.redis.setnx('smpp_last_sequence_number_wrap', 1)
-
-        # If someone crashed in exactly the wrong place, the lock may be
-        # held by someone else but have no expire time. A race condition
-        # here may set the TTL multiple times, but that's fine.
-        if (yield self.redis.ttl('smpp_last_sequence_number_wrap')) < 0:
-            # The TTL only gets set if the lock exists and recently had no TTL.
-            yield self.redis.expire('smpp_last_sequence_number_wrap', 10)
-
-        if not locked:
-            # We didn't actually get the lock, so our job is done.
-            return
-
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
-            # Our stored sequence number is no longer outside the allowed
-            # range, so someone else must have reset it before we got the lock.
-            return
-
-        # We reset the counter by deleting the key. The next INCR will recreate
-        # it for us.
-        yield self.redis.delete('smpp_last_sequence_number')
-
     def pop_data(self):
-        data = None
-        if(len(self.datastream) >= 16):
-            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
-            if(len(self.datastream) >= command_length):
-                data = self.datastream[0:command_length]
-                self.datastream = self.datastream[command_length:]
-        return data
+        return self.pdu_buffer.pop_pdu()
 
     @inlineCallbacks
     def handle_data(self, data):
@@ -184,11 +171,9 @@ class EsmeTransceiver(Protocol):
         log.msg('STATE: %s' % (self.state))
 
     def dataReceived(self, data):
-        self.datastream += data
-        data = self.pop_data()
-        while data is not None:
-            self._pdu_queue.put(data)
-            data = self.pop_data()
+        self.pdu_buffer.feed(data)
+        for pdu_data in self.pdu_buffer.pop_pdus():
+            self._pdu_queue.put(pdu_data)
 
     def send_pdu(self, pdu):
         data = pdu.get_bin()
@@ -227,7 +212,7 @@ class EsmeTransceiver(Protocol):
 
     @inlineCallbacks
     def handle_submit_sm_resp(self, pdu):
-        yield self.pop_unacked()
+        self._unacked.discard(pdu['header']['sequence_number'])
         message_id = pdu.get('body', {}).get(
                 'mandatory_parameters', {}).get('message_id')
         yield self.esme_callbacks.submit_sm_resp(
@@ -425,17 +410,7 @@ class EsmeTransceiver(Protocol):
             log.msg("enquire_link_resp NOT OK: %r" % (pdu,))
 
     def get_unacked_count(self):
-        return self.redis.llen("unacked").addCallback(int)
-
-    @inlineCallbacks
-    def push_unacked(self, sequence_number=-1):
-        yield self.redis.lpush("unacked", sequence_number)
-        log.msg("unacked pushed to: %s" % ((yield self.get_unacked_count())))
-
-    @inlineCallbacks
-    def pop_unacked(self):
-        yield self.redis.lpop("unacked")
-        log.msg("unacked popped to: %s" % ((yield self.get_unacked_count())))
+        return succeed(len(self._unacked))
 
     @inlineCallbacks
     def submit_sm(self, **kwargs):
@@ -458,7 +433,7 @@ class EsmeTransceiver(Protocol):
             pdu.add_message_payload(''.join('%02x' % ord(c) for c in message))
 
         self.send_pdu(pdu)
-        yield self.push_unacked(sequence_number)
+        self._unacked.add(sequence_number)
         returnValue(sequence_number)
 
     @inlineCallbacks
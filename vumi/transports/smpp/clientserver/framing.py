@@ -0,0 +1,79 @@
+# -*- test-case-name: vumi.transports.smpp.clientserver.tests.test_framing -*-
+
+"""Framing of the SMPP PDU byte stream."""
+
+import struct
+
+
+class PDUFramingError(Exception):
+    """Raised when the stream contains an impossible PDU length."""
+
+
+class PDUBuffer(object):
+    """
+    Accumulates bytes read from an SMPP connection and splits them into
+    complete PDUs.
+
+    Incoming data is appended to a single `bytearray` and PDUs are read
+    from a moving offset rather than by slicing the remaining data off the
+    front of a string for every PDU, so splitting a large read containing
+    many PDUs takes time linear in the size of the read. Consumed bytes are
+    only discarded once the buffer is drained or the consumed prefix makes
+    up most of the buffer.
+    """
+
+    HEADER_LENGTH = 16
+    COMPACT_THRESHOLD = 64 * 1024
+
+    _command_length = struct.Struct('!I')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """Append data read from the connection."""
+        self._buffer.extend(data)
+
+    def pop_pdu(self):
+        """
+        Remove the next complete PDU from the buffer and return it as a
+        string, or return `None` if there isn't a complete PDU available.
+        """
+        start = self._offset
+        available = len(self._buffer) - start
+        if available < self.HEADER_LENGTH:
+            return None
+        (command_length,) = self._command_length.unpack_from(
+            self._buffer, start)
+        if command_length < self.HEADER_LENGTH:
+            raise PDUFramingError(
+                "Invalid PDU command_length: %s" % (command_length,))
+        if available < command_length:
+            return None
+        end = start + command_length
+        pdu = str(self._buffer[start:end])
+        self._offset = end
+        self._compact()
+        return pdu
+
+    def pop_pdus(self):
+        """Remove and return a list of all the complete PDUs available."""
+        pdus = []
+        pdu = self.pop_pdu()
+        while pdu is not None:
+            pdus.append(pdu)
+            pdu = self.pop_pdu()
+        return pdus
+
+    def _compact(self):
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif (self._offset >= self.COMPACT_THRESHOLD and
+              self._offset * 2 >= len(self._buffer)):
+            del self._buffer[:self._offset]
+            self._offset = 0
@@ -156,6 +156,43 @@ class EsmeGenericMixin(object):
         self.assertEqual(0xFFFF0001, (yield esme.get_next_seq()))
         self.assertEqual(1, (yield esme.get_next_seq()))
 
+    @inlineCallbacks
+    def test_sequence_block_allocation(self):
+        esme = yield self.get_unbound_esme()
+        esme.sequence_block_size = 10
+        self.assertEqual(1, (yield esme.get_next_seq()))
+        self.assertEqual(
+            '10', (yield esme.redis.get('smpp_last_sequence_number')))
+        for expected in range(2, 11):
+            self.assertEqual(expected, (yield esme.get_next_seq()))
+        self.assertEqual(
+            '10', (yield esme.redis.get('smpp_last_sequence_number')))
+        self.assertEqual(11, (yield esme.get_next_seq()))
+        self.assertEqual(
+            '20', (yield esme.redis.get('smpp_last_sequence_number')))
+
+    @inlineCallbacks
+    def test_sequence_blocks_shared_redis(self):
+        esme1 = yield self.get_unbound_esme()
+        esme2 = self.ESME_CLASS(esme1.config, esme1.redis, EsmeCallbacks())
+        esme1.sequence_block_size = esme2.sequence_block_size = 3
+        seqs = []
+        for _ in range(5):
+            seqs.append((yield esme1.get_next_seq()))
+            seqs.append((yield esme2.get_next_seq()))
+        self.assertEqual([1, 2, 3, 7, 8], seqs[::2])
+        self.assertEqual([4, 5, 6, 10, 11], seqs[1::2])
+
+    @inlineCallbacks
+    def test_sequence_block_rollover(self):
+        esme = yield self.get_unbound_esme()
+        esme.sequence_block_size = 10
+        yield esme.redis.set('smpp_last_sequence_number', 0xFFFF0000 - 5)
+        seqs = []
+        for _ in range(11):
+            seqs.append((yield esme.get_next_seq()))
+        self.assertEqual(range(0xFFFF0000 - 4, 0xFFFF0000 + 6) + [1], seqs)
+
 
 class EsmeTransmitterMixin(EsmeGenericMixin):
     """Transmitter-side tests."""
@@ -0,0 +1,70 @@
+from twisted.trial.unittest import TestCase
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.transports.smpp.clientserver.framing import (
+    PDUBuffer, PDUFramingError)
+
+
+class PDUBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.buffer = PDUBuffer()
+
+    def mk_pdus(self, count):
+        return [DeliverSM(i + 1, short_message="message %s" % (i,)).get_bin()
+                for i in range(count)]
+
+    def test_pop_pdu_empty(self):
+        self.assertEqual(None, self.buffer.pop_pdu())
+        self.assertEqual([], self.buffer.pop_pdus())
+
+    def test_pop_pdu(self):
+        [pdu] = self.mk_pdus(1)
+        self.buffer.feed(pdu)
+        self.assertEqual(pdu, self.buffer.pop_pdu())
+        self.assertEqual(None, self.buffer.pop_pdu())
+        self.assertEqual(0, len(self.buffer))
+
+    def test_partial_header(self):
+        pdu = EnquireLink(1).get_bin()
+        self.buffer.feed(pdu[:10])
+        self.assertEqual(None, self.buffer.pop_pdu())
+        self.buffer.feed(pdu[10:])
+        self.assertEqual(pdu, self.buffer.pop_pdu())
+
+    def test_partial_body(self):
+        [pdu] = self.mk_pdus(1)
+        self.buffer.feed(pdu[:-1])
+        self.assertEqual(None, self.buffer.pop_pdu())
+        self.assertEqual(len(pdu) - 1, len(self.buffer))
+        self.buffer.feed(pdu[-1:])
+        self.assertEqual(pdu, self.buffer.pop_pdu())
+
+    def test_pop_pdus_from_burst(self):
+        pdus = self.mk_pdus(100)
+        self.buffer.feed(''.join(pdus))
+        self.assertEqual(pdus, self.buffer.pop_pdus())
+        self.assertEqual(0, len(self.buffer))
+
+    def test_pop_pdus_from_small_reads(self):
+        pdus = self.mk_pdus(50)
+        data = ''.join(pdus)
+        popped = []
+        for i in range(0, len(data), 7):
+            self.buffer.feed(data[i:i + 7])
+            popped.extend(self.buffer.pop_pdus())
+        self.assertEqual(pdus, popped)
+
+    def test_compaction(self):
+        self.buffer.COMPACT_THRESHOLD = 100
+        pdus = self.mk_pdus(20)
+        self.buffer.feed(''.join(pdus) + pdus[0][:5])
+        self.assertEqual(pdus, self.buffer.pop_pdus())
+        self.assertEqual(5, len(self.buffer))
+        self.assertEqual(0, self.buffer._offset)
+        self.buffer.feed(pdus[0][5:])
+        self.assertEqual([pdus[0]], self.buffer.pop_pdus())
+
+    def test_invalid_command_length(self):
+        self.buffer.feed('\x00\x00\x00\x04' + '\x00' * 12)
+        self.assertRaises(PDUFramingError, self.buffer.pop_pdu)
@@ -0,0 +1,132 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_send_window -*-
+
+"""Local tracking of submitted PDUs awaiting a response."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+
+class SendWindow(object):
+    """
+    Tracks `submit_sm` PDUs that have been sent to the SMSC but not yet
+    answered with a `submit_sm_resp`.
+
+    In-flight PDUs are held in memory, keyed by sequence number. A response
+    to a PDU always arrives on the connection the PDU was sent over, so
+    there is no need to share this state through Redis.
+
+    Senders call :meth:`wait_for_space` before sending a PDU. This reserves
+    a slot in the window, which counts towards :meth:`is_full` until it is
+    filled with :meth:`add` or given back with :meth:`release`.
+
+    :param int max_size:
+        The maximum number of PDUs that may be in flight at once. A value of
+        `0` or `None` means the window is unbounded.
+    :param float timeout:
+        Seconds to wait for a response before giving up on a PDU. A value of
+        `0` or `None` disables timeouts.
+    :param timeout_callback:
+        Called as `timeout_callback(sequence_number, message_id)` when a
+        PDU times out. The PDU has already been removed from the window.
+    :param clock:
+        Provider of `callLater`, used to schedule timeouts. Defaults to the
+        reactor.
+    """
+
+    def __init__(self, max_size=None, timeout=None, timeout_callback=None,
+                 clock=reactor):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.timeout_callback = timeout_callback
+        self.clock = clock
+        self._pending = {}
+        self._reserved = 0
+        self._waiting = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, sequence_number):
+        return sequence_number in self._pending
+
+    def is_full(self):
+        return bool(self.max_size) and (
+            len(self._pending) + self._reserved >= self.max_size)
+
+    def add(self, sequence_number, message_id):
+        """
+        Record a PDU as in flight, filling a slot reserved by
+        :meth:`wait_for_space` if there is one. Adding a sequence number that
+        is already in the window replaces the existing entry.
+        """
+        if self._reserved:
+            self._reserved -= 1
+        self._cancel_timeout(sequence_number)
+        delayed_call = None
+        if self.timeout:
+            delayed_call = self.clock.callLater(
+                self.timeout, self._timed_out, sequence_number)
+        self._pending[sequence_number] = (message_id, delayed_call)
+
+    def remove(self, sequence_number):
+        """
+        Remove a PDU from the window and return the message id it was added
+        with, or `None` if the sequence number isn't in the window.
+        """
+        entry = self._pending.pop(sequence_number, None)
+        if entry is None:
+            return None
+        message_id, delayed_call = entry
+        if delayed_call is not None and delayed_call.active():
+            delayed_call.cancel()
+        self._notify_waiting()
+        return message_id
+
+    def clear(self):
+        """
+        Remove every PDU from the window, cancelling their timeouts, and
+        return the message ids that were in flight.
+        """
+        message_ids = []
+        for sequence_number in self._pending.keys():
+            message_ids.append(self.remove(sequence_number))
+        return message_ids
+
+    def wait_for_space(self):
+        """
+        Return a deferred that fires once a slot in the window has been
+        reserved for another PDU. The caller must either :meth:`add` the PDU
+        or :meth:`release` the slot.
+        """
+        if not self.is_full():
+            self._reserved += 1
+            return succeed(None)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def release(self):
+        """
+        Give back a slot reserved by :meth:`wait_for_space` without adding a
+        PDU, for example because the PDU couldn't be sent.
+        """
+        if self._reserved:
+            self._reserved -= 1
+            self._notify_waiting()
+
+    def _cancel_timeout(self, sequence_number):
+        entry = self._pending.get(sequence_number)
+        if entry is not None and entry[1] is not None:
+            if entry[1].active():
+                entry[1].cancel()
+
+    def _notify_waiting(self):
+        while self._waiting and not self.is_full():
+            self._reserved += 1
+            self._waiting.pop(0).callback(None)
+
+    def _timed_out(self, sequence_number):
+        message_id, _ = self._pending.pop(sequence_number)
+        self._notify_waiting()
+        if self.timeout_callback is not None:
+            self.timeout_callback(sequence_number, message_id)
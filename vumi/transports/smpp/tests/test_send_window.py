@@ -0,0 +1,119 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from vumi.transports.smpp.send_window import SendWindow
+
+
+class SendWindowTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.timed_out = []
+        self.window = SendWindow(
+            max_size=2, timeout=10, clock=self.clock,
+            timeout_callback=lambda *args: self.timed_out.append(args))
+
+    def test_add_and_remove(self):
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        self.assertEqual(2, len(self.window))
+        self.assertTrue(1 in self.window)
+        self.assertEqual('msg-2', self.window.remove(2))
+        self.assertEqual(None, self.window.remove(2))
+        self.assertEqual(1, len(self.window))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+    def test_is_full(self):
+        self.assertFalse(self.window.is_full())
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        self.assertTrue(self.window.is_full())
+        self.window.remove(1)
+        self.assertFalse(self.window.is_full())
+
+    def test_unbounded(self):
+        window = SendWindow(max_size=0, clock=self.clock)
+        for i in range(1000):
+            window.add(i, 'msg-%s' % (i,))
+        self.assertFalse(window.is_full())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_wait_for_space(self):
+        self.window.add(1, 'msg-1')
+        self.assertTrue(self.window.wait_for_space().called)
+        self.window.add(2, 'msg-2')
+        d = self.window.wait_for_space()
+        self.assertFalse(d.called)
+        self.window.remove(1)
+        self.assertTrue(d.called)
+
+    def test_wait_for_space_reserves_slot(self):
+        self.assertTrue(self.window.wait_for_space().called)
+        self.assertTrue(self.window.wait_for_space().called)
+        self.assertTrue(self.window.is_full())
+        self.assertEqual(0, len(self.window))
+        self.assertFalse(self.window.wait_for_space().called)
+        self.window.add(1, 'msg-1')
+        self.assertTrue(self.window.is_full())
+
+    def test_multiple_waiters(self):
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        d1 = self.window.wait_for_space()
+        d2 = self.window.wait_for_space()
+        d3 = self.window.wait_for_space()
+        self.window.remove(1)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        # The freed slot is reserved for the first waiter until it adds its
+        # PDU, so the window never holds more than max_size PDUs.
+        self.window.add(3, 'msg-3')
+        self.assertFalse(d2.called)
+        self.assertEqual(2, len(self.window))
+        self.window.remove(2)
+        self.assertTrue(d2.called)
+        self.assertFalse(d3.called)
+        # A released reservation lets the next waiter in.
+        self.window.release()
+        self.assertTrue(d3.called)
+        self.window.add(4, 'msg-4')
+        self.assertEqual(2, len(self.window))
+        self.assertTrue(self.window.is_full())
+
+    def test_release_without_reservation(self):
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        self.window.release()
+        self.assertTrue(self.window.is_full())
+
+    def test_timeout(self):
+        self.window.add(1, 'msg-1')
+        self.clock.advance(5)
+        self.window.add(2, 'msg-2')
+        self.clock.advance(5)
+        self.assertEqual([(1, 'msg-1')], self.timed_out)
+        self.assertEqual(1, len(self.window))
+        self.clock.advance(5)
+        self.assertEqual([(1, 'msg-1'), (2, 'msg-2')], self.timed_out)
+        self.assertEqual(0, len(self.window))
+
+    def test_timeout_frees_space(self):
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        d = self.window.wait_for_space()
+        self.clock.advance(10)
+        self.assertTrue(d.called)
+
+    def test_remove_cancels_timeout(self):
+        self.window.add(1, 'msg-1')
+        self.window.remove(1)
+        self.clock.advance(10)
+        self.assertEqual([], self.timed_out)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_clear(self):
+        self.window.add(1, 'msg-1')
+        self.window.add(2, 'msg-2')
+        self.assertEqual(['msg-1', 'msg-2'], sorted(self.window.clear()))
+        self.assertEqual(0, len(self.window))
+        self.assertEqual([], self.clock.getDelayedCalls())
@@ -219,6 +219,81 @@ class SmppTransportTestCase(TransportTestCase):
                                 [self.mkmsg_ack('447', '3rd_party_5'),
                                  self.mkmsg_ack('448', '3rd_party_6')])
 
+    @inlineCallbacks
+    def test_send_window_backpressure(self):
+        self.transport.send_window.max_size = 2
+        connector = self.transport.connectors[self.transport.transport_name]
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='451'))
+        self.assertFalse(connector._consumers['outbound'].paused)
+        yield self.dispatch(self.mkmsg_out("message 2", message_id='452'))
+        self.assertTrue(connector._consumers['outbound'].paused)
+        self.assertEqual(2, (yield self.esme.get_unacked_count()))
+
+        yield self.esme.handle_data(SubmitSMResp(1, "3rd_party_1").get_bin())
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual(1, len(self.transport.send_window))
+        self.assertEqual([self.mkmsg_ack('451', '3rd_party_1')],
+                         self.get_dispatched_events())
+
+    @inlineCallbacks
+    def test_send_window_multiple_waiters(self):
+        self.transport.send_window.max_size = 1
+        yield self.transport.handle_outbound_message(
+            self.mkmsg_out("message 1", message_id='451'))
+        d2 = self.transport.handle_outbound_message(
+            self.mkmsg_out("message 2", message_id='452'))
+        d3 = self.transport.handle_outbound_message(
+            self.mkmsg_out("message 3", message_id='453'))
+        self.assert_sent_contents(["message 1"])
+
+        yield self.esme.handle_data(SubmitSMResp(1, "3rd_party_1").get_bin())
+        yield d2
+        self.assertFalse(d3.called)
+        self.assert_sent_contents(["message 1", "message 2"])
+        self.assertEqual(1, len(self.transport.send_window))
+
+        yield self.esme.handle_data(SubmitSMResp(2, "3rd_party_2").get_bin())
+        yield d3
+        self.assert_sent_contents(["message 1", "message 2", "message 3"])
+        self.assertEqual(1, len(self.transport.send_window))
+
+    @inlineCallbacks
+    def test_disconnect_clears_send_window(self):
+        connector = self.transport.connectors[self.transport.transport_name]
+        self.transport.send_window.max_size = 1
+        yield self.dispatch(self.mkmsg_out("message", message_id='451'))
+        self.assertTrue(connector._consumers['outbound'].paused)
+
+        yield self.transport.esme_disconnected()
+        self.assertEqual(0, len(self.transport.send_window))
+        self.assertTrue(connector._consumers['outbound'].paused)
+        [nack] = yield self.wait_for_dispatched_events(1)
+        self.assertEqual(nack['user_message_id'], '451')
+        self.assertEqual(nack['nack_reason'],
+                         'Connection lost before submit_sm_resp')
+
+        yield self.transport.esme_connected(self.esme)
+        self.assertFalse(connector._consumers['outbound'].paused)
+
+    @inlineCallbacks
+    def test_submit_sm_timeout(self):
+        clock = Clock()
+        self.transport.send_window.clock = clock
+        message = self.mkmsg_out("message", message_id='453')
+        yield self.dispatch(message)
+        self.assertEqual(1, len(self.transport.send_window))
+
+        clock.advance(self.transport.submit_sm_timeout)
+        [nack] = yield self.wait_for_dispatched_events(1)
+        self.assertEqual(nack['user_message_id'], '453')
+        self.assertEqual(nack['nack_reason'],
+                         'Timed out waiting for submit_sm_resp')
+        self.assertEqual(0, len(self.transport.send_window))
+
+        # A late response is ignored.
+        yield self.esme.handle_data(SubmitSMResp(1, "3rd_party_1").get_bin())
+        self.assertEqual(1, len(self.get_dispatched_events()))
+
     @inlineCallbacks
     def test_reconnect(self):
         connector = self.transport.connectors[self.transport.transport_name]
@@ -6,12 +6,13 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
-from vumi.utils import get_operator_number
+from vumi.utils import OperatorRoutingTable
 from vumi.transports.base import Transport
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiverFactory, EsmeTransmitterFactory, EsmeReceiverFactory,
     EsmeCallbacks)
 from vumi.transports.smpp.clientserver.config import ClientConfig
+from vumi.transports.smpp.send_window import SendWindow
 from vumi.transports.failures import FailureMessage
 from vumi.message import Message, TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
@@ -63,6 +64,15 @@ class SmppTransport(Transport):
     :param throttle_delay:
         Delay (in seconds) before retrying a message after receiving
         `ESME_RTHROTTLED`. Default 0.1
+    :type max_window_size: int, optional
+    :param max_window_size:
+        Maximum number of `submit_sm` PDUs awaiting a `submit_sm_resp` at
+        any one time. The outbound consumer is paused while the window is
+        full. Set to 0 for no limit. Default 100.
+    :type submit_sm_timeout: float, optional
+    :param submit_sm_timeout:
+        Seconds to wait for a `submit_sm_resp` before the message is
+        treated as failed. Set to 0 to wait forever. Default 60.
 
     SMPP protocol configuration options:
 
@@ -99,6 +109,13 @@ class SmppTransport(Transport):
         `message_payload` optional field instead of the `short_message` field.
         Default is `False`, simply because that maintains previous behaviour.
 
+    :param int sequence_block_size:
+        The number of SMPP sequence numbers to reserve from Redis at a time.
+        Sequence numbers are handed out locally from the reserved block, so
+        larger values mean fewer Redis calls per PDU at the cost of skipping
+        the unused part of a block on reconnect. Binds sharing a
+        `split_bind_prefix` never get overlapping blocks. Default is 1.
+
     The list of SMPP protocol configuration options given above is not
     exhaustive. Any other options specified are passed through to the
     python-smpp library PDU (protocol data unit) builder.
@@ -130,6 +147,13 @@ class SmppTransport(Transport):
     def validate_config(self):
         self.client_config = ClientConfig.from_config(self.config)
         self.throttle_delay = float(self.config.get('throttle_delay', 0.1))
+        self.max_window_size = int(self.config.get('max_window_size', 100))
+        self.submit_sm_timeout = float(
+            self.config.get('submit_sm_timeout', 60))
+        self.operator_routing = OperatorRoutingTable(
+            self.config.get('OPERATOR_PREFIX', {}),
+            self.config.get('COUNTRY_CODE', ''),
+            self.config.get('OPERATOR_NUMBER', {}))
 
     @inlineCallbacks
     def setup_transport(self):
@@ -152,6 +176,10 @@ class SmppTransport(Transport):
 
         self.r_message_prefix = "message_json"
         self.throttled = False
+        self.window_full = False
+        self.send_window = SendWindow(
+            max_size=self.max_window_size, timeout=self.submit_sm_timeout,
+            timeout_callback=self.submit_sm_timed_out)
 
         self.esme_callbacks = EsmeCallbacks(
             connect=self.esme_connected,
@@ -173,6 +201,8 @@ class SmppTransport(Transport):
         if hasattr(self, 'factory'):
             self.factory.stopTrying()
             self.factory.esme.transport.loseConnection()
+        if hasattr(self, 'send_window'):
+            self.send_window.clear()
         yield self.redis._close()
 
     def make_factory(self):
@@ -183,25 +213,44 @@ class SmppTransport(Transport):
         log.msg("ESME Connected, adding handlers")
         self.esme_client = client
         # Start the consumer
-        self.unpause_connectors()
+        if not self.window_full:
+            self.unpause_connectors()
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
         log.debug("Consumed outgoing message %r" % (message,))
         log.debug("Unacknowledged message count: %s" % (
-                (yield self.esme_client.get_unacked_count()),))
+                len(self.send_window),))
         yield self.r_set_message(message)
         yield self._submit_outbound_message(message)
 
     @inlineCallbacks
     def _submit_outbound_message(self, message):
-        sequence_number = yield self.send_smpp(message)
-        yield self.r_set_id_for_sequence(
-            sequence_number, message.payload.get("message_id"))
+        yield self.send_window.wait_for_space()
+        try:
+            sequence_number = yield self.send_smpp(message)
+        except Exception:
+            self.send_window.release()
+            raise
+        if sequence_number:
+            self.send_window.add(
+                sequence_number, message.payload.get("message_id"))
+        else:
+            self.send_window.release()
+        self._check_send_window()
 
     def esme_disconnected(self):
         log.msg("ESME Disconnected")
         self.pause_connectors()
+        # PDUs sent over the lost connection will never get a response, so
+        # fail them now rather than letting them hold window slots until
+        # they time out. We're paused already, so reset window_full instead
+        # of going through _check_send_window, which would unpause us.
+        self.window_full = False
+        for sent_sms_id in self.send_window.clear():
+            self._fail_in_flight(
+                sent_sms_id, 'Connection lost before submit_sm_resp')
+        self.window_full = self.send_window.is_full()
 
     # Redis message storing methods
 
@@ -227,17 +276,6 @@ class SmppTransport(Transport):
     def r_delete_message(self, message_id):
         return self.redis.delete(self.r_message_key(message_id))
 
-    # Redis sequence number storing methods
-
-    def r_get_id_for_sequence(self, sequence_number):
-        return self.redis.get(str(sequence_number))
-
-    def r_delete_for_sequence(self, sequence_number):
-        return self.redis.delete(str(sequence_number))
-
-    def r_set_id_for_sequence(self, sequence_number, id):
-        return self.redis.set(str(sequence_number), id)
-
     # Redis 3rd party id to vumi id mapping
 
     def r_third_party_id_key(self, third_party_id):
@@ -268,20 +306,45 @@ class SmppTransport(Transport):
             return
         log.err("No longer throttling outbound messages.")
         self.throttled = False
-        self.unpause_connectors()
+        if not self.window_full:
+            self.unpause_connectors()
+
+    def _check_send_window(self):
+        """
+        Pause the outbound consumer while the send window is full and
+        unpause it once there is room again (unless we're throttled).
+        """
+        if self.send_window.is_full():
+            if not self.window_full:
+                log.msg("Send window full, pausing outbound messages.")
+                self.window_full = True
+                self.pause_connectors()
+        elif self.window_full:
+            log.msg("Send window has room, resuming outbound messages.")
+            self.window_full = False
+            if not self.throttled:
+                self.unpause_connectors()
+
+    def submit_sm_timed_out(self, sequence_number, sent_sms_id):
+        log.warning("Timed out waiting for submit_sm_resp for sequence "
+                    "number %s (message %s)." % (sequence_number, sent_sms_id))
+        self._check_send_window()
+        return self._fail_in_flight(
+            sent_sms_id, 'Timed out waiting for submit_sm_resp')
+
+    def _fail_in_flight(self, sent_sms_id, reason):
+        return self.submit_sm_failure(sent_sms_id, reason).addErrback(log.err)
 
     @inlineCallbacks
     def submit_sm_resp(self, *args, **kwargs):
         transport_msg_id = kwargs['message_id']
-        sent_sms_id = (
-            yield self.r_get_id_for_sequence(kwargs['sequence_number']))
+        sent_sms_id = self.send_window.remove(kwargs['sequence_number'])
         if sent_sms_id is None:
             log.err("Sequence number lookup failed for:%s" % (
                 kwargs['sequence_number'],))
         else:
             yield self.r_set_id_for_third_party_id(
                 transport_msg_id, sent_sms_id)
-            yield self.r_delete_for_sequence(kwargs['sequence_number'])
             status = kwargs['command_status']
             if status == 'ESME_ROK':
                 # The sms was submitted ok
@@ -295,6 +358,7 @@ class SmppTransport(Transport):
                 yield self.submit_sm_failure(sent_sms_id,
                                              status or 'Unspecified')
                 yield self._stop_throttling()
+            self._check_send_window()
 
     @inlineCallbacks
     def submit_sm_success(self, sent_sms_id, transport_msg_id):
@@ -405,10 +469,8 @@ class SmppTransport(Transport):
         text = message['content']
         continue_session = (
             message['session_event'] != TransportUserMessage.SESSION_CLOSE)
-        route = get_operator_number(to_addr,
-                self.config.get('COUNTRY_CODE', ''),
-                self.config.get('OPERATOR_PREFIX', {}),
-                self.config.get('OPERATOR_NUMBER', {})) or from_addr
+        route = self.operator_routing.get_operator_number(
+            to_addr) or from_addr
         return self.esme_client.submit_sm(
                 short_message=text.encode('utf-8'),
                 destination_addr=str(to_addr),
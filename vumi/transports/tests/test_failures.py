@@ -65,11 +65,6 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         else:
             self.assertEqual(None, retry_key)
 
-    @inlineCallbacks
-    def assert_stored_timestamps(self, *expected):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
-        self.assertEqual(list(expected), timestamps)
-
     def assert_published_retries(self, expected):
         msgs = self.broker.get_dispatched('vumi', 'sms.outbound.sphex')
         self.assertEqual(expected, [json.loads(m.body) for m in msgs])
@@ -184,49 +179,54 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         self.assert_write_timestamp("1970-01-01T00:00:24", 12, 11)
 
     @inlineCallbacks
-    def test_store_read_timestamp(self):
+    def test_store_retry(self):
         """
-        We need to store granular timestamps.
+        Store a retry in redis and make sure we can get at it again.
         """
-        timestamp1 = "1977-07-28T12:34:56"
-        timestamp2 = "1980-07-30T12:34:56"
-        timestamp3 = "1980-09-02T12:34:56"
-        yield self.assert_stored_timestamps()
-        yield self.worker.store_read_timestamp(timestamp2)
-        yield self.assert_stored_timestamps(timestamp2)
-        yield self.worker.store_read_timestamp(timestamp1)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2)
-        yield self.worker.store_read_timestamp(timestamp3)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2, timestamp3)
+        key = yield self.store_failure()
+        yield self.assert_zcard(0, 'retry_due')
+
+        yield self.worker.store_retry(key, 0, now=0)
+        yield self.assert_zcard(1, 'retry_due')
+        yield self.assert_equal_d(
+            5, self.worker.retry_queue.get_due_time(key))
+        yield self.assert_equal_d(
+            json.dumps(key), self.redis.hget('retry_items', key))
 
     @inlineCallbacks
-    def test_read_timestamp(self):
+    def test_store_failure_with_retry(self):
         """
-        We need to read the next timestamp.
+        Storing a failure with a retry delay should queue a retry.
         """
-        past = mktimestamp(-10)
-        future = mktimestamp(10)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(future)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(past)
-        yield self.assert_equal_d(past, self.worker.get_next_read_timestamp())
+        key = yield self.worker.store_failure(
+            {'message': 'foo'}, "reason", retry_delay=10)
+        yield self.assert_zcard(1, 'retry_due')
+        due = yield self.worker.retry_queue.get_due_time(key)
+        self.assertTrue(time.time() + 10 <= due <= time.time() + 15)
 
     @inlineCallbacks
-    def test_store_retry(self):
+    def test_migrate_legacy_retries(self):
         """
-        Store a retry in redis and make sure we can get at it again.
+        Retries stored in time buckets by older versions should be moved
+        into the retry queue.
         """
-        timestamp = "1970-01-01T00:00:05"
-        retry_key = "retry_keys." + timestamp
-        key = yield self.store_failure()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        key1 = yield self.store_failure()
+        key2 = yield self.store_failure()
+        timestamp = mktimestamp(-10)
+        yield self.redis.sadd("retry_keys." + timestamp, key1)
+        yield self.redis.sadd("retry_keys." + timestamp, key2)
+        yield self.redis.zadd('retry_timestamps', **{timestamp: 0})
 
-        yield self.worker.store_retry(key, 0, now=0)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_equal_d([timestamp],
-                                  self.redis.zrange('retry_timestamps', 0, 0))
-        yield self.assert_equal_d(set([key]), self.redis.smembers(retry_key))
+        yield self.worker.migrate_legacy_retries()
+        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_equal_d(
+            set(), self.redis.smembers("retry_keys." + timestamp))
+        yield self.assert_zcard(2, 'retry_due')
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 2)
 
     def test_get_retry_key_none(self):
         """
@@ -240,9 +240,9 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         If there are no retries due, get None.
         """
         yield self.store_retry(10)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
         yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
 
     @inlineCallbacks
     def test_get_retry_key_one_due(self):
@@ -250,9 +250,9 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         Get a retry from redis when we have one due.
         """
         yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
         yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_zcard(0, 'retry_due')
         yield self.assert_get_retry_key(False)
 
     @inlineCallbacks
@@ -262,9 +262,9 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         """
         yield self.store_retry(0, -5)
         yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(2, 'retry_due')
         yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
 
     @inlineCallbacks
     def test_get_retry_key_two_due_different_times(self):
@@ -273,11 +273,11 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         """
         yield self.store_retry(0, -5)
         yield self.store_retry(0, -15)
-        yield self.assert_zcard(2, 'retry_timestamps')
+        yield self.assert_zcard(2, 'retry_due')
         yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
         yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_zcard(0, 'retry_due')
 
     @inlineCallbacks
     def test_get_retry_key_one_due_one_future(self):
@@ -285,12 +285,12 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         Get a retry from redis when we have one due and one in the future.
         """
         yield self.store_retry(0, -5)
-        yield self.worker.store_retry(self.store_failure(), 0)
-        yield self.assert_zcard(2, 'retry_timestamps')
+        yield self.worker.store_retry((yield self.store_failure()), 0)
+        yield self.assert_zcard(2, 'retry_due')
         yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
         yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_zcard(1, 'retry_due')
 
     @inlineCallbacks
     def test_deliver_retries_none(self):
@@ -305,7 +305,7 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         """
         Delivering no current retries should do nothing.
         """
-        yield self.worker.store_retry(self.store_failure(), 0)
+        yield self.worker.store_retry((yield self.store_failure()), 0)
         yield self.worker.deliver_retries()
         self.assert_published_retries([])
 
@@ -1,19 +1,21 @@
 # -*- test-case-name: vumi.tests.test_utils -*-
 
 import os.path
-import re
 import sys
 import base64
 import pkg_resources
 import warnings
+import urlparse
+from collections import deque
 from functools import wraps
 
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet import reactor, protocol
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, fail
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, ResponseDone
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, ResponseDone, RequestNotSent)
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
@@ -112,35 +114,237 @@ class SimplishReceiver(protocol.Protocol):
             self.deferred.errback(reason)
 
 
-def http_request_full(url, data=None, headers={}, method='POST',
-                      timeout=None, data_limit=None):
-    agent = Agent(reactor)
-    d = agent.request(method,
-                      url,
-                      mkheaders(headers),
-                      StringProducer(data) if data else None)
+class HttpQueueFullError(HttpError):
+    """Returned by http_request_full if too many requests are already
+    waiting for a connection to the same host."""
+
+
+class HttpClient(object):
+    """
+    Makes HTTP requests over a pool of persistent connections.
+
+    At most `max_per_host` requests are sent to a host at once. Further
+    requests wait for one of these to finish, up to `max_queued_per_host` of
+    them, after which new requests fail immediately with
+    :class:`HttpQueueFullError` rather than queuing without bound.
+
+    Idle connections are kept open for `idle_timeout` seconds so that
+    later requests to the same host can skip the TCP (and TLS) handshake.
+
+    :param bool persistent:
+        Whether to keep connections open between requests.
+    :param int max_per_host:
+        Maximum number of requests in flight to each host.
+    :param int max_queued_per_host:
+        Maximum number of requests waiting for a connection to each host.
+        `None` means no limit.
+    :param float connect_timeout:
+        Seconds to wait for a new connection to be established. `None`
+        uses the Twisted default.
+    :param float idle_timeout:
+        Seconds to keep an idle connection open.
+    :param metrics_hook:
+        Called as `metrics_hook(name, value)` for each request. `name` is
+        one of `'queued'` (the number of requests waiting for the host when
+        the request was made), `'rejected'`, `'timeout'`, `'failed'` or
+        `'response_time'` (the seconds from making the request to receiving
+        the whole response, including any time spent waiting).
+    """
+
+    def __init__(self, persistent=True, max_per_host=10,
+                 max_queued_per_host=1000, connect_timeout=None,
+                 idle_timeout=240, metrics_hook=None):
+        self.pool = HTTPConnectionPool(reactor, persistent=persistent)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+        agent_kw = {'pool': self.pool}
+        if connect_timeout is not None:
+            agent_kw['connectTimeout'] = connect_timeout
+        self.agent = Agent(reactor, **agent_kw)
+        self.max_per_host = max_per_host
+        self.max_queued_per_host = max_queued_per_host
+        self.metrics_hook = metrics_hook
+        # Maps (scheme, netloc) to [in flight count, deque of waiters].
+        self._hosts = {}
+        self.stats = {
+            'requests': 0,
+            'queued': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'failed': 0,
+        }
+
+    def close(self):
+        """Close all idle connections.
+
+        Returns a deferred that fires once they have been closed.
+        """
+        return self.pool.closeCachedConnections()
+
+    def _record(self, name, value):
+        if self.metrics_hook is not None:
+            self.metrics_hook(name, value)
+
+    def _host_key(self, url):
+        parts = urlparse.urlsplit(url)
+        return (parts.scheme, parts.netloc)
+
+    def pending(self, url):
+        """Return the number of requests in flight and waiting for the host
+        in `url`.
+        """
+        in_flight, waiting = self._hosts.get(self._host_key(url), (0, ()))
+        return in_flight + len(waiting)
+
+    def _acquire(self, host):
+        slot = self._hosts.setdefault(host, [0, deque()])
+        if slot[0] < self.max_per_host:
+            slot[0] += 1
+            return succeed(None)
+        waiting = slot[1]
+        if (self.max_queued_per_host is not None and
+                len(waiting) >= self.max_queued_per_host):
+            self.stats['rejected'] += 1
+            self._record('rejected', 1)
+            return fail(HttpQueueFullError(
+                "Too many requests waiting for %s://%s" % host))
+        self.stats['queued'] += 1
+        self._record('queued', len(waiting) + 1)
+        d = defer.Deferred(canceller=lambda d: waiting.remove(d))
+        waiting.append(d)
+        return d
+
+    def _release(self, host):
+        slot = self._hosts[host]
+        if slot[1]:
+            # Hand our place straight to the next waiting request.
+            slot[1].popleft().callback(None)
+            return
+        slot[0] -= 1
+        if slot[0] == 0:
+            del self._hosts[host]
+
+    def request(self, url, data=None, headers={}, method='POST',
+                timeout=None, data_limit=None):
+        """
+        Make an HTTP request.
+
+        Returns a deferred that fires with the response once its whole body
+        has been received. The body is available as `delivered_body` on the
+        response.
+
+        :param float timeout:
+            Seconds to wait for the whole response, including any time
+            spent waiting for a connection. `None` means wait forever.
+        :param int data_limit:
+            Maximum number of bytes of body to receive.
+        """
+        host = self._host_key(url)
+        started = reactor.seconds()
+        d = self._acquire(host)
+        d.addCallback(
+            self._send, host, url, data, headers, method, data_limit)
+        d.addBoth(self._request_done, started)
+
+        if timeout is not None:
+            cancelling_on_timeout = [False]
+
+            def raise_timeout(reason):
+                if not cancelling_on_timeout[0]:
+                    return reason
+                self.stats['timeouts'] += 1
+                self._record('timeout', 1)
+                return Failure(HttpTimeoutError("Timeout while connecting"))
+
+            def cancel_on_timeout():
+                cancelling_on_timeout[0] = True
+                d.cancel()
+
+            def cancel_timeout(result):
+                if delayed_call.active():
+                    delayed_call.cancel()
+                return result
+
+            d.addErrback(raise_timeout)
+            delayed_call = reactor.callLater(timeout, cancel_on_timeout)
+            d.addBoth(cancel_timeout)
+
+        return d
+
+    def _send(self, _, host, url, data, headers, method, data_limit):
+        self.stats['requests'] += 1
+        d = self._send_request(url, data, headers, method)
+
+        def retry_unsent(failure):
+            # A pooled connection may have been closed by the server after
+            # we chose to reuse it, in which case nothing was sent and it's
+            # safe to try again even if the method isn't idempotent.
+            failure.trap(RequestNotSent)
+            return self._send_request(url, data, headers, method)
+
+        d.addErrback(retry_unsent)
+
+        def handle_response(response):
+            return SimplishReceiver(response, data_limit).deferred
+
+        d.addCallback(handle_response)
+
+        def release(result):
+            self._release(host)
+            return result
+
+        return d.addBoth(release)
+
+    def _send_request(self, url, data, headers, method):
+        return self.agent.request(method,
+                                  url,
+                                  mkheaders(headers),
+                                  StringProducer(data) if data else None)
+
+    def _request_done(self, result, started):
+        if isinstance(result, Failure):
+            self.stats['failed'] += 1
+            self._record('failed', 1)
+        else:
+            self._record('response_time', reactor.seconds() - started)
+        return result
+
 
-    def handle_response(response):
-        return SimplishReceiver(response, data_limit).deferred
+_http_client = None
 
-    d.addCallback(handle_response)
 
-    if timeout is not None:
-        cancelling_on_timeout = [False]
+def get_http_client():
+    """Return the :class:`HttpClient` used by :func:`http_request_full`,
+    creating one with the default settings if there isn't one yet."""
+    global _http_client
+    if _http_client is None:
+        _http_client = HttpClient()
+    return _http_client
 
-        def raise_timeout(reason):
-            if not cancelling_on_timeout[0]:
-                return reason
-            return Failure(HttpTimeoutError("Timeout while connecting"))
 
-        def cancel_on_timeout():
-            cancelling_on_timeout[0] = True
-            d.cancel()
+def set_http_client(http_client):
+    """Replace the :class:`HttpClient` used by :func:`http_request_full`.
 
-        d.addErrback(raise_timeout)
-        reactor.callLater(timeout, cancel_on_timeout)
+    Returns the client that was replaced, which may be `None`.
+    """
+    global _http_client
+    old_client, _http_client = _http_client, http_client
+    return old_client
 
-    return d
+
+def http_request_full(url, data=None, headers={}, method='POST',
+                      timeout=None, data_limit=None, http_client=None):
+    """
+    Make an HTTP request. See :meth:`HttpClient.request`.
+
+    If `http_client` is `None`, the shared client returned by
+    :func:`get_http_client` is used.
+    """
+    if http_client is None:
+        http_client = get_http_client()
+    return http_client.request(url, data=data, headers=headers,
+                               method=method, timeout=timeout,
+                               data_limit=data_limit)
 
 
 def mkheaders(headers):
@@ -347,8 +551,9 @@ def get_first_word(content, delimiter=' '):
 
 
 def cleanup_msisdn(number, country_code):
-    number = re.sub('\+', '', number)
-    number = re.sub('^0', country_code, number)
+    number = number.replace('+', '')
+    if number.startswith('0'):
+        number = country_code + number[1:]
     return number
 
 
@@ -368,6 +573,131 @@ def get_operator_number(msisdn, country_code, mapping, numbers):
     return number
 
 
+class PrefixTrie(object):
+    """
+    A longest-prefix-match lookup table for strings.
+
+    Lookups walk the trie one character at a time, so they take time
+    proportional to the length of the key rather than the number of
+    prefixes stored.
+
+    >>> trie = PrefixTrie({'27': 'ZA', '2782': 'VODACOM'})
+    >>> trie.lookup('27821234567')
+    'VODACOM'
+    >>> trie.lookup('27711234567')
+    'ZA'
+    >>> trie.lookup('44123', 'UNKNOWN')
+    'UNKNOWN'
+    """
+
+    # Values are stored under this key in each node. Keys are otherwise
+    # single characters, so this can't clash with a child.
+    _VALUE = None
+
+    def __init__(self, prefixes=None):
+        self._root = {}
+        self._size = 0
+        for prefix, value in (prefixes or {}).iteritems():
+            self.add(prefix, value)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, prefix, value):
+        """Add a prefix, replacing its value if it's already present."""
+        node = self._root
+        for char in str(prefix):
+            node = node.setdefault(char, {})
+        if self._VALUE not in node:
+            self._size += 1
+        node[self._VALUE] = value
+
+    def lookup(self, key, default=None):
+        """Return the value of the longest prefix of `key`, or `default`."""
+        node = self._root
+        value = node.get(self._VALUE, default)
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(self._VALUE, value)
+        return value
+
+    def lookup_all(self, key):
+        """Return the values of every prefix of `key`, shortest first."""
+        node = self._root
+        values = []
+        if self._VALUE in node:
+            values.append(node[self._VALUE])
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            if self._VALUE in node:
+                values.append(node[self._VALUE])
+        return values
+
+
+class OperatorRoutingTable(object):
+    """
+    Compiled version of an operator prefix mapping, for looking up the
+    network an MSISDN belongs to.
+
+    :param dict prefixes:
+        Mapping of MSISDN prefixes to network names in the same (possibly
+        nested) format as used by :func:`get_operator_name`. A nested
+        mapping's prefixes only apply to MSISDNs that also start with the
+        prefixes of the mappings containing it.
+    :param str country_code:
+        Used to replace a leading zero in an MSISDN, as
+        :func:`cleanup_msisdn` does.
+    :param dict numbers:
+        Mapping of network names to the source MSISDN to use for them,
+        as used by :func:`get_operator_number`.
+
+    Unlike :func:`get_operator_name`, when prefixes overlap the longest
+    matching prefix always wins.
+    """
+
+    UNKNOWN = 'UNKNOWN'
+
+    def __init__(self, prefixes, country_code='', numbers=None):
+        self.country_code = country_code
+        self.numbers = numbers or {}
+        self._trie = PrefixTrie()
+        self._add_prefixes(prefixes, '')
+
+    def __len__(self):
+        return len(self._trie)
+
+    def _add_prefixes(self, prefixes, parent):
+        for prefix, value in prefixes.iteritems():
+            prefix = str(prefix)
+            if not prefix.startswith(parent):
+                if not parent.startswith(prefix):
+                    # No MSISDN can start with both prefixes.
+                    continue
+                prefix = parent
+            if isinstance(value, dict):
+                self._add_prefixes(value, prefix)
+            else:
+                self._trie.add(prefix, value)
+
+    def cleanup_msisdn(self, msisdn):
+        return cleanup_msisdn(msisdn, self.country_code)
+
+    def get_operator_name(self, msisdn):
+        return self._trie.lookup(msisdn, self.UNKNOWN)
+
+    def get_operator_number(self, msisdn):
+        """
+        Return the source MSISDN to use for `msisdn`'s network, or `None`
+        if there isn't one. `msisdn` is cleaned up first.
+        """
+        operator = self.get_operator_name(self.cleanup_msisdn(msisdn))
+        return self.numbers.get(operator)
+
+
 def safe_routing_key(routing_key):
     """
     >>> safe_routing_key(u'*32323#')
@@ -379,6 +709,114 @@ def safe_routing_key(routing_key):
                     [('*', 's'), ('#', 'h')], routing_key)
 
 
+class LRUCache(object):
+    """
+    A mapping that holds at most `max_size` items, evicting the least
+    recently used item when a new one is added to a full cache.
+
+    Example::
+
+      >>> cache = LRUCache(2)
+      >>> cache['a'] = 1
+      >>> cache['b'] = 2
+      >>> cache.get('a')
+      1
+      >>> cache['c'] = 3
+      >>> 'b' in cache
+      False
+    """
+
+    # Indexes into the [prev, next, key, value] linked list entries.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1, got %r"
+                             % (max_size,))
+        self.max_size = max_size
+        self._links = {}
+        # The root of a circular doubly linked list. The item after the root
+        # is the least recently used and the one before it is the most
+        # recently used.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        prev_link, next_link = link[self.PREV], link[self.NEXT]
+        prev_link[self.NEXT] = next_link
+        next_link[self.PREV] = prev_link
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, root
+        last[self.NEXT] = root[self.PREV] = link
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def __getitem__(self, key):
+        if key not in self._links:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+        else:
+            if len(self._links) >= self.max_size:
+                self.pop(self._root[self.NEXT][self.KEY])
+            link = [None, None, key, None]
+            self._links[key] = link
+        link[self.VALUE] = value
+        self._append(link)
+
+    def __delitem__(self, key):
+        link = self._links.pop(key)
+        self._unlink(link)
+
+    def pop(self, key, default=None):
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[self.VALUE]
+
+    def oldest(self):
+        """Return the least recently used `(key, value)` pair without
+        marking it as used, or `None` if the cache is empty."""
+        link = self._root[self.NEXT]
+        if link is self._root:
+            return None
+        return link[self.KEY], link[self.VALUE]
+
+    def clear(self):
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def keys(self):
+        """Return the keys from least to most recently used."""
+        keys = []
+        link = self._root[self.NEXT]
+        while link is not self._root:
+            keys.append(link[self.KEY])
+            link = link[self.NEXT]
+        return keys
+
+
 ### SAMPLE CONFIG PARAMETERS - REPLACE 'x's IN OPERATOR_NUMBER
 
 """
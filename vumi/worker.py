@@ -8,7 +8,7 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigCache, ConfigInt, ConfigText
 from vumi.errors import DuplicateConnectorError
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
@@ -32,6 +32,15 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_concurrency = ConfigInt(
+        "The maximum number of messages from each AMQP queue that are"
+        " processed at the same time by each worker instance.",
+        default=1, static=True)
+    amqp_ordering_key = ConfigText(
+        "If set, messages with the same value for this message field (e.g."
+        " `from_addr`) are always processed in the order they arrive, even"
+        " when `amqp_concurrency` is greater than one.",
+        static=True)
 
 
 class BaseWorker(Worker):
@@ -43,12 +52,16 @@ class BaseWorker(Worker):
     """
 
     CONFIG_CLASS = BaseConfig
+    # The maximum number of per-message config objects to keep around.
+    CONFIG_CACHE_SIZE = 100
 
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = ConfigCache(
+            self.CONFIG_CLASS, self.CONFIG_CACHE_SIZE)
         self._hb_pub = None
 
     def startWorker(self):
@@ -100,6 +113,7 @@ class BaseWorker(Worker):
             'hostname': socket.gethostname(),
             'timestamp': time.time(),
             'pid': os.getpid(),
+            'config_cache': self._config_cache.stats(),
         }
         return attrs
 
@@ -138,8 +152,21 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        The config object is built once and reused, since it doesn't depend
+        on the message.
+        """
+        return succeed(self.get_cached_config(None, lambda: self.config))
+
+    def get_cached_config(self, cache_key, get_config_data):
+        """Return a (possibly cached) config object for `cache_key`.
+
+        Subclasses that build per-message config should use this, with a
+        `cache_key` that identifies the config data returned by
+        `get_config_data()`, to avoid validating the same config for every
+        message.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return self._config_cache.get(cache_key, get_config_data)
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -163,12 +190,15 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            concurrency=static_config.amqp_concurrency,
+            ordering_key=static_config.amqp_ordering_key,
+            middlewares=middlewares)
         self.connectors[connector_name] = connector
 
         d = connector.setup()